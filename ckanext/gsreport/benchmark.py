@@ -0,0 +1,433 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Performance benchmark for gsreport reports.
+
+Benchmark creates synthetic catalog (organizations, datasets and
+resources) directly in database, starts local stub server which serves
+resource files and WMS/WFS capabilities with configurable latency and
+failure rate, and generates each report for option combinations of
+synthetic organizations, measuring wall time, number of db queries,
+number of requests received by stub server and memory.
+
+This modifies database, so it should be run on development instance
+with empty catalog. Synthetic catalog is removed after benchmark,
+with check runs and cached reports of its organizations.
+"""
+
+import json
+import logging
+import random
+import resource
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from urlparse import urlparse, parse_qs
+
+from sqlalchemy import event, select
+from ckan import model
+
+log = logging.getLogger(__name__)
+
+NAME_PREFIX = 'gsreport-bench-'
+DEFAULT_SIZES = (1000, 10000, 100000,)
+REPORT_NAMES = ('resources-format', 'licenses', 'broken-links',)
+
+FORMATS = ('CSV', 'PDF', 'SHP', 'ZIP', 'XLS', 'JSON', 'WMS', 'WFS', '',)
+LICENSES = ('cc-by', 'cc-by-sa', 'cc-zero', 'odc-odbl', 'other-open', None,)
+RESOURCES_PER_DATASET = 5
+RESOURCES_PER_ORG = 1000
+# how many resources point to the same file
+DUPLICATE_URLS = 3
+# how many layers are published by one stub OWS endpoint
+LAYERS_PER_ENDPOINT = 50
+
+WMS_CAPABILITIES = """<?xml version="1.0" encoding="UTF-8"?>
+<WMT_MS_Capabilities version="1.1.1" xmlns:xlink="http://www.w3.org/1999/xlink">
+<Service>
+  <Name>OGC:WMS</Name>
+  <Title>gsreport stub</Title>
+  <OnlineResource xlink:href="{url}"/>
+</Service>
+<Capability>
+  <Request>
+    <GetCapabilities>
+      <Format>application/vnd.ogc.wms_xml</Format>
+      <DCPType><HTTP><Get><OnlineResource xlink:href="{url}"/></Get></HTTP></DCPType>
+    </GetCapabilities>
+    <GetMap>
+      <Format>image/png</Format>
+      <DCPType><HTTP><Get><OnlineResource xlink:href="{url}"/></Get></HTTP></DCPType>
+    </GetMap>
+  </Request>
+  <Layer>
+    <Title>gsreport stub</Title>
+    <SRS>EPSG:4326</SRS>
+    {layers}
+  </Layer>
+</Capability>
+</WMT_MS_Capabilities>
+"""
+
+WMS_LAYER = """<Layer queryable="0"><Name>{name}</Name><Title>{name}</Title>
+    <LatLonBoundingBox minx="-180" miny="-90" maxx="180" maxy="90"/></Layer>"""
+
+WFS_CAPABILITIES = """<?xml version="1.0" encoding="UTF-8"?>
+<WFS_Capabilities version="1.0.0" xmlns="http://www.opengis.net/wfs">
+<Service>
+  <Name>WFS</Name>
+  <Title>gsreport stub</Title>
+  <OnlineResource>{url}</OnlineResource>
+</Service>
+<Capability>
+  <Request>
+    <GetCapabilities>
+      <DCPType><HTTP><Get onlineResource="{url}"/></HTTP></DCPType>
+    </GetCapabilities>
+    <GetFeature>
+      <ResultFormat><GML2/></ResultFormat>
+      <DCPType><HTTP><Get onlineResource="{url}"/></HTTP></DCPType>
+    </GetFeature>
+  </Request>
+</Capability>
+<FeatureTypeList>
+  {layers}
+</FeatureTypeList>
+</WFS_Capabilities>
+"""
+
+WFS_LAYER = """<FeatureType><Name>{name}</Name><Title>{name}</Title><SRS>EPSG:4326</SRS>
+    <LatLongBoundingBox minx="-180" miny="-90" maxx="180" maxy="90"/></FeatureType>"""
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    # set by StubServer
+    stub = None
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+    def do_HEAD(self):
+        self._respond(body=False)
+
+    def do_GET(self):
+        self._respond(body=True)
+
+    def _respond(self, body):
+        stub = self.stub
+        stub.count_request()
+        if stub.latency:
+            time.sleep(stub.latency)
+        if stub.should_fail():
+            self.send_response(500)
+            self.send_header('Content-Type', 'text/plain')
+            self.end_headers()
+            if body:
+                self.wfile.write('stub failure')
+            return
+
+        url = urlparse(self.path)
+        if url.path.startswith('/ows/'):
+            params = dict((k.lower(), v[0]) for k, v in parse_qs(url.query).items())
+            service_url = 'http://{}:{}{}'.format(stub.host, stub.port, url.path)
+            layers = ['layer_{}'.format(i) for i in range(LAYERS_PER_ENDPOINT)]
+            if params.get('service', '').lower() == 'wfs':
+                data = WFS_CAPABILITIES.format(url=service_url,
+                                               layers='\n'.join(WFS_LAYER.format(name=l) for l in layers))
+            else:
+                data = WMS_CAPABILITIES.format(url=service_url,
+                                               layers='\n'.join(WMS_LAYER.format(name=l) for l in layers))
+            content_type = 'application/xml'
+        else:
+            data = 'x' * 4096
+            content_type = 'application/octet-stream'
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if body:
+            self.wfile.write(data)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class StubServer(object):
+    """
+    Local http server serving resource files and WMS/WFS capabilities.
+
+    Each response is delayed by `latency` seconds, and `failure_rate` part
+    of responses (chosen randomly, with `seed`) is 500 error.
+    """
+
+    def __init__(self, latency=0, failure_rate=0, seed=0, host='127.0.0.1'):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.host = host
+        self.port = None
+        self.requests = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(self.host, self.port)
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def should_fail(self):
+        with self._lock:
+            return self._random.random() < self.failure_rate
+
+    def start(self):
+        handler = type('StubHandler', (_StubHandler,), {'stub': self})
+        self._server = _ThreadingHTTPServer((self.host, 0), handler)
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def create_catalog(size, base_url, seed=0):
+    """
+    Create synthetic catalog with `size` resources, with resource urls
+    pointing to stub server at `base_url`. Returns number of
+    organizations and datasets created.
+    """
+    rnd = random.Random(seed)
+    conn = model.Session.connection()
+    now = datetime.now()
+
+    orgs_count = max(size // RESOURCES_PER_ORG, 2)
+    org_ids = [unicode(uuid.uuid4()) for i in range(orgs_count)]
+    conn.execute(model.group_table.insert(),
+                 [{'id': org_id,
+                   'name': u'{}org-{}'.format(NAME_PREFIX, idx),
+                   'title': u'Benchmark organization {}'.format(idx),
+                   'type': u'organization',
+                   'is_organization': True,
+                   'state': u'active',
+                   'approval_status': u'approved',
+                   'created': now} for idx, org_id in enumerate(org_ids)])
+
+    datasets = 0
+    packages = []
+    resources = []
+
+    def flush():
+        if packages:
+            conn.execute(model.package_table.insert(), packages)
+        if resources:
+            conn.execute(model.resource_table.insert(), resources)
+        del packages[:]
+        del resources[:]
+
+    for idx in range(0, size, RESOURCES_PER_DATASET):
+        pkg_id = unicode(uuid.uuid4())
+        packages.append({'id': pkg_id,
+                         'name': u'{}dataset-{}'.format(NAME_PREFIX, idx),
+                         'title': u'Benchmark dataset {}'.format(idx),
+                         'type': u'dataset',
+                         'state': u'active',
+                         'private': rnd.random() < 0.1,
+                         'license_id': rnd.choice(LICENSES),
+                         'owner_org': rnd.choice(org_ids),
+                         'metadata_created': now,
+                         'metadata_modified': now})
+        datasets += 1
+        for position in range(min(RESOURCES_PER_DATASET, size - idx)):
+            res_format = rnd.choice(FORMATS)
+            file_idx = (idx + position) // DUPLICATE_URLS
+            if res_format in ('WMS', 'WFS',):
+                endpoint = file_idx // LAYERS_PER_ENDPOINT
+                param = 'layers' if res_format == 'WMS' else 'typename'
+                url = u'{}/ows/{}?service={}&{}=layer_{}'.format(base_url, endpoint, res_format,
+                                                                 param, file_idx % LAYERS_PER_ENDPOINT)
+            else:
+                url = u'{}/files/{}'.format(base_url, file_idx)
+            resources.append({'id': unicode(uuid.uuid4()),
+                              'package_id': pkg_id,
+                              'url': url,
+                              'format': res_format,
+                              'name': u'resource {}'.format(position),
+                              'position': position,
+                              'state': u'active',
+                              'created': now})
+        if len(resources) >= 5000:
+            flush()
+    flush()
+    model.Session.commit()
+    return orgs_count, datasets
+
+
+def drop_catalog():
+    """
+    Remove synthetic catalog created by `create_catalog`, with check
+    runs of its organizations and their cached reports
+    """
+    from ckanext.report.model import DataCache
+    from ckanext.gsreport import model as gsreport_model
+
+    s = model.Session
+    run = gsreport_model.check_run_table.c
+    run_ids = select([run.id]).where(run.organization.like(u'{}%'.format(NAME_PREFIX)))
+    pkg_ids = s.query(model.Package.id)\
+               .filter(model.Package.name.like(u'{}%'.format(NAME_PREFIX)))\
+               .subquery()
+    res_ids = s.query(model.Resource.id)\
+               .filter(model.Resource.package_id.in_(pkg_ids))\
+               .subquery()
+    conn = s.connection()
+    for table in (gsreport_model.host_stats_table,
+                  gsreport_model.report_page_table,
+                  gsreport_model.run_coverage_table,
+                  gsreport_model.check_result_table,
+                  gsreport_model.check_queue_table,):
+        conn.execute(table.delete().where(table.c.run_id.in_(run_ids)))
+    conn.execute(gsreport_model.check_run_table.delete().where(run.id.in_(run_ids)))
+    conn.execute(gsreport_model.check_state_table.delete()
+                 .where(gsreport_model.check_state_table.c.resource_id.in_(res_ids)))
+    conn.execute(gsreport_model.check_result_table.delete()
+                 .where(gsreport_model.check_result_table.c.resource_id.in_(res_ids)))
+    conn.execute(gsreport_model.package_counts_table.delete()
+                 .where(gsreport_model.package_counts_table.c.package_id.in_(pkg_ids)))
+    conn.execute(model.resource_table.delete()
+                 .where(model.resource_table.c.package_id.in_(pkg_ids)))
+    conn.execute(model.package_table.delete()
+                 .where(model.package_table.c.name.like(u'{}%'.format(NAME_PREFIX))))
+    conn.execute(model.group_table.delete()
+                 .where(model.group_table.c.name.like(u'{}%'.format(NAME_PREFIX))))
+    # report cache keys contain organization option
+    s.query(DataCache)\
+     .filter(DataCache.object_id.in_(REPORT_NAMES))\
+     .filter(DataCache.key.like(u'%{}%'.format(NAME_PREFIX)))\
+     .delete(synchronize_session=False)
+    s.commit()
+
+
+class QueryCounter(object):
+    """
+    Counts queries executed with engine
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def _on_execute(self, *args, **kwargs):
+        self.count += 1
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._on_execute)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self._on_execute)
+
+
+def get_peak_rss():
+    """
+    Return peak resident memory of current process, in kilobytes
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def is_synthetic(option_dict):
+    """
+    Return True if report options select organization of synthetic catalog
+    """
+    org = option_dict.get('org') or option_dict.get('organization')
+    return bool(org) and org.startswith(NAME_PREFIX)
+
+
+def run_report(name, stub):
+    """
+    Generate report for option combinations of synthetic organizations,
+    and return measurements. Combinations are iterated all, as reports
+    prepare data for them when iteration starts, but cache of other
+    organizations (and of whole site) is not refreshed.
+    """
+    from ckanext.report.report_registry import ReportRegistry
+
+    report = ReportRegistry.instance().get_report(name)
+    requests_before = stub.requests
+    peak_before = get_peak_rss()
+    combinations = 0
+    with QueryCounter(model.meta.engine) as queries:
+        start = time.time()
+        for option_dict in report.get_option_combinations():
+            if not is_synthetic(option_dict):
+                continue
+            report.refresh_cache(option_dict)
+            combinations += 1
+        wall_time = time.time() - start
+    peak_after = get_peak_rss()
+    return {'wall_time': wall_time,
+            'combinations': combinations,
+            'queries': queries.count,
+            'requests': stub.requests - requests_before,
+            'peak_rss_kb': peak_after,
+            'peak_rss_growth_kb': peak_after - peak_before}
+
+
+def run_benchmark(sizes=DEFAULT_SIZES, latency=0, failure_rate=0, seed=0, reports=REPORT_NAMES):
+    """
+    Run benchmark for each catalog size, and return list of results,
+    which can be serialized to json.
+
+    :param sizes: list of catalog sizes (number of resources)
+    :param latency: stub server response latency, in seconds
+    :param failure_rate: part of stub server responses which fail (0..1)
+    :param seed: random seed for catalog and failures
+    :param reports: names of reports to run
+    """
+    from ckanext.gsreport.model import init_tables
+
+    init_tables()
+    out = []
+    for size in sizes:
+        stub = StubServer(latency=latency, failure_rate=failure_rate, seed=seed).start()
+        try:
+            drop_catalog()
+            orgs, datasets = create_catalog(size, stub.url, seed=seed)
+            result = {'size': size,
+                      'organizations': orgs,
+                      'datasets': datasets,
+                      'latency': latency,
+                      'failure_rate': failure_rate,
+                      'seed': seed,
+                      'host': socket.gethostname(),
+                      'started_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                      'reports': {}}
+            for name in reports:
+                log.info('running %s report for %s resources', name, size)
+                result['reports'][name] = run_report(name, stub)
+            out.append(result)
+        finally:
+            stub.stop()
+            model.Session.rollback()
+            drop_catalog()
+    return out
+
+
+def dump_results(results, fileobj):
+    json.dump(results, fileobj, indent=2, sort_keys=True)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+In-memory caches shared by checks and report helpers.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Thread-safe cache with least recently used eviction, bounded
+    by number of entries.
+
+    Value for a key is created once, even if requested concurrently
+    from many threads. With `ttl` (in seconds), values stored earlier
+    than `ttl` seconds ago are treated as missing.
+    """
+
+    def __init__(self, size, ttl=None):
+        self.size = max(size, 1)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        # key -> (value, time when it was stored)
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def _get(self, key):
+        # must be called with self._lock acquired
+        value, stored_at = self._data.pop(key)
+        if self.ttl and time.time() - stored_at >= self.ttl:
+            raise KeyError(key)
+        self._data[key] = (value, stored_at,)
+        return value
+
+    def get_or_create(self, key, factory):
+        """
+        Return value for key, call `factory()` to create it if missing
+        """
+        with self._lock:
+            try:
+                return self._get(key)
+            except KeyError:
+                key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self._lock:
+                try:
+                    return self._get(key)
+                except KeyError:
+                    pass
+            value = factory()
+            with self._lock:
+                self._set(key, value)
+                self._key_locks.pop(key, None)
+            return value
+
+    def _set(self, key, value):
+        # must be called with self._lock acquired
+        self._data.pop(key, None)
+        self._data[key] = (value, time.time(),)
+        while len(self._data) > self.size:
+            self._data.popitem(last=False)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                return self._get(key)
+            except KeyError:
+                return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._set(key, value)
+
+    def pop(self, key):
+        """
+        Remove key from cache (invalidate it)
+        """
+        with self._lock:
+            value, stored_at = self._data.pop(key, (None, None,))
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._key_locks.clear()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Streaming validation of OWS capabilities documents.
+
+Document is parsed incrementally, and reading stops as soon as verdict
+is known (root element, version and service identification were read,
+and optionally requested layers were found), so large capabilities
+documents don't have to be downloaded and parsed whole.
+"""
+
+try:
+    import xml.etree.cElementTree as etree
+except ImportError:
+    import xml.etree.ElementTree as etree
+
+# root elements of capabilities documents for service type
+CAPABILITIES_ROOTS = {'wms': ('WMS_Capabilities', 'WMT_MS_Capabilities',),
+                      'wfs': ('WFS_Capabilities',),
+                      }
+
+EXCEPTION_ROOTS = ('ServiceExceptionReport', 'ExceptionReport',)
+EXCEPTION_ELEMENTS = ('ServiceException', 'ExceptionText',)
+
+# service identification elements (1.x, OWS common)
+SERVICE_ELEMENTS = ('Service', 'ServiceIdentification',)
+
+# elements which contain layer/feature type name
+LAYER_ELEMENTS = {'wms': 'Layer',
+                  'wfs': 'FeatureType',
+                  }
+
+
+class ChunkReader(object):
+    """
+    File-like object reading from iterable of byte chunks, which
+    returns end of file after `max_bytes` were read (0 means no limit).
+    """
+
+    def __init__(self, chunks, max_bytes=0):
+        self.max_bytes = max_bytes
+        self.read_bytes = 0
+        self.capped = False
+        self._chunks = iter(chunks)
+        self._buf = ''
+
+    def _fill(self, size):
+        while (size < 0 or len(self._buf) < size) and not self.capped:
+            try:
+                chunk = next(self._chunks)
+            except StopIteration:
+                break
+            if self.max_bytes and self.read_bytes + len(chunk) >= self.max_bytes:
+                chunk = chunk[:self.max_bytes - self.read_bytes]
+                self.capped = True
+            self.read_bytes += len(chunk)
+            self._buf += chunk
+
+    def read(self, size=-1):
+        self._fill(size)
+        if size < 0:
+            out, self._buf = self._buf, ''
+        else:
+            out, self._buf = self._buf[:size], self._buf[size:]
+        return out
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def _layer_local_name(name):
+    # layer name without namespace prefix
+    return name.split(':')[-1]
+
+
+def _verdict(status, msg=None, version=None, **kwargs):
+    out = {'status': status, 'msg': msg, 'version': version}
+    out.update(kwargs)
+    return out
+
+
+def parse_capabilities(chunks, service, layers=None, max_bytes=0, collect_layers=False):
+    """
+    Validate capabilities document read from iterable of byte chunks.
+
+    Returns verdict dict, as `ckanext.gsreport.checkers.evaluate_ows`
+    does, with status:
+     * ok - document is valid capabilities document for service
+     * service-error - service returned exception report
+     * contents-error - document is not valid capabilities document
+     * too-large - verdict was not reached in `max_bytes`
+     * truncated - service identification was read, but `max_bytes`
+       was reached before requested layers were found (or before end
+       of document, with `collect_layers`)
+
+    If `layers` (list of layer or feature type names) is provided, verdict
+    also contains `missing_layers` with names which were not found, and
+    document is read until all of them are found. Names are matched
+    without namespace prefix.
+
+    If `collect_layers` is set, whole document (up to `max_bytes`) is read,
+    and verdict contains `layers` with set of all layer or feature type
+    names.
+
+    :param chunks: iterable with parts of document
+    :param service: service type (wms, wfs)
+    :param layers: optional list of names to look for
+    :param max_bytes: max number of bytes read (0 means no limit)
+    :param collect_layers: collect names of all layers
+    """
+    reader = ChunkReader(chunks, max_bytes)
+    layers = set(layers or ())
+    # local name -> requested names which were not found yet
+    missing = {}
+    for layer_name in layers:
+        missing.setdefault(_layer_local_name(layer_name), set()).add(layer_name)
+    layer_element = LAYER_ELEMENTS.get(service)
+    names = set() if collect_layers else None
+    extra = {}
+    roots = CAPABILITIES_ROOTS.get(service, ())
+
+    version = None
+    service_found = False
+    exception = None
+    stack = []
+    try:
+        for event, elem in etree.iterparse(reader, events=('start', 'end',)):
+            name = _local_name(elem.tag)
+            if event == 'start':
+                if not stack:
+                    version = elem.get('version')
+                    if name not in roots and name not in EXCEPTION_ROOTS:
+                        return _verdict('contents-error',
+                                        'Unexpected root element {}, not a {} capabilities document'
+                                        .format(name, service.upper()))
+                    if name in EXCEPTION_ROOTS:
+                        exception = []
+                stack.append(name)
+                continue
+
+            stack.pop()
+            if exception is not None:
+                if name in EXCEPTION_ELEMENTS and elem.text:
+                    exception.append(elem.text.strip())
+            elif name in SERVICE_ELEMENTS and len(stack) == 1:
+                service_found = True
+            elif name == 'Name' and stack and stack[-1] == layer_element:
+                layer_name = (elem.text or '').strip()
+                missing.pop(_layer_local_name(layer_name), None)
+                if names is not None:
+                    names.add(layer_name)
+
+            if service_found and not missing and names is None:
+                return _verdict('ok', version=version,
+                                **({'missing_layers': []} if layers else {}))
+            # element is closed and was read, free its contents
+            # to keep memory bounded
+            elem.clear()
+    except SyntaxError, err:
+        # ParseError is a subclass of SyntaxError
+        if not reader.capped:
+            return _verdict('contents-error', 'Invalid capabilities document: {}'.format(err))
+
+    if exception is not None:
+        return _verdict('service-error', '\n'.join(exception) or 'Service exception', version)
+    if reader.capped:
+        if service_found:
+            return _verdict('truncated',
+                            'Layers were not found in first {} bytes of capabilities document'
+                            .format(max_bytes), version)
+        return _verdict('too-large',
+                        'No service identification in first {} bytes of capabilities document'
+                        .format(max_bytes), version)
+    if not service_found:
+        return _verdict('contents-error', 'No service identification in capabilities document', version)
+    if collect_layers:
+        extra['layers'] = names
+    if layers:
+        extra['missing_layers'] = sorted(n for group in missing.values() for n in group)
+    return _verdict('ok', version=version, **extra)
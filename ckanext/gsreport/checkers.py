@@ -1,22 +1,156 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import errno
 import logging
-from datetime import datetime
+import math
+import os
+import signal
+import threading
+import time
+from datetime import datetime, timedelta
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import urllib2
-from urllib import urlopen, urlencode
+from urllib import urlencode
 from urlparse import urlparse, urlunparse, parse_qs
 from functools import partial
+from collections import OrderedDict
+import requests
+from requests.adapters import HTTPAdapter
 import owslib.wms, owslib.wfs, owslib.csw, owslib.wmts
+from owslib.util import ServiceException
 from jinja2.utils import escape
 from ckan.lib.base import config
 from ckan.plugins import toolkit as t
 
+from ckanext.gsreport.cache import LRUCache
+from ckanext.gsreport.capabilities import parse_capabilities, CAPABILITIES_ROOTS
+
 
 log = logging.getLogger(__name__)
 
 SITE_URL = config['ckan.site_url']
 
+# uploaded files and local paths are checked with stat in ckan's
+# storage path, instead of http request to this site
+CHECK_LOCAL_FILES_CONFIG = 'ckanext.gsreport.checks.local_files'
+CHECK_LOCAL_FILES = t.asbool(config.get(CHECK_LOCAL_FILES_CONFIG, True))
+STORAGE_PATH = config.get('ckan.storage_path')
+
+# concurrent checks: size of worker pool (1 means checks are run serially)
+# and number of checks allowed to run against one host at the same time
+DEFAULT_CHECK_WORKERS = 1
+CHECK_WORKERS_CONFIG = 'ckanext.gsreport.checks.workers'
+CHECK_WORKERS = t.asint(config.get(CHECK_WORKERS_CONFIG,
+                                   DEFAULT_CHECK_WORKERS))
+
+DEFAULT_CHECK_PER_HOST = 2
+CHECK_PER_HOST_CONFIG = 'ckanext.gsreport.checks.per_host'
+CHECK_PER_HOST = t.asint(config.get(CHECK_PER_HOST_CONFIG,
+                                    DEFAULT_CHECK_PER_HOST))
+
+# how many resources are prepared and sent to worker pool at once
+CHECK_BATCH_FACTOR = 20
+
+# max number of distinct check verdicts kept in memory during run
+# for resources sharing the same url. Resources are checked in url order,
+# so duplicates are usually close to each other
+VERDICTS_LIMIT = 10000
+
+# circuit breaker: after this number of consecutive connection errors
+# for a host (0 disables breaker), remaining resources on that host
+# are not checked for `cooldown` seconds, and get inferred connection error
+DEFAULT_BREAKER_THRESHOLD = 5
+BREAKER_THRESHOLD_CONFIG = 'ckanext.gsreport.checks.breaker_threshold'
+BREAKER_THRESHOLD = t.asint(config.get(BREAKER_THRESHOLD_CONFIG,
+                                       DEFAULT_BREAKER_THRESHOLD))
+
+DEFAULT_BREAKER_COOLDOWN = 300
+BREAKER_COOLDOWN_CONFIG = 'ckanext.gsreport.checks.breaker_cooldown'
+BREAKER_COOLDOWN = t.asint(config.get(BREAKER_COOLDOWN_CONFIG,
+                                      DEFAULT_BREAKER_COOLDOWN))
+
+# incremental checks: previous check state is stored per resource,
+# and is used to send conditional requests or to skip check entirely
+# if resource was checked less than `fresh_for` seconds ago
+CHECK_INCREMENTAL_CONFIG = 'ckanext.gsreport.checks.incremental'
+CHECK_INCREMENTAL = t.asbool(config.get(CHECK_INCREMENTAL_CONFIG, False))
+
+DEFAULT_CHECK_FRESH_FOR = 0
+CHECK_FRESH_FOR_CONFIG = 'ckanext.gsreport.checks.fresh_for'
+CHECK_FRESH_FOR = t.asint(config.get(CHECK_FRESH_FOR_CONFIG,
+                                     DEFAULT_CHECK_FRESH_FOR))
+
+# http checks: timeouts (in seconds) for connecting to server
+# and for waiting for response data
+DEFAULT_CONNECT_TIMEOUT = 10
+CONNECT_TIMEOUT_CONFIG = 'ckanext.gsreport.checks.connect_timeout'
+CONNECT_TIMEOUT = float(config.get(CONNECT_TIMEOUT_CONFIG,
+                                   DEFAULT_CONNECT_TIMEOUT))
+
+DEFAULT_READ_TIMEOUT = 30
+READ_TIMEOUT_CONFIG = 'ckanext.gsreport.checks.read_timeout'
+READ_TIMEOUT = float(config.get(READ_TIMEOUT_CONFIG,
+                                DEFAULT_READ_TIMEOUT))
+
+# shared http transport: number of hosts for which connections are kept,
+# number of connections kept per host, and time (in seconds) after which
+# connections to host which was not used are closed
+DEFAULT_HTTP_POOL_HOSTS = 20
+HTTP_POOL_HOSTS_CONFIG = 'ckanext.gsreport.http.pool_hosts'
+HTTP_POOL_HOSTS = t.asint(config.get(HTTP_POOL_HOSTS_CONFIG,
+                                     DEFAULT_HTTP_POOL_HOSTS))
+
+DEFAULT_HTTP_POOL_SIZE = 4
+HTTP_POOL_SIZE_CONFIG = 'ckanext.gsreport.http.pool_size'
+HTTP_POOL_SIZE = t.asint(config.get(HTTP_POOL_SIZE_CONFIG,
+                                    DEFAULT_HTTP_POOL_SIZE))
+
+DEFAULT_HTTP_IDLE_TIMEOUT = 60
+HTTP_IDLE_TIMEOUT_CONFIG = 'ckanext.gsreport.http.idle_timeout'
+HTTP_IDLE_TIMEOUT = t.asint(config.get(HTTP_IDLE_TIMEOUT_CONFIG,
+                                       DEFAULT_HTTP_IDLE_TIMEOUT))
+
+# response codes for successful http check (206 is response to ranged GET)
+HTTP_OK_CODES = (200, 206,)
+
+# max number of bytes of response body read after check, so connection
+# can be reused; responses with larger remaining body are closed
+HTTP_DRAIN_BYTES = 64 * 1024
+
+# max number of OWS clients (parsed capabilities) kept in memory during run
+DEFAULT_OWS_CACHE_SIZE = 50
+OWS_CACHE_SIZE_CONFIG = 'ckanext.gsreport.ows.cache_size'
+OWS_CACHE_SIZE = t.asint(config.get(OWS_CACHE_SIZE_CONFIG,
+                                    DEFAULT_OWS_CACHE_SIZE))
+
+# number of processes parsing OWS capabilities, 0 to parse in checking thread
+DEFAULT_OWS_PROCESSES = 0
+OWS_PROCESSES_CONFIG = 'ckanext.gsreport.ows.processes'
+OWS_PROCESSES = t.asint(config.get(OWS_PROCESSES_CONFIG,
+                                   DEFAULT_OWS_PROCESSES))
+
+# max seconds for fetching and parsing capabilities in process pool
+DEFAULT_OWS_TIMEOUT = 120
+OWS_TIMEOUT_CONFIG = 'ckanext.gsreport.ows.timeout'
+OWS_TIMEOUT = t.asint(config.get(OWS_TIMEOUT_CONFIG,
+                                 DEFAULT_OWS_TIMEOUT))
+
+# validate WMS/WFS capabilities with streaming parser instead of owslib
+OWS_STREAMING_CONFIG = 'ckanext.gsreport.ows.streaming'
+OWS_STREAMING = t.asbool(config.get(OWS_STREAMING_CONFIG, False))
+
+# check if layers/feature types requested in resource url exist in capabilities
+OWS_CHECK_LAYERS_CONFIG = 'ckanext.gsreport.ows.check_layers'
+OWS_CHECK_LAYERS = t.asbool(config.get(OWS_CHECK_LAYERS_CONFIG, True))
+
+# max number of capabilities bytes read by streaming parser, 0 means no limit
+DEFAULT_OWS_MAX_BYTES = 10 * 1024 * 1024
+OWS_MAX_BYTES_CONFIG = 'ckanext.gsreport.ows.max_bytes'
+OWS_MAX_BYTES = t.asint(config.get(OWS_MAX_BYTES_CONFIG,
+                                   DEFAULT_OWS_MAX_BYTES))
+
 
 def headers_to_str(headers):
     """
@@ -49,6 +183,7 @@ def check_url(res):
         * code - http response code
         * url - used url
         * resource_url - url in resource (may be different from url)
+        * resource_id - id of resource
         * resource_name - name of resource
         * resource_format - format of resource (CSV, XML, WMS, WFS..)
         * dataset_title - title of related dataset
@@ -61,6 +196,13 @@ def check_url(res):
         * msg_rendered - message with context
         * msg - error message (may be exception or richer description template)
         * error - error name
+        * inferred - True if check was not performed, and result was
+          inferred from previous connection errors to the same host
+        * timing - dict with check timing (see `CheckTimer`)
+        * local_path - path of resource file in storage, if it was checked
+          with stat instead of http request (see `get_local_path`)
+        * resource_size - size of resource, compared with size of file
+          checked in storage
    
     Error names describes type of error:
      * connection-error - client couldn't connect to server (dns/network problem)
@@ -68,45 +210,877 @@ def check_url(res):
      * response-error - response was not correct (for example no xml when xml was expected)
      * not-valid-ows - OWS response was expected, but that failed
      * not-valid-ows-good-http - OWS response was expected, but that failed, regular http response was correct
+     * missing-layer - OWS service works, but layer or feature type from url is not published by it
+     * size-mismatch - file in storage has different size than the one recorded in resource
     
+    """
+    out = prepare_check(res)
+    resp = timed_check(res, out)
+    if resp and resp.get('error'):
+        out.update(resp)
+        return out
+
+
+def prepare_check(res):
+    """
+    Build base result dict for resource check (see `check_url` for keys).
+
+    This reads resource and dataset attributes, so it should be called
+    in thread which owns db session.
     """
     log.debug('checking [%s] resource: %s from %s [%s dataset]', res.format, res.url, res.name, res.package.title)
-    res_url = res.url
+    res_url = get_check_url(res.url)
 
+    return {'code': None,
+            'url': res_url,
+            'resource_url': res.url,
+            'resource_id': res.id,
+            'resource_name': res.name,
+            'resource_format': res.format,
+            'dataset_title': res.package.title,
+            'dataset_id': res.package_id,
+            'dataset_url': '{}/dataset/{}'.format(SITE_URL, res.package.name),
+            'organization_id': res.package.owner_org,
+            'checked_at': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            'headers': {},
+            'data': None,
+            'msg': None,
+            'error': None,
+            'resource_size': res.size,
+            'local_path': get_local_path(res)}
+
+
+def get_check_url(url):
+    """
+    Return url which is checked for resource url
+    """
     # not real url, just a file name or path.
-    if not res_url.startswith(('http://', 'https://')):
-        res_url = '{}/{}'.format(SITE_URL, res_url.lstrip('/'))
-        log.debug('rewriting url from %s to %s', res.url, res_url)
+    if not url.startswith(('http://', 'https://')):
+        check_url = '{}/{}'.format(SITE_URL, url.lstrip('/'))
+        log.debug('rewriting url from %s to %s', url, check_url)
+        return check_url
+    return url
 
-    res_format = res.format
 
-    out = {'code': None,
-           'url': res_url,
-           'resource_url': res.url,
-           'resource_name': res.name,
-           'resource_format': res.format,
-           'dataset_title': res.package.title,
-           'dataset_id': res.package_id,
-           'dataset_url': '{}/dataset/{}'.format(SITE_URL, res.package.name),
-           'organization_id': res.package.owner_org,
-           'checked_at': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-           'headers': {},
-           'data': None,
-           'msg': None,
-           'error': None}
+def get_upload_path(resource_id):
+    """
+    Return path of uploaded resource file, with the same layout
+    as `ckan.lib.uploader.ResourceUpload`
+    """
+    return os.path.join(os.path.abspath(STORAGE_PATH), 'resources',
+                        resource_id[0:3], resource_id[3:6], resource_id[6:])
+
+
+def get_local_path(res):
+    """
+    Return path of resource's file in storage path, or None, if resource
+    is not stored locally (and should be checked with http).
+
+    Uploaded resources and resource urls, which are not http urls
+    (`file://` urls or just a path), are local if their file exists
+    in storage path. Uploads missing there may be stored elsewhere
+    (for example when storage is not mounted on this host), so they're
+    checked with http.
+    """
+    if not (CHECK_LOCAL_FILES and STORAGE_PATH):
+        return None
+    if res.url_type == 'upload':
+        path = get_upload_path(res.id)
+        return path if os.path.isfile(path) else None
+    url = res.url or ''
+    if url.startswith(('http://', 'https://')):
+        return None
+    storage = os.path.abspath(STORAGE_PATH)
+    if url.startswith('file://'):
+        path = os.path.abspath(url[len('file://'):])
+    else:
+        path = os.path.abspath(os.path.join(storage, url.lstrip('/')))
+    if not path.startswith(storage + os.sep) or not os.path.isfile(path):
+        return None
+    return path
+
+
+def check_file(path, size=None):
+    """
+    Check resource file in storage path with stat, without http request.
+
+    Missing file is reported as `bad-response-code` with 404 code,
+    and file which can't be read as `bad-response-code` with 500 code,
+    as they would be served by this site. If resource's `size` is set,
+    file of different size is reported as `size-mismatch`.
+    """
+    try:
+        st = os.stat(path)
+        if not os.access(path, os.R_OK):
+            raise OSError(errno.EACCES, os.strerror(errno.EACCES))
+    except OSError, err:
+        missing = err.errno in (errno.ENOENT, errno.ENOTDIR,)
+        log.warning('Cannot read %s from storage: %s', path, err)
+        return {'code': 404 if missing else 500,
+                'headers': None,
+                'msg': t._('File missing in storage: {1}') if missing else t._('Cannot read file from storage: {1}'),
+                'msg_raw': clean_for_markdown(path if missing else str(err)),
+                'error': t._('bad-response-code')}
+    timer = get_timer()
+    if timer is not None:
+        timer.ttfb = time.time() - timer.started
+    log.debug('%s found in storage, %s bytes', path, st.st_size)
+    if size is not None and st.st_size != size:
+        log.warning('%s has %s bytes in storage, resource size is %s', path, st.st_size, size)
+        return {'code': None,
+                'headers': None,
+                'msg': t._('File in storage has {1} bytes, resource size differs'),
+                'msg_raw': str(st.st_size),
+                'error': t._('size-mismatch')}
 
+
+def get_handler(res_format):
+    """
+    Return check handler for resource format
+    """
     # find handler or use default
     try:
-        handler = check_handlers[res_format.lower()]
+        return check_handlers[(res_format or '').lower()]
     except KeyError:
-        handler = check_http
+        return check_http
 
-    resp = handler(res, res_url)
-    if resp:
-        out.update(resp)
+
+def run_check(res, out, validators=None):
+    """
+    Run check handler for prepared result dict.
+
+    Handler is selected from resource format in `out`. Returns
+    handler's response, which is error dict if check failed.
+
+    `validators` (etag/last_modified from previous check) are used
+    only by plain http check.
+    """
+    handler = get_handler(out['resource_format'])
+    timer = get_timer()
+    if handler is check_http and out.get('local_path'):
+        if timer is not None:
+            timer.handler = get_handler_name(check_file)
+        return check_file(out['local_path'], out.get('resource_size'))
+    if timer is not None:
+        timer.handler = get_handler_name(handler)
+    if validators is not None and handler is check_http:
+        return handler(res, out['url'], validators=validators)
+    return handler(res, out['url'])
+
+
+def get_handler_name(handler):
+    """
+    Return name of check handler function
+    """
+    return getattr(handler, '__name__', None) or handler.func.__name__
+
+
+# timer of check running in current thread
+_timing = threading.local()
+
+
+class CheckTimer(object):
+    """
+    Collects timing of one check:
+     * ttfb - time to first byte of first response, in seconds
+     * duration - total duration of check, in seconds
+     * bytes - number of response body bytes read
+     * handler - name of check handler (check_http, check_ows)
+     * version - OWS version negotiated with service
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.ttfb = None
+        self.duration = None
+        self.bytes = 0
+        self.handler = None
+        self.version = None
+
+    def response(self, sent_at, elapsed, nbytes):
+        """
+        Record response to request sent at `sent_at`, which took
+        `elapsed` seconds to receive headers, with `nbytes` of body read
+        """
+        if self.ttfb is None:
+            self.ttfb = sent_at - self.started + elapsed
+        self.bytes += nbytes
+
+    def finish(self):
+        self.duration = time.time() - self.started
+
+    def as_dict(self):
+        return {'ttfb': self.ttfb,
+                'duration': self.duration,
+                'bytes': self.bytes,
+                'handler': self.handler,
+                'version': self.version}
+
+
+def get_timer():
+    """
+    Return timer of check running in current thread, or None
+    """
+    return getattr(_timing, 'timer', None)
+
+
+def _record_response(sent_at, resp, nbytes):
+    timer = get_timer()
+    if timer is not None:
+        timer.response(sent_at, resp.elapsed.total_seconds(), nbytes)
+
+
+def timed_check(res, out, validators=None):
+    """
+    Run check (see `run_check`) and return its response, with
+    `timing` dict from `CheckTimer` added, also for successful check.
+    """
+    timer = _timing.timer = CheckTimer()
+    try:
+        resp = run_check(res, out, validators)
+    finally:
+        _timing.timer = None
+    timer.finish()
+    resp = dict(resp or {})
+    resp['timing'] = timer.as_dict()
+    return resp
+
+
+def normalize_url(url):
+    """
+    Return normalized form of url, which can be used to detect
+    urls pointing to the same location.
+
+    Scheme and host are lowercased, default ports and fragment are removed.
+    """
+    url = urlparse(url.strip())
+    scheme = url.scheme.lower()
+    netloc = url.netloc.lower()
+    if (scheme == 'http' and netloc.endswith(':80')) or\
+       (scheme == 'https' and netloc.endswith(':443')):
+        netloc = netloc.rsplit(':', 1)[0]
+    return urlunparse((scheme, netloc, url.path or '/', url.params, url.query, '',))
+
+
+def get_check_key(out):
+    """
+    Return key identifying check for prepared result dict.
+
+    Resources with the same key will get the same check verdict, so
+    such check is performed once per run. Files checked in storage
+    (see `get_local_path`) don't share verdict with http checks of the same url,
+    nor with checks of resources with different size.
+    """
+    local_path = out.get('local_path')
+    return (normalize_url(out['url']), get_handler(out['resource_format']),
+            local_path, out.get('resource_size') if local_path else None,)
+
+
+def get_host(url):
+    """
+    Return host part of url, used to group checks per remote server
+    """
+    return urlparse(url).netloc.lower()
+
+
+class HostLimiter(object):
+    """
+    Limits number of concurrent checks performed against one host.
+    """
+
+    def __init__(self, limit):
+        self.limit = max(limit, 1)
+        self._lock = threading.Lock()
+        self._semaphores = {}
+
+    def get(self, url):
+        host = get_host(url)
+        with self._lock:
+            try:
+                return self._semaphores[host]
+            except KeyError:
+                sem = self._semaphores[host] = threading.BoundedSemaphore(self.limit)
+                return sem
+
+
+class HostBreaker(object):
+    """
+    Per-host circuit breaker.
+
+    After `threshold` consecutive connection errors for a host, breaker
+    for that host is open: checks are not performed, and last connection
+    error is returned as inferred result. After `cooldown` seconds one
+    check is allowed (half-open state): if it succeeds, breaker is closed,
+    otherwise it's open for next `cooldown` seconds.
+    """
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        # host -> dict with failures, opened_at, probing, error
+        self._hosts = {}
+
+    def before_check(self, host):
+        """
+        Return inferred result if host should not be checked, None otherwise
+        """
+        with self._lock:
+            h = self._hosts.get(host)
+            if h is None or h['opened_at'] is None:
+                return None
+            if not h['probing'] and time.time() - h['opened_at'] >= self.cooldown:
+                log.info('probing host %s after %s connection errors', host, h['failures'])
+                h['probing'] = True
+                return None
+            return self._inferred(h)
+
+    def after_check(self, host, resp):
+        """
+        Record check result for host
+        """
+        failed = bool(resp) and resp.get('error') == t._('connection-error')
+        with self._lock:
+            h = self._hosts.setdefault(host, {'failures': 0,
+                                              'opened_at': None,
+                                              'probing': False,
+                                              'error': None})
+            if not failed:
+                h.update({'failures': 0, 'opened_at': None, 'probing': False, 'error': None})
+                return
+            h['failures'] += 1
+            h['error'] = resp
+            if h['probing'] or h['failures'] >= self.threshold:
+                if h['opened_at'] is None:
+                    log.warning('host %s is not responding, %s consecutive '
+                                'connection errors', host, h['failures'])
+                h['opened_at'] = time.time()
+                h['probing'] = False
+
+    def _inferred(self, h):
+        out = dict(h['error'])
+        # no check was performed for this result
+        out.pop('timing', None)
+        out['inferred'] = True
+        out['msg_raw'] = h['error'].get('msg')
+        out['msg'] = t._("""**Note:** Resource was not checked, result was inferred """
+                         """from previous connection errors for this host.\n\n{1}""")
+        out['msg_rendered'] = out['msg'].format(out['error'], out['msg_raw'] or '')
         return out
 
 
+def get_percentile(values, pct):
+    """
+    Return `pct` percentile (nearest rank) from sorted list of values
+    """
+    if not values:
+        return None
+    idx = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[min(max(idx, 0), len(values) - 1)]
+
+
+class HostStats(object):
+    """
+    Per-host aggregates of checks performed during run: number of checks,
+    errors, duration percentiles and bytes read.
+
+    Only performed checks are counted, not verdicts copied to
+    resources with the same url, or inferred results.
+    """
+
+    PERCENTILES = (50, 95, 99,)
+
+    def __init__(self):
+        # host -> dict with durations, ttfb, errors, bytes
+        self._hosts = {}
+
+    def __len__(self):
+        return len(self._hosts)
+
+    def add(self, url, resp):
+        """
+        Record check response (with `timing` key) for url
+        """
+        timing = resp.get('timing')
+        if not timing or resp.get('inferred'):
+            return
+        h = self._hosts.setdefault(get_host(url), {'durations': [],
+                                                  'ttfb': [],
+                                                  'errors': 0,
+                                                  'bytes': 0})
+        h['durations'].append(timing['duration'])
+        if timing['ttfb'] is not None:
+            h['ttfb'].append(timing['ttfb'])
+        h['bytes'] += timing['bytes']
+        if resp.get('error'):
+            h['errors'] += 1
+
+    def summary(self):
+        """
+        Return list of per-host summary dicts, sorted by host
+        """
+        out = []
+        for host, h in sorted(self._hosts.items()):
+            durations = sorted(h['durations'])
+            ttfb = sorted(h['ttfb'])
+            row = {'host': host,
+                   'count': len(durations),
+                   'errors': h['errors'],
+                   'error_rate': float(h['errors']) / len(durations),
+                   'duration_sum': sum(durations),
+                   'ttfb_p50': get_percentile(ttfb, 50),
+                   'bytes': h['bytes']}
+            for pct in self.PERCENTILES:
+                row['p{}'.format(pct)] = get_percentile(durations, pct)
+            out.append(row)
+        return out
+
+
+class PoolingAdapter(HTTPAdapter):
+    """
+    Http adapter which keeps connections to each host alive, and closes
+    connections to hosts which were not used for `idle_timeout` seconds.
+    """
+
+    def __init__(self, idle_timeout, **kwargs):
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._last_used = {}
+        self._last_cleanup = time.time()
+        super(PoolingAdapter, self).__init__(**kwargs)
+
+    def get_connection(self, url, proxies=None):
+        pool = super(PoolingAdapter, self).get_connection(url, proxies)
+        now = time.time()
+        with self._lock:
+            self._last_used[pool] = now
+            if now - self._last_cleanup > min(self.idle_timeout, 10):
+                self._close_idle(now)
+        return pool
+
+    def _close_idle(self, now):
+        # must be called with self._lock acquired
+        self._last_cleanup = now
+        idle = set(pool for pool, used in self._last_used.items()
+                   if now - used > self.idle_timeout)
+        if not idle:
+            return
+        pools = self.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool in idle:
+                # removed pool is closed by pool manager
+                del pools[key]
+        for pool in idle:
+            self._last_used.pop(pool, None)
+
+    def close(self):
+        with self._lock:
+            self._last_used.clear()
+        super(PoolingAdapter, self).close()
+
+
+def create_session():
+    """
+    Return new http session with keep-alive connection pool for each host.
+    """
+    session = requests.Session()
+    adapter = PoolingAdapter(HTTP_IDLE_TIMEOUT,
+                             pool_connections=HTTP_POOL_HOSTS,
+                             pool_maxsize=max(HTTP_POOL_SIZE, CHECK_PER_HOST))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+# session for checks performed outside of `ResourceChecker`
+_session = None
+_session_lock = threading.Lock()
+
+# `ResourceChecker` which performs checks in current thread
+_checker_context = threading.local()
+
+
+def get_checker():
+    """
+    Return `ResourceChecker` which performs checks in current thread, if any
+    """
+    return getattr(_checker_context, 'checker', None)
+
+
+def get_session():
+    """
+    Return http session for checks in current thread: session of
+    current `ResourceChecker`, or session shared by checks performed
+    outside of checker.
+    """
+    global _session
+    checker = get_checker()
+    if checker is not None:
+        return checker.session
+    with _session_lock:
+        if _session is None:
+            _session = create_session()
+        return _session
+
+
+def close_session():
+    """
+    Close http session shared by checks performed outside of checker
+    """
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def _get_thread_context():
+    """
+    Return objects registered for current (main) thread, which are
+    needed by checks in worker threads (translator used by `t._`).
+    """
+    try:
+        import pylons
+        return pylons.translator._current_obj()
+    except (ImportError, TypeError, AttributeError):
+        return None
+
+
+def _init_worker_thread(translator, checker):
+    _checker_context.checker = checker
+    if translator is not None:
+        import pylons
+        pylons.translator._push_object(translator)
+
+
+def _run_item_check(limiter, breaker, item):
+    res, out, validators = item
+    if out.get('local_path'):
+        # local file checks don't load site, they're not limited
+        return timed_check(res, out, validators)
+    host = get_host(out['url'])
+    if breaker is not None:
+        inferred = breaker.before_check(host)
+        if inferred is not None:
+            return inferred
+    if limiter is None:
+        resp = timed_check(res, out, validators)
+    else:
+        with limiter.get(out['url']):
+            resp = timed_check(res, out, validators)
+    if breaker is not None:
+        breaker.after_check(host, resp)
+    return resp
+
+
+def interleave_hosts(items):
+    """
+    Return list of (key, (resource, result dict, validators)) items
+    ordered round-robin across hosts, so checks submitted to pool
+    don't wait for one host's limit while other hosts are idle.
+    Items of one host keep their order.
+    """
+    queues = OrderedDict()
+    for key, item in items:
+        queues.setdefault(get_host(item[1]['url']), []).append((key, item,))
+    out = []
+    queues = [iter(q) for q in queues.values()]
+    while queues:
+        active = []
+        for q in queues:
+            for item in q:
+                out.append(item)
+                active.append(q)
+                break
+        queues = active
+    return out
+
+
+def _check_batch(check_many, batch, verdicts, state=None, stats=None):
+    """
+    Check batch of (resource, result dict) items.
+
+    Each distinct check (see `get_check_key`) is performed once,
+    with verdicts stored in `verdicts` dict, and its result is applied
+    to all items sharing it. Inferred results (see `HostBreaker`) are
+    applied within batch only, so later batches check such urls when
+    host's breaker is closed again.
+
+    If check `state` store is provided, resources checked recently
+    get verdict from previous check, and others are checked with
+    validators from previous check. New state is saved for checked resources.
+
+    Timing of performed checks is added to `stats` (`HostStats`), if provided.
+
+    Checks are submitted interleaved by host (see `interleave_hosts`),
+    results are applied in batch order.
+    """
+    states = {}
+    if state is not None:
+        states = state.get_for_resources([out['resource_id'] for res, out in batch])
+    fresh_since = datetime.now() - timedelta(seconds=CHECK_FRESH_FOR)
+
+    keys = []
+    pending = OrderedDict()
+    for res, out in batch:
+        prev = states.get(out['resource_id'])
+        if prev is not None and prev.url != out['url']:
+            prev = None
+        if prev is not None and CHECK_FRESH_FOR and prev.checked_at >= fresh_since:
+            keys.append(None)
+            continue
+        key = get_check_key(out)
+        keys.append(key)
+        if key not in verdicts and key not in pending:
+            validators = prev.get_validators() if prev is not None else None
+            if state is not None and validators is None:
+                validators = {}
+            pending[key] = (res, out, validators,)
+
+    pending = interleave_hosts(pending.items())
+    responses = {}
+    for (key, item), resp in zip(pending, check_many([item for key, item in pending])):
+        responses[key] = resp
+        if not (resp and resp.get('inferred')):
+            verdicts[key] = resp
+        if stats is not None and resp:
+            stats.add(item[1]['url'], resp)
+
+    checked = []
+    for (res, out), key in zip(batch, keys):
+        if key is None:
+            prev = states[out['resource_id']]
+            out.update(prev.get_result())
+            out['checked_at'] = prev.checked_at.strftime("%Y-%m-%d %H:%M:%S")
+        else:
+            resp = responses[key] if key in responses else verdicts[key]
+            if resp:
+                out.update(resp)
+            if not out.get('inferred'):
+                checked.append(out)
+    if state is not None and checked:
+        state.update_from_results(checked)
+
+    while len(verdicts) > VERDICTS_LIMIT:
+        verdicts.popitem(last=False)
+
+    for res, out in batch:
+        yield out
+
+
+class ResourceChecker(object):
+    """
+    Checks resources (see `check_resources`), keeping worker pools,
+    http session, OWS caches and verdicts between calls of `check`,
+    until `close` is called. Params are the same as for `check_resources`.
+
+    Pools, session and caches belong to checker, so many checkers can
+    run at once. Checks find them with `get_checker`.
+
+    Can be used as context manager, which closes it on exit.
+    """
+
+    def __init__(self, workers=None, per_host=None, state=None, stats=None, versions=None):
+        workers = workers or CHECK_WORKERS
+        per_host = per_host or CHECK_PER_HOST
+        self.state = state
+        self.stats = stats
+        self.versions = versions
+        self.verdicts = OrderedDict()
+        breaker = None
+        if BREAKER_THRESHOLD > 0:
+            breaker = HostBreaker(BREAKER_THRESHOLD, BREAKER_COOLDOWN)
+        # OWS verdicts (see `evaluate_ows`) created in _check_ows
+        self.ows_cache = LRUCache(OWS_CACHE_SIZE)
+        # OWS versions which worked for endpoints
+        self.ows_versions = OwsVersions()
+        self.ows_versions.load(versions.load_all() if versions is not None else {})
+        # processes are forked before any thread is started
+        self.ows_pool = None
+        if OWS_PROCESSES > 0:
+            self.ows_pool = OwsProcessPool(OWS_PROCESSES)
+        self.session = create_session()
+
+        if workers < 2:
+            self._pool = None
+            self._check_many = partial(map, partial(_run_item_check, None, breaker))
+            self.batch_size = CHECK_BATCH_FACTOR
+        else:
+            self._pool = ThreadPool(workers,
+                                    initializer=_init_worker_thread,
+                                    initargs=(_get_thread_context(), self,))
+            self._check_many = partial(self._pool.imap,
+                                       partial(_run_item_check, HostLimiter(per_host), breaker))
+            self.batch_size = workers * CHECK_BATCH_FACTOR
+
+    def check(self, resources, deadline=None):
+        """
+        Check each resource from iterable and yield result dict for it,
+        see `check_resources`.
+        """
+        count = 0
+        batch = []
+        for res in resources:
+            batch.append((res, prepare_check(res),))
+            count += 1
+            if len(batch) >= self.batch_size:
+                for out in self._check_batch(batch):
+                    yield out
+                batch = []
+                # checked in batch boundary, so no resource is read and left unchecked
+                if deadline is not None and time.time() >= deadline:
+                    log.info('time budget exhausted after %s resources', count)
+                    break
+        if batch:
+            for out in self._check_batch(batch):
+                yield out
+        log.info('checked %s resources with %s distinct checks', count, len(self.verdicts))
+
+    def _check_batch(self, batch):
+        # serial checks run in calling thread, which may be used by other checkers
+        prev = get_checker()
+        _checker_context.checker = self
+        try:
+            outs = list(_check_batch(self._check_many, batch, self.verdicts, self.state, self.stats))
+        finally:
+            _checker_context.checker = prev
+        changes = self.ows_versions.pop_changes()
+        if self.versions is not None and changes:
+            self.versions.save(changes)
+        return outs
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+        if self.ows_pool is not None:
+            self.ows_pool.close()
+            self.ows_pool = None
+        self.ows_cache.clear()
+        self.ows_versions.clear()
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+def check_resources(resources, workers=None, per_host=None, state=None, stats=None, versions=None,
+                    deadline=None):
+    """
+    Check each resource from iterable and yield result dict for it.
+
+    Results are yielded in the same order as resources were provided,
+    for all resources. Successful check will have `error` key set to None,
+    otherwise result dict is the same as one returned by `check_url`.
+
+    Resources pointing to the same url (after normalization, see
+    `normalize_url`) and using the same check handler are checked once,
+    and the verdict is copied to result dict of each of them.
+
+    With more than one worker, checks are performed concurrently in a
+    thread pool, with at most `per_host` checks running against the same host.
+
+    Hosts which fail to connect repeatedly are not checked for some time
+    (see `HostBreaker`), their resources get inferred connection error.
+    Resources are read from iterable (and prepared) in calling thread,
+    worker threads don't touch db session.
+
+    :param resources: iterable with Resource instances
+    :param workers: size of worker pool, defaults to
+        `ckanext.gsreport.checks.workers` config value
+    :param per_host: max concurrent checks per host, defaults to
+        `ckanext.gsreport.checks.per_host` config value
+    :param state: check state store, like
+        `ckanext.gsreport.model.ResourceCheckState`, used for incremental checks
+    :param stats: `HostStats` instance, which will collect per-host
+        timing of performed checks
+    :param versions: OWS version store, like `ckanext.gsreport.model.OwsVersion`,
+        with versions which worked for OWS endpoints in previous runs
+    :param deadline: time (as `time.time()`) after which no more resources
+        are read from iterable (checked after each batch). Resources
+        already read are checked, no results are yielded for the rest.
+
+    Pools, http session and caches live only for the call, use
+    `ResourceChecker` to keep them for many calls.
+    """
+    checker = ResourceChecker(workers, per_host, state, stats, versions)
+    try:
+        for out in checker.check(resources, deadline):
+            yield out
+    finally:
+        checker.close()
+
+
+class OwsVersions(object):
+    """
+    Versions which worked for OWS endpoints. Version which worked is tried
+    first in next checks of the same endpoint, and it's dropped if it fails.
+
+    Changes are collected, so they can be saved by calling thread
+    (see `ckanext.gsreport.model.OwsVersion`).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions = {}
+        self._changes = {}
+
+    def load(self, versions):
+        with self._lock:
+            self._versions = dict(versions)
+            self._changes = {}
+
+    def clear(self):
+        self.load({})
+
+    def get(self, key):
+        return self._versions.get(key)
+
+    def order(self, key, defaults):
+        """
+        Return defaults (list of param dicts with version),
+        with version which worked for endpoint first
+        """
+        version = self.get(key)
+        if not version:
+            return defaults
+        return tuple([d for d in defaults if d.get('version') == version] +
+                     [d for d in defaults if d.get('version') != version])
+
+    def worked(self, key, version):
+        with self._lock:
+            if self._versions.get(key) != version:
+                self._versions[key] = version
+                self._changes[key] = version
+
+    def failed(self, key, version):
+        with self._lock:
+            if self._versions.get(key) == version:
+                del self._versions[key]
+                self._changes[key] = None
+
+    def pop_changes(self):
+        """
+        Return dict of endpoint key -> version (None for dropped versions)
+        changed since last call
+        """
+        with self._lock:
+            changes, self._changes = self._changes, {}
+            return changes
+
+
+def get_ows_version_key(format, endpoint):
+    """
+    Return key of OWS endpoint for version memory
+    """
+    return u'{}:{}'.format(format, normalize_url(endpoint))
+
+
 # to check ows service, we must know the type
 # from type, we'll get client class and list of
 # defaults to detect if ows supports any known version
@@ -115,7 +1089,7 @@ ows_clients = {'wms': (owslib.wms.WebMapService, (dict(version='1.1.1'),
                'wfs': (owslib.wfs.WebFeatureService, (dict(version='1.0'),
                                                       dict(version='1.1'),
                                                       dict(version='2.0'),)),
-               'csw': (owslib.csw.CatalogueServiceWeb, (dict(version=v) for v in ('2.0.0', '2.0.1', '2.0.2',)),)
+               'csw': (owslib.csw.CatalogueServiceWeb, tuple(dict(version=v) for v in ('2.0.0', '2.0.1', '2.0.2',)),)
                }
                             
 
@@ -128,6 +1102,9 @@ def check_ows(res, res_url, format):
     that may be an indication that url is not OWS.
     """
     out = _check_ows(res, res_url, format)
+    # service works, but doesn't publish layers or is too slow
+    if out and out.get('error') in (t._('missing-layer'), t._('timeout'),):
+        return out
     if out and out.get('error'):
         out_http = check_http(res, res_url, return_headers=True)
         # we have invalid ows and valid http check
@@ -175,48 +1152,63 @@ def _check_ows(res, res_url, format):
     in_params = parse_qs(url.query)
     normalized = dict((k.lower(), v) for k, v in in_params.items())
 
+    endpoint = urlunparse(url[:3] + ('', '', '',))
+    layers = get_requested_layers(normalized) if OWS_CHECK_LAYERS else []
+    checker = get_checker()
+    ows_versions = checker.ows_versions if checker is not None else None
+    version_key = None
     # if we have forced version in params, we'll use it instead of versions from defaults
     if 'version' in normalized:
         defaults = (in_params,)
-    
+    elif ows_versions is not None:
+        # version which worked for endpoint before is tried first
+        version_key = get_ows_version_key(format, endpoint)
+        defaults = ows_versions.order(version_key, defaults)
+
     for params in defaults:
         # replace query in url
         new_url = urlunparse(url[:4] + (urlencode(params, True),) + url[5:])
-        try:
-            client = client_cls(new_url)
+        verdict = _get_ows_verdict(format, client_cls, new_url, get_ows_cache_key(format, endpoint, params),
+                                   layers)
+        status = verdict['status']
         # bad version will cause Attr error
-        except AttributeError, err:
-            log.info("OWS service %s is not using %s params: %s", res_url, params, err)
+        if status == 'bad-version':
+            log.info("OWS service %s is not using %s params: %s", res_url, params, verdict['msg'])
+            if version_key is not None:
+                ows_versions.failed(version_key, params['version'])
             continue
-        except urllib2.URLError, err:
+        if status == 'connection-error':
             out['error'] = t._('connection-error')
-            out['msg'] = clean_for_markdown(str(err))
+            out['msg'] = clean_for_markdown(verdict['msg'])
             out['msg_rendered'] = out['msg']
             return out
-        
-        # fallback for general error
-        except Exception, err:
-            log.warning("OWS service %s causes client creation error: %s", res_url, err)
-            out['error'] = t._('response-error')
-            out['msg'] = clean_for_markdown(str(err))
+        if status == 'timeout':
+            log.warning("OWS service %s timed out: %s", res_url, verdict['msg'])
+            out['error'] = t._('timeout')
+            out['msg'] = clean_for_markdown(verdict['msg'])
             out['msg_rendered'] = out['msg']
             return out
-
-        try:
-            contents = client.contents
-        except ServiceException, err:
-            log.debug("OWS service %s is not using %s params", res_url, params)
-
+        if status != 'ok':
+            log.warning("OWS service %s causes %s: %s", res_url, status, verdict['msg'])
             out['error'] = t._('response-error')
-            out['msg'] = clean_for_markdown(str(err))
+            out['msg'] = clean_for_markdown(verdict['msg'])
             out['msg_rendered'] = out['msg']
             return out
-        # fallback for general error
-        except Exception, err:
-            log.warning("OWS service %s causes client contents error: %s", res_url, err)
-            out['error'] = t._('response-error')
-            out['msg'] = clean_for_markdown(str(err))
-            out['msg_rendered'] = out['msg']
+        if version_key is not None:
+            ows_versions.worked(version_key, params['version'])
+        timer = get_timer()
+        if timer is not None:
+            version = verdict['version'] or params.get('version')
+            timer.version = version[0] if isinstance(version, list) else version
+        # streaming parser looks only for requested layers
+        missing = verdict.get('missing_layers')
+        if missing is None:
+            missing = get_missing_layers(verdict.get('layers'), normalized)
+        if missing:
+            out['error'] = t._('missing-layer')
+            out['msg_raw'] = clean_for_markdown(', '.join(missing))
+            out['msg'] = t._("Layers not published by service: {1}")
+            out['msg_rendered'] = out['msg'].format(out['error'], out['msg_raw'])
             return out
         break
     else:
@@ -230,38 +1222,361 @@ def _check_ows(res, res_url, format):
         return out
     return out
 
-def check_http(res, res_url, return_headers=False):
+# request params which select layer/feature type, they don't change
+# capabilities document returned by endpoint
+OWS_LAYER_PARAMS = ('layers', 'layer', 'typename', 'typenames', 'styles',
+                    'bbox', 'srs', 'crs', 'width', 'height', 'format',)
+
+
+# request params which name layers/feature types
+OWS_NAME_PARAMS = ('layers', 'layer', 'typename', 'typenames',)
+
+
+def get_layer_index(names):
+    """
+    Return index of layer/feature type names: set with each name,
+    and its local part (without namespace prefix).
+    """
+    index = set()
+    for name in names:
+        index.add(name)
+        index.add(name.split(':')[-1])
+    return frozenset(index)
+
+
+def get_requested_layers(params):
+    """
+    Return list of layer names requested in params (dict of lowercased
+    param -> list of values)
+    """
+    names = []
+    for param in OWS_NAME_PARAMS:
+        for value in params.get(param) or ():
+            for name in value.split(','):
+                name = name.strip()
+                if name:
+                    names.append(name)
+    return names
+
+
+def get_missing_layers(index, params):
+    """
+    Return list of layer names requested in params (dict of lowercased
+    param -> list of values), which are not in layer index. If there's
+    no index, nothing is reported as missing.
+    """
+    if index is None or not OWS_CHECK_LAYERS:
+        return []
+    return [name for name in get_requested_layers(params)
+            if name not in index and name.split(':')[-1] not in index]
+
+
+def get_ows_cache_key(format, endpoint, params):
+    """
+    Return key for OWS client cache: service type, endpoint and
+    request params (including version), except layer-specific ones.
+    """
+    params = sorted((k.lower(), tuple(v) if isinstance(v, list) else v)
+                    for k, v in params.items()
+                    if k.lower() not in OWS_LAYER_PARAMS)
+    return (format, endpoint, tuple(params),)
+
+
+def evaluate_ows(client_cls, url):
+    """
+    Create OWS client for url and read its contents. Returns compact
+    verdict dict, with keys:
+     * status - ok, bad-version (client doesn't support requested version),
+       connection-error, client-error, service-error, contents-error,
+       too-large, truncated (streaming parser only) or timeout
+     * msg - error message
+     * version - version of service
+     * layers - index of layer/feature type names (see `get_layer_index`),
+       or None if it's not available
+    """
+    verdict = {'status': 'ok', 'msg': None, 'version': None, 'layers': None}
+    try:
+        client = client_cls(url)
+    except AttributeError, err:
+        verdict.update({'status': 'bad-version', 'msg': str(err)})
+        return verdict
+    except (urllib2.URLError, requests.ConnectionError, requests.Timeout,), err:
+        # owslib uses requests (routed through checks session), older versions urllib2
+        verdict.update({'status': 'connection-error', 'msg': str(err)})
+        return verdict
+    except Exception, err:
+        verdict.update({'status': 'client-error', 'msg': str(err)})
+        return verdict
+
+    try:
+        contents = client.contents
+    except ServiceException, err:
+        verdict.update({'status': 'service-error', 'msg': str(err)})
+        return verdict
+    except Exception, err:
+        verdict.update({'status': 'contents-error', 'msg': str(err)})
+        return verdict
+    verdict['version'] = getattr(client, 'version', None)
+    if OWS_CHECK_LAYERS and contents is not None:
+        verdict['layers'] = get_layer_index(contents.keys())
+    return verdict
+
+
+def evaluate_ows_stream(format, url, layers=None):
+    """
+    Fetch capabilities document from url and validate it with streaming
+    parser (see `ckanext.gsreport.capabilities.parse_capabilities`),
+    reading at most `ckanext.gsreport.ows.max_bytes`. Returns verdict
+    dict, as `evaluate_ows` does, with `missing_layers` instead of
+    layer index.
+
+    Document is read only until requested `layers` are found.
+    """
+    sent_at = time.time()
+    try:
+        resp = get_session().get(url,
+                                 timeout=(CONNECT_TIMEOUT, READ_TIMEOUT,),
+                                 stream=True)
+    except requests.RequestException, err:
+        return {'status': 'connection-error', 'msg': str(err), 'version': None}
+    try:
+        if resp.status_code != 200:
+            _record_response(sent_at, resp, 0)
+            return {'status': 'client-error',
+                    'msg': 'Capabilities request failed with {} response'.format(resp.status_code),
+                    'version': None}
+        nbytes = [0]
+
+        def chunks():
+            for chunk in resp.iter_content(64 * 1024):
+                nbytes[0] += len(chunk)
+                yield chunk
+        try:
+            verdict = parse_capabilities(chunks(), format,
+                                         layers=layers,
+                                         max_bytes=OWS_MAX_BYTES)
+            verdict['layers'] = None
+            return verdict
+        except requests.RequestException, err:
+            return {'status': 'connection-error', 'msg': str(err), 'version': None}
+        finally:
+            _record_response(sent_at, resp, nbytes[0])
+    finally:
+        # remaining part of large document is not transferred
+        _release_response(resp)
+
+
+class _OwsTimeout(Exception):
+    pass
+
+
+def _raise_ows_timeout(signum, frame):
+    raise _OwsTimeout()
+
+
+def _evaluate_ows_task(evaluate, args, timeout):
+    # runs in main thread of pool process, so alarm can interrupt it
+    prev = signal.signal(signal.SIGALRM, _raise_ows_timeout)
+    signal.alarm(timeout)
+    try:
+        return evaluate(*args)
+    except _OwsTimeout:
+        return _timeout_verdict(timeout)
+    finally:
+        signal.alarm(0)
+        signal.signal(signal.SIGALRM, prev)
+
+
+def _timeout_verdict(timeout):
+    return {'status': 'timeout',
+            'msg': 'Capabilities were not fetched and parsed in {} seconds'.format(timeout),
+            'version': None,
+            'layers': None}
+
+
+class OwsProcessPool(object):
+    """
+    Process pool for OWS capabilities parsing, enabled
+    with `ckanext.gsreport.ows.processes`.
+
+    Tasks submitted to pool at once are limited to number of its
+    processes, so task doesn't wait in pool's queue, and deadline
+    of waiting for its result is counted from its start.
+    """
+
+    def __init__(self, processes):
+        self._pool = multiprocessing.Pool(processes)
+        self._slots = threading.BoundedSemaphore(processes)
+
+    def evaluate(self, evaluate, args, url):
+        """
+        Call `evaluate(*args)` in pool process and return its verdict,
+        or timeout verdict if it wasn't returned in time.
+        """
+        with self._slots:
+            task = self._pool.apply_async(_evaluate_ows_task, (evaluate, args, OWS_TIMEOUT,))
+            try:
+                # process reports its own timeout, deadline here is for
+                # process which can't be interrupted (or died)
+                return task.get(OWS_TIMEOUT + 1)
+            except multiprocessing.TimeoutError:
+                log.warning('OWS service %s was not parsed in %s seconds', url, OWS_TIMEOUT)
+                return _timeout_verdict(OWS_TIMEOUT)
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+
+
+def _create_ows_verdict(format, client_cls, url, layers=None, pool=None):
+    if OWS_STREAMING and format in CAPABILITIES_ROOTS:
+        evaluate, args = evaluate_ows_stream, (format, url, layers,)
+    else:
+        evaluate, args = evaluate_ows, (client_cls, url,)
+    if pool is None:
+        return evaluate(*args)
+    return pool.evaluate(evaluate, args, url)
+
+
+def _get_ows_verdict(format, client_cls, url, key, layers=None):
+    """
+    Return OWS verdict for url (see `evaluate_ows`), reusing one created
+    for the same endpoint and version by current `ResourceChecker`.
+
+    With process pool enabled, client is created and capabilities are
+    parsed in pool process, and only verdict is sent back. With
+    `ckanext.gsreport.ows.streaming` enabled, WMS/WFS capabilities are
+    validated with streaming parser instead of owslib client, which
+    looks for requested `layers` only, so they're part of cache key.
+    """
+    if OWS_STREAMING and format in CAPABILITIES_ROOTS:
+        layers = tuple(sorted(set(layers or ())))
+        key = key + (layers,)
+    checker = get_checker()
+    if checker is None:
+        return _create_ows_verdict(format, client_cls, url, layers)
+    return checker.ows_cache.get_or_create(key, partial(_create_ows_verdict, format, client_cls, url,
+                                                        layers, checker.ows_pool))
+
+
+def _get_conditional_headers(validators):
+    """
+    Return conditional request headers built from validators
+    """
+    headers = {}
+    if validators:
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
+
+def _release_response(resp, max_bytes=HTTP_DRAIN_BYTES):
+    """
+    Release connection of streamed response.
+
+    Small rest of body (up to `max_bytes`) is read, so connection is
+    returned to session's pool and reused by next request to the host.
+    Response with larger (or unknown, and longer) rest of body is closed
+    early, with its connection, so rest of body is not transferred.
+    """
+    try:
+        length = int(resp.headers.get('Content-Length'))
+    except (TypeError, ValueError):
+        length = None
+    try:
+        if length is None or length <= max_bytes:
+            read = 0
+            for chunk in resp.iter_content(16 * 1024):
+                read += len(chunk)
+                if read > max_bytes:
+                    break
+    except (requests.RequestException, EnvironmentError), err:
+        log.debug('cannot read rest of response from %s: %s', resp.url, err)
+    # returns connection to pool, if body was read whole
+    resp.close()
+
+
+def _probe(method, url, headers):
+    """
+    Send http request and return (response code, response headers, data).
+
+    For GET request only first 1024 bytes of body are read (None for HEAD).
+    Rest of body is not transferred, unless it's small, see `_release_response`.
+    """
+    sent_at = time.time()
+    resp = get_session().request(method, url,
+                                 headers=headers,
+                                 timeout=(CONNECT_TIMEOUT, READ_TIMEOUT,),
+                                 allow_redirects=True,
+                                 stream=True)
+    try:
+        data = None
+        if method == 'GET':
+            data = next(resp.iter_content(1024), '')[:1024]
+        _record_response(sent_at, resp, len(data or ''))
+        return resp.status_code, resp.headers, data
+    finally:
+        _release_response(resp)
+
+
+def check_http(res, res_url, return_headers=False, validators=None):
     """
     Perform http check on resource
+
+    HEAD request is sent first. If server doesn't respond to it with success,
+    ranged GET request is sent for first 1024 bytes of body (some servers
+    don't support HEAD properly). When `return_headers` is set, GET request
+    is used directly, so response data is available in result.
+
+    If `validators` dict (with `etag` and `last_modified` from previous
+    check) is provided, conditional request is sent and 304 response
+    is treated as successful check. In that case, current validators
+    are returned also for successful check.
     """
     out = {'headers': None,
            'code': None}
     if isinstance(res_url, unicode):
         res_url = res_url.encode('utf-8')
+    req_headers = _get_conditional_headers(validators)
+    not_modified = validators is not None
     try:
-        resp = urlopen(res_url)
-    except IOError, err:
+        resp_code = None
+        if not return_headers:
+            resp_code, resp_headers, data = _probe('HEAD', res_url, req_headers)
+        if resp_code not in HTTP_OK_CODES and not (resp_code == 304 and not_modified):
+            range_headers = dict(req_headers, Range='bytes=0-1023')
+            resp_code, resp_headers, data = _probe('GET', res_url, range_headers)
+    except requests.RequestException, err:
         log.warning('Cannot connect to %s: %s', res_url, err)
         out['msg'] = clean_for_markdown(str(err))
         out['error'] = t._('connection-error')
         return out
-    resp_code = resp.getcode()
-    info = resp.info()
-    try:
-        data = resp.read(1024)
-        data = data.decode('utf-8')
-    except UnicodeError:
-        data = u"can't encode data properly. possibly binary response from server"
+    if resp_code == 304 and not_modified:
+        # not modified since previous check, still ok
+        return {'code': resp_code,
+                'etag': resp_headers.get('ETag') or validators.get('etag'),
+                'last_modified': resp_headers.get('Last-Modified') or validators.get('last_modified')}
+    if data is not None:
+        try:
+            data = data.decode('utf-8')
+        except UnicodeError:
+            data = u"can't encode data properly. possibly binary response from server"
     out.update({'code': resp_code,
-                'headers': headers_to_str(info.headers),
+                'headers': headers_to_str('{}: {}'.format(k, v) for k, v in resp_headers.items()),
                 'data': data})
 
-    if resp_code != 200:
+    if resp_code not in HTTP_OK_CODES:
         out['error'] = t._('bad-response-code')
         log.warning('bad response from resource: %s: %s', resp_code, data)
         return out
     if return_headers:
         return out
+    if validators is not None:
+        return {'code': resp_code,
+                'etag': resp_headers.get('ETag'),
+                'last_modified': resp_headers.get('Last-Modified')}
 
 
 
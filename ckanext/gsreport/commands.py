@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+
+from ckan.lib.cli import CkanCommand
+
+log = logging.getLogger(__name__)
+
+
+class GsReportCommand(CkanCommand):
+    """
+    Maintenance commands for ckanext-gsreport
+
+    Usage:
+
+        gsreport reconcile-counters
+            - rebuild live format and license counters from all datasets
+
+        gsreport enqueue [ORGANIZATION ...] [--force]
+            - queue resources of organizations (all by default) for
+              sharded broken-links checking. Nothing is queued if queue
+              is not drained, unless --force is used
+
+        gsreport worker
+            - check queued resources until queue is drained, then merge
+              finished organization runs. Many workers can run at once,
+              on one or more machines
+
+        gsreport merge
+            - merge finished organization runs
+
+        gsreport metrics [--output=FILE]
+            - write link check metrics from latest broken-links runs
+              in Prometheus text format (for textfile collector)
+
+        gsreport export REPORT [--org=ORGANIZATION] [--res-format=FORMAT]
+                               [--format=csv|jsonl] [--all-results] [--output=FILE]
+            - stream rows of resources-format (resources with format) or
+              broken-links (failed resources from latest runs, all checked
+              resources with --all-results) report as csv or json lines
+
+        gsreport benchmark [SIZE ...] [--latency=SECONDS] [--failure-rate=RATE]
+                           [--seed=SEED] [--report=NAME ...] [--output=FILE]
+            - generate reports for synthetic catalogs of SIZE resources
+              (default 1000 10000 100000) against local stub server, and
+              write measurements as json. This modifies database, run it
+              on development instance only.
+    """
+
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+    min_args = 1
+
+    def __init__(self, name):
+        super(GsReportCommand, self).__init__(name)
+        self.parser.add_option('--latency', dest='latency', type='float', default=0,
+                               help='stub server response latency, in seconds')
+        self.parser.add_option('--failure-rate', dest='failure_rate', type='float', default=0,
+                               help='part of stub server responses which fail (0..1)')
+        self.parser.add_option('--seed', dest='seed', type='int', default=0,
+                               help='random seed for synthetic catalog')
+        self.parser.add_option('--report', dest='reports', action='append', default=None,
+                               help='report to run, can be repeated (default: all)')
+        self.parser.add_option('--force', dest='force', action='store_true', default=False,
+                               help='queue resources even if queue is not drained')
+        self.parser.add_option('--output', dest='output', default=None,
+                               help='file to write results to (default: stdout)')
+        self.parser.add_option('--org', dest='org', default=None,
+                               help='organization to export rows of')
+        self.parser.add_option('--res-format', dest='res_format', default=None,
+                               help='resource format to export rows of')
+        self.parser.add_option('--format', dest='export_format', default='csv',
+                               help='export format, csv or jsonl (default: csv)')
+        self.parser.add_option('--all-results', dest='all_results', action='store_true', default=False,
+                               help='export all checked resources, not only failed ones')
+
+    def command(self):
+        self._load_config()
+        cmd = self.args[0].replace('-', '_')
+        handler = getattr(self, 'cmd_{}'.format(cmd), None)
+        if handler is None:
+            print(self.usage)
+            return
+        handler(*self.args[1:])
+
+    def cmd_reconcile_counters(self):
+        from ckan import model
+        from ckanext.gsreport.model import init_tables, reconcile_counters
+
+        init_tables()
+        reconcile_counters()
+        model.Session.commit()
+        print('Counters rebuilt')
+
+    def cmd_benchmark(self, *sizes):
+        import sys
+        from ckanext.gsreport import benchmark
+
+        sizes = [int(size) for size in sizes] or benchmark.DEFAULT_SIZES
+        results = benchmark.run_benchmark(sizes=sizes,
+                                          latency=self.options.latency,
+                                          failure_rate=self.options.failure_rate,
+                                          seed=self.options.seed,
+                                          reports=self.options.reports or benchmark.REPORT_NAMES)
+        if self.options.output:
+            with open(self.options.output, 'w') as f:
+                benchmark.dump_results(results, f)
+        else:
+            benchmark.dump_results(results, sys.stdout)
+
+    def cmd_metrics(self):
+        import sys
+        from ckanext.gsreport.metrics import get_metrics
+
+        data = get_metrics().encode('utf-8')
+        if self.options.output:
+            with open(self.options.output, 'w') as f:
+                f.write(data)
+        else:
+            sys.stdout.write(data)
+
+    def cmd_export(self, report_name):
+        import sys
+        from ckanext.gsreport import export
+
+        options = {'org': self.options.org,
+                   'res_format': self.options.res_format}
+        columns, rows = export.get_export(report_name, options,
+                                          errors_only=not self.options.all_results)
+        chunks = export.write_export(columns, rows, self.options.export_format)
+        out = open(self.options.output, 'w') if self.options.output else sys.stdout
+        try:
+            for chunk in chunks:
+                out.write(chunk)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+
+    def cmd_enqueue(self, *organizations):
+        from ckanext.gsreport.model import init_tables
+        from ckanext.gsreport.workers import enqueue_runs
+
+        init_tables()
+        runs = enqueue_runs(list(organizations) or None, force=self.options.force)
+        print('Queued runs for {} organizations'.format(len(runs)))
+
+    def cmd_worker(self):
+        from ckanext.gsreport.workers import run_worker
+
+        count = run_worker()
+        print('Checked {} resources'.format(count))
+
+    def cmd_merge(self):
+        from ckanext.gsreport.workers import merge_runs
+
+        merged = merge_runs()
+        print('Merged runs for {} organizations'.format(len(merged)))
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+
+from ckan.lib.base import BaseController, response, request, c
+import ckan.lib.helpers as h
+import ckan.plugins.toolkit as t
+
+
+class GsReportController(BaseController):
+
+    def _check_super(self):
+        context = {'user': c.user, 'auth_user_obj': c.userobj}
+        try:
+            t.check_access('report_list', context, {})
+        except t.NotAuthorized:
+            t.abort(403, t._('Only superuser can use reports'))
+
+    def metrics(self):
+        """
+        Link check metrics in Prometheus text format
+        """
+        from ckanext.gsreport.metrics import get_metrics, CONTENT_TYPE
+
+        self._check_super()
+        response.headers['Content-Type'] = CONTENT_TYPE
+        return get_metrics().encode('utf-8')
+
+    def _json(self, data, status=200):
+        response.status_int = status
+        response.headers['Content-Type'] = 'application/json; charset=utf-8'
+        return json.dumps(data, default=unicode)
+
+    def report_rows(self, report_name):
+        """
+        Page of report rows as json, see `ckanext.gsreport.paging`
+        for params. Report options are passed as for report page.
+        """
+        from ckanext.gsreport import paging
+
+        self._check_super()
+        try:
+            options = paging.get_report_options(report_name, request.params)
+        except KeyError:
+            t.abort(404, t._('Report not found'))
+        try:
+            query = paging.parse_rows_query(request.params)
+            context = {'user': c.user, 'auth_user_obj': c.userobj}
+            data = t.get_action('report_data_get')(context, {'id': report_name,
+                                                             'options': options})
+            out = paging.get_report_rows(report_name, data, options, query)
+        except ValueError, err:
+            return self._json({'error': unicode(err)}, 400)
+        out['report'] = report_name
+        out['options'] = options
+        out['rows'] = self._display_rows(report_name, out['rows'])
+        return self._json(out)
+
+    def export(self, report_name):
+        """
+        Stream report rows as csv or json lines (`format` param),
+        see `ckanext.gsreport.export`. Report options are passed
+        as for report page.
+        """
+        from ckanext.gsreport import export, paging
+
+        self._check_super()
+        try:
+            options = paging.get_report_options(report_name, request.params)
+        except KeyError:
+            t.abort(404, t._('Report not found'))
+        fmt = request.params.get('format') or 'csv'
+        errors_only = not t.asbool(request.params.get('all_results'))
+        try:
+            columns, rows = export.get_export(report_name, options, errors_only)
+            chunks = export.write_export(columns, rows, fmt)
+        except ValueError, err:
+            t.abort(400, unicode(err))
+        response.headers['Content-Type'] = export.CONTENT_TYPES[fmt]
+        response.headers['Content-Disposition'] = 'attachment; filename="{}"'\
+            .format(export.get_export_filename(report_name, options, fmt).encode('utf-8'))
+        return chunks
+
+    def _display_rows(self, report_name, rows):
+        """
+        Add localized titles, urls and messages used by report views
+        to rows
+        """
+        from ckanext.gsreport import helpers as gsh
+
+        lang = h.lang()
+        if report_name == 'broken-links':
+            if rows and 'resource_id' in rows[0]:
+                titles = gsh.get_localized_pkg_titles(rows, lang, 'dataset_id')
+                for row in rows:
+                    row['dataset_title'] = titles.get(row['dataset_id']) or row['dataset_title']
+                    row['error_label'] = t._(row['error']) if row['error'] else row['error']
+                    row['reason'] = h.render_markdown(t._(row['msg'] or '').format(t._(row['error'] or ''),
+                                                                                  row['msg_raw'] or ''))
+            else:
+                titles = gsh.get_localized_org_titles(rows, lang, 'organization')
+                for row in rows:
+                    row['organization_title'] = titles.get(row['organization']) or row['organization']
+        elif report_name == 'resources-format' and rows and 'resource.id' in rows[0]:
+            org_titles = gsh.get_localized_org_titles(rows, lang, 'organization.name')
+            pkg_titles = gsh.get_localized_pkg_titles(rows, lang, 'dataset.id')
+            for row in rows:
+                row['organization.title'] = org_titles.get(row['organization.name']) or row['organization.name']
+                row['dataset.title'] = pkg_titles.get(row['dataset.id']) or row['dataset.title']
+                row['dataset.url'] = h.url_for('dataset_read', id=row['dataset.id'])
+                row['resource.read_url'] = h.url_for(controller='package', action='resource_read',
+                                                     id=row['dataset.id'], resource_id=row['resource.id'])
+        return rows
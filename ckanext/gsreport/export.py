@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Streaming export of report rows as CSV or JSON lines.
+
+Rows are read with server-side cursor on separate db connection and
+written out as they're fetched, so memory use doesn't depend on number
+of exported rows, and output starts before query is finished.
+Separate connection is also used, because rows are streamed after
+request's db session is removed.
+"""
+
+import csv
+import json
+from cStringIO import StringIO
+
+from ckan import model
+
+from ckanext.gsreport import reports
+from ckanext.gsreport.model import CheckRun
+from ckanext.gsreport.storage import ROW_KEYS, get_report_row
+
+FORMATS = ('csv', 'jsonl',)
+CONTENT_TYPES = {'csv': 'text/csv; charset=utf-8',
+                 'jsonl': 'application/x-ndjson; charset=utf-8',
+                 }
+
+# number of rows fetched from cursor at once
+EXPORT_BATCH_SIZE = 1000
+# size of written chunk, in bytes
+CHUNK_SIZE = 64 * 1024
+
+RESOURCES_FORMAT_COLUMNS = ('organization.name',
+                            'dataset.id',
+                            'dataset.name',
+                            'dataset.title',
+                            'dataset.private',
+                            'dataset.notes',
+                            'resource.id',
+                            'resource.name',
+                            'resource.format',
+                            'resource.url',
+                            'resource.size',
+                            'resource.description',
+                            'resource.created',
+                            'resource.last_modified',
+                            'resource.state',
+                            )
+
+BROKEN_LINKS_COLUMNS = ROW_KEYS
+
+
+def _stream(statement, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Yield rows of statement, fetched in batches from server-side cursor
+    """
+    conn = model.meta.engine.connect()
+    try:
+        rows = conn.execution_options(stream_results=True).execute(statement)
+        while True:
+            batch = rows.fetchmany(batch_size)
+            if not batch:
+                break
+            for r in batch:
+                yield r
+    finally:
+        conn.close()
+
+
+def _resources_format_rows(org=None, res_format=None):
+    P = model.Package
+    O = model.Group
+
+    q = reports._resources_format_rows_query(model.Session)
+    if res_format:
+        q = reports._filter_resources_format(q, org, res_format)
+    else:
+        q = q.filter(P.state == 'active')
+        if org:
+            q = q.filter(O.name == org)
+    for r in _stream(q.statement):
+        yield reports._resources_format_row(r)
+
+
+def _broken_links_rows(run_ids, errors_only=True):
+    if not run_ids:
+        return
+    for r in _stream(CheckRun.get_results_query(run_ids, errors_only)):
+        yield get_report_row(json.loads(r[0]))
+
+
+def get_export(report_name, options, errors_only=True):
+    """
+    Return (columns, iterator of row dicts) for report export.
+
+    `resources-format` exports resources with format (all resources,
+    without `res_format`), of organization or whole site.
+    `broken-links` exports stored results of latest run of organization
+    (or each organization), failed only, unless `errors_only` is False.
+
+    Rows are read lazily, when iterator is consumed. Raises ValueError
+    for reports which can't be exported.
+    """
+    if report_name == 'resources-format':
+        return (RESOURCES_FORMAT_COLUMNS,
+                _resources_format_rows(options.get('org'), options.get('res_format')),)
+    if report_name == 'broken-links':
+        # run ids are resolved now, while db session is available
+        run_ids = CheckRun.get_latest_ids(options.get('org'))
+        return BROKEN_LINKS_COLUMNS, _broken_links_rows(run_ids, errors_only)
+    raise ValueError(u'Report {} can not be exported'.format(report_name))
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def _take(buf):
+    out = buf.getvalue()
+    buf.seek(0)
+    buf.truncate()
+    return out
+
+
+def _csv_lines(columns, rows):
+    buf = StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(columns)
+    yield _take(buf)
+    for row in rows:
+        writer.writerow([_csv_value(row.get(c)) for c in columns])
+        yield _take(buf)
+
+
+def _json_lines(columns, rows):
+    for row in rows:
+        out = json.dumps(dict((c, row.get(c)) for c in columns), default=unicode)
+        yield out + '\n'
+
+
+def _chunks(lines):
+    # first line (csv header) is written immediately,
+    # rest is joined into larger chunks
+    lines = iter(lines)
+    for line in lines:
+        yield line
+        break
+    chunk = []
+    size = 0
+    for line in lines:
+        chunk.append(line)
+        size += len(line)
+        if size >= CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+            size = 0
+    if chunk:
+        yield ''.join(chunk)
+
+
+def write_export(columns, rows, fmt='csv'):
+    """
+    Return iterator of export chunks (bytes) in format (`csv` or `jsonl`).
+    Raises ValueError for unknown format.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(u'Unknown export format: {}'.format(fmt))
+    if fmt == 'csv':
+        return _chunks(_csv_lines(columns, rows))
+    return _chunks(_json_lines(columns, rows))
+
+
+def get_export_filename(report_name, options, fmt):
+    parts = [report_name] + [v for k, v in sorted(options.items()) if v]
+    return u'{}.{}'.format('-'.join(parts), fmt)
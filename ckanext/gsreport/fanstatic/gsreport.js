@@ -23,3 +23,126 @@ ckan.module('autosubmit', function($){
  });
 
 
+
+
+ckan.module('gsreport-pager', function($){
+    // loads report rows page by page from gsreport_report_rows endpoint,
+    // sorting and filtering is done on server
+    var escape = function(value){
+        return $('<div/>').text(value === null || value === undefined ? '' : value).html();
+    };
+    var link = function(url, text){
+        return '<a href="' + escape(url) + '">' + escape(text) + '</a>';
+    };
+    var truncate = function(value, length){
+        value = value || '';
+        return value.length > length ? value.substr(0, length - 3) + '...' : value;
+    };
+
+    var renderers = {
+        'broken-links': function(row){
+            var url = row.res_url || row.resource_url;
+            return [link(row.dataset_url, row.dataset_title),
+                    escape(truncate(row.resource_name, 50)),
+                    escape(row.resource_format),
+                    link(url, url),
+                    escape(row.error_label),
+                    row.reason];
+        },
+        'resources-format': function(row){
+            var resource = (row['resource.name'] ? escape(row['resource.name']) + '<br/>' : '') +
+                           escape(row['resource.url']);
+            return [escape(row['organization.title']),
+                    link(row['dataset.url'], row['dataset.title']) +
+                        (row['dataset.private'] ? ' <span class="icon-lock" title="private"></span>' : ''),
+                    '<a href="' + escape(row['resource.read_url']) + '">' + resource + '</a>',
+                    escape(truncate(row['resource.description'], 50)),
+                    escape(row['resource.format']),
+                    escape(row['resource.created'])];
+        }
+    };
+
+    var pager = {
+        options: {url: null,
+                  report: null,
+                  total: 0,
+                  limit: 100,
+                  moreLabel: 'Load more',
+                  filterLabel: 'Filter'},
+
+        initialize: function(){
+            $.proxyAll(this, /_on/);
+            this.sort = null;
+            this.q = null;
+            this.shown = this.$('tbody tr').length;
+            this.total = this.options.total;
+            this.render = renderers[this.options.report];
+
+            this.filter = $('<input type="search" class="gsreport-pager-filter"/>')
+                            .attr('placeholder', this.options.filterLabel)
+                            .on('change', this._onFilter)
+                            .insertBefore(this.el);
+            this.more = $('<button type="button" class="btn btn-default gsreport-pager-more"/>')
+                            .text(this.options.moreLabel)
+                            .on('click', this._onMore)
+                            .insertAfter(this.el);
+            this.$('th[data-sort]').addClass('header').on('click', this._onSort);
+            this._update();
+        },
+
+        _update: function(){
+            this.more.toggle(this.shown < this.total);
+        },
+
+        _load: function(offset, replace){
+            var params = {offset: offset, limit: this.options.limit};
+            if (this.sort){
+                params.sort = this.sort;
+            }
+            if (this.q){
+                params.q = this.q;
+            }
+            this.more.prop('disabled', true);
+            $.getJSON(this.options.url, params, this._onLoaded(replace));
+        },
+
+        _onLoaded: function(replace){
+            var that = this;
+            return function(data){
+                var html = $.map(data.rows, function(row){
+                    return '<tr><td>' + that.render(row).join('</td><td>') + '</td></tr>';
+                }).join('');
+                var body = that.$('tbody');
+                if (replace){
+                    body.html(html);
+                    that.shown = 0;
+                } else {
+                    body.append(html);
+                }
+                that.shown += data.rows.length;
+                that.total = data.total;
+                that.more.prop('disabled', false);
+                that._update();
+            };
+        },
+
+        _onMore: function(){
+            this._load(this.shown, false);
+        },
+
+        _onSort: function(evt){
+            var th = $(evt.currentTarget);
+            var column = th.data('sort');
+            this.sort = this.sort === column ? '-' + column : column;
+            this.$('th[data-sort]').removeClass('headerSortUp headerSortDown');
+            th.addClass(this.sort.charAt(0) === '-' ? 'headerSortUp' : 'headerSortDown');
+            this._load(0, true);
+        },
+
+        _onFilter: function(){
+            this.q = $.trim(this.filter.val()) || null;
+            this._load(0, true);
+        }
+    };
+    return $.extend({}, pager);
+ });
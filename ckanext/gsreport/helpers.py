@@ -1,10 +1,11 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from beaker.cache import CacheManager
-
+from ckan import model
 from ckan.plugins import toolkit as t
 from ckan.lib.i18n import get_lang
+from ckanext.gsreport import reports
+from ckanext.gsreport.cache import LRUCache
 from ckanext.gsreport.reports import EMPTY_STRING_PLACEHOLDER
 
 try:
@@ -19,7 +20,23 @@ except ImportError:
 
 DEFAULT_LANG = config.get('ckan.locale_default', 'en')
 
-cache = CacheManager(type='memory')
+# number of organizations and datasets with localized titles kept in memory
+DEFAULT_TITLES_CACHE_SIZE = 10000
+TITLES_CACHE_SIZE_CONFIG = 'ckanext.gsreport.titles_cache_size'
+TITLES_CACHE_SIZE = t.asint(config.get(TITLES_CACHE_SIZE_CONFIG,
+                                       DEFAULT_TITLES_CACHE_SIZE))
+
+# seconds after which cached titles are loaded again, so changes
+# made by other processes are picked up; 0 disables expiry
+DEFAULT_TITLES_CACHE_TTL = 3600
+TITLES_CACHE_TTL_CONFIG = 'ckanext.gsreport.titles_cache_ttl'
+TITLES_CACHE_TTL = t.asint(config.get(TITLES_CACHE_TTL_CONFIG,
+                                      DEFAULT_TITLES_CACHE_TTL))
+
+# (kind, org name or package id) -> dict of lang -> localized title (or None),
+# entries are invalidated when organization or dataset is changed,
+# and expire after `ckanext.gsreport.titles_cache_ttl` seconds
+titles_cache = LRUCache(TITLES_CACHE_SIZE, ttl=TITLES_CACHE_TTL)
 
 
 def facets_hide_item(item):
@@ -45,29 +62,119 @@ def get_organizations():
     for org in org_list(ctx, data_dict):
         yield (org['name'], org['title'],)
 
-@cache.cache('localized_org_title', expire=30)
+def _query_org_titles(names, langs):
+    q = model.Session.query(GroupMultilang.name, GroupMultilang.lang, GroupMultilang.text)\
+                     .filter(GroupMultilang.name.in_(names),
+                             GroupMultilang.lang.in_(langs),
+                             GroupMultilang.field == 'title')
+    return q
+
+
+def _query_pkg_titles(ids, langs):
+    q = model.Session.query(PackageMultilang.package_id, PackageMultilang.lang, PackageMultilang.text)\
+                     .filter(PackageMultilang.package_id.in_(ids),
+                             PackageMultilang.lang.in_(langs),
+                             PackageMultilang.field == 'title',
+                             PackageMultilang.field_type == 'package')
+    return q
+
+
+def _get_titles(kind, query, keys, lang):
+    """
+    Return dict of key -> localized title (in `lang`, or default language),
+    for keys which have one. Titles missing in cache are loaded with
+    one query.
+    """
+    langs = [lang] if lang == DEFAULT_LANG else [lang, DEFAULT_LANG]
+    entries = {}
+    missing = set()
+    for key in set(k for k in keys if k):
+        entry = titles_cache.get((kind, key,))
+        if entry is None or any(l not in entry for l in langs):
+            missing.add(key)
+        else:
+            entries[key] = entry
+
+    if missing:
+        loaded = dict((key, dict(titles_cache.get((kind, key,)) or {})) for key in missing)
+        for entry in loaded.values():
+            entry.update(dict.fromkeys(langs, None))
+        for key, row_lang, text in query(list(missing), langs):
+            loaded[key][row_lang] = text
+        for key, entry in loaded.items():
+            titles_cache.set((kind, key,), entry)
+        entries.update(loaded)
+
+    out = {}
+    for key, entry in entries.items():
+        title = entry.get(lang) or entry.get(DEFAULT_LANG)
+        if title:
+            out[key] = title
+    return out
+
+
+def _get_keys(rows, key):
+    if key is None:
+        return rows
+    return [row.get(key) for row in rows]
+
+
+def get_localized_org_titles(rows, lang, key=None):
+    """
+    Returns dict of organization name -> localized title, for all
+    organizations in rows (list of names, or list of dicts with name
+    under `key`).
+    """
+    if GroupMultilang is None:
+        return {}
+    return _get_titles('org', _query_org_titles, _get_keys(rows, key), lang)
+
+
+def get_localized_pkg_titles(rows, lang, key=None):
+    """
+    Returns dict of dataset id -> localized title, for all
+    datasets in rows (list of ids, or list of dicts with id under `key`).
+    """
+    if PackageMultilang is None:
+        return {}
+    return _get_titles('pkg', _query_pkg_titles, _get_keys(rows, key), lang)
+
+
 def get_localized_org_title(org_name, lang):
     """
     Returns localized organization title if possible.
     """
-    if GroupMultilang is not None:
+    return get_localized_org_titles([org_name], lang).get(org_name)
 
-        g = GroupMultilang.get_for_group_name_and_lang(org_name, lang)
-        if not g:
-            g = GroupMultilang.get_for_group_name_and_lang(org_name, DEFAULT_LANG)
-        for row in g:
-            if row.field == 'title':
-                return row.text
 
-@cache.cache('localized_pkg_title', expire=30)
 def get_localized_pkg_title(pkg_id, lang):
     """
-    Returns localized organization title if possible.
+    Returns localized dataset title if possible.
+    """
+    return get_localized_pkg_titles([pkg_id], lang).get(pkg_id)
+
+
+def invalidate_org_title(org_name):
+    titles_cache.pop(('org', org_name,))
+
+
+def invalidate_pkg_title(pkg_id):
+    titles_cache.pop(('pkg', pkg_id,))
+
+
+def get_live_formats():
+    """
+    Returns current `resources-format` summary data from live counters,
+    or None if live counters are disabled.
+    """
+    if reports.LIVE_COUNTERS:
+        return reports.resources_formats()
+
+
+def get_live_licenses(organization=None):
+    """
+    Returns current `licenses` report data from live counters,
+    or None if live counters are disabled.
     """
-    field_type = 'package'
-    if PackageMultilang is not None:
-        g = PackageMultilang.get(pkg_id, 'title', lang, field_type)
-        if not g:
-            g = PackageMultilang.get(pkg_id, 'title', DEFAULT_LANG, field_type)
-        if g:
-            return g.text
+    if reports.LIVE_COUNTERS:
+        return reports.report_licenses(organization)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Link check metrics in Prometheus text exposition format.
+
+Metrics are built from per-host timing stored with latest `broken-links`
+run of each organization.
+"""
+
+from ckanext.gsreport.model import CheckRun
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+QUANTILES = (('0.5', 'p50',), ('0.95', 'p95',), ('0.99', 'p99',),)
+
+
+def _escape(value):
+    return unicode(value or '').replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+    return u','.join(u'{}="{}"'.format(k, _escape(v)) for k, v in sorted(labels.items()))
+
+
+def format_metrics(host_stats):
+    """
+    Return metrics text for list of per-host summary dicts
+    (see `ckanext.gsreport.model.CheckRun.get_latest_host_stats`)
+    """
+    lines = [u'# HELP gsreport_link_check_duration_seconds Duration of link checks per host, from latest broken-links run',
+             u'# TYPE gsreport_link_check_duration_seconds summary']
+    for row in host_stats:
+        labels = {'organization': row['organization'], 'host': row['host']}
+        for quantile, key in QUANTILES:
+            lines.append(u'gsreport_link_check_duration_seconds{{{}}} {}'
+                         .format(_labels(quantile=quantile, **labels), row[key]))
+        lines.append(u'gsreport_link_check_duration_seconds_sum{{{}}} {}'
+                     .format(_labels(**labels), row['duration_sum']))
+        lines.append(u'gsreport_link_check_duration_seconds_count{{{}}} {}'
+                     .format(_labels(**labels), row['count']))
+
+    gauges = (('gsreport_link_check_ttfb_p50_seconds', 'Median time to first byte of link checks per host',
+               lambda row: row['ttfb_p50'],),
+              ('gsreport_link_check_errors', 'Number of failed link checks per host',
+               lambda row: row['errors'],),
+              ('gsreport_link_check_error_ratio', 'Ratio of failed link checks per host',
+               lambda row: float(row['errors']) / row['count'] if row['count'] else 0,),
+              ('gsreport_link_check_bytes', 'Number of response bytes read by link checks per host',
+               lambda row: row['bytes'],),
+              )
+    for name, help, value in gauges:
+        lines.append(u'# HELP {} {}'.format(name, help))
+        lines.append(u'# TYPE {} gauge'.format(name))
+        for row in host_stats:
+            val = value(row)
+            if val is None:
+                continue
+            lines.append(u'{}{{{}}} {}'.format(name,
+                                               _labels(organization=row['organization'], host=row['host']),
+                                               val))
+    return u'\n'.join(lines) + u'\n'
+
+
+def get_metrics():
+    """
+    Return metrics text for latest broken-links runs
+    """
+    return format_metrics(CheckRun.get_latest_host_stats())
@@ -0,0 +1,825 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+from collections import Counter
+from datetime import datetime, timedelta
+from itertools import groupby
+
+from sqlalchemy import Table, Column, ForeignKey, types, select, func, distinct, case, and_, or_, desc
+from sqlalchemy.exc import IntegrityError
+from ckan import model
+from ckan.model.meta import metadata, mapper, Session
+from ckan.model.domain_object import DomainObject
+
+log = logging.getLogger(__name__)
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# same as ckanext.gsreport.reports.EMPTY_STRING_PLACEHOLDER
+EMPTY_STRING_PLACEHOLDER = 'not-specified'
+
+# keys from check result dict, which are stored as a verdict of check
+RESULT_KEYS = ('code', 'headers', 'data', 'msg', 'msg_raw', 'msg_rendered', 'error',)
+
+
+check_state_table = Table('gsreport_check_state', metadata,
+                          Column('resource_id', types.UnicodeText, primary_key=True),
+                          Column('url', types.UnicodeText),
+                          Column('error', types.UnicodeText),
+                          Column('result', types.UnicodeText),
+                          Column('etag', types.UnicodeText),
+                          Column('last_modified', types.UnicodeText),
+                          Column('checked_at', types.DateTime, index=True),
+                          )
+
+
+check_run_table = Table('gsreport_check_run', metadata,
+                        Column('id', types.Integer, primary_key=True),
+                        Column('organization', types.UnicodeText, index=True),
+                        Column('dataset', types.UnicodeText),
+                        Column('total_datasets', types.Integer),
+                        Column('started_at', types.DateTime),
+                        Column('finished_at', types.DateTime),
+                        )
+
+check_result_table = Table('gsreport_check_result', metadata,
+                           Column('id', types.Integer, primary_key=True),
+                           Column('run_id', types.Integer,
+                                  ForeignKey('gsreport_check_run.id', ondelete='CASCADE'),
+                                  index=True),
+                           Column('resource_id', types.UnicodeText),
+                           Column('dataset_id', types.UnicodeText),
+                           Column('organization_id', types.UnicodeText),
+                           Column('url', types.UnicodeText),
+                           Column('error', types.UnicodeText),
+                           Column('checked_at', types.DateTime),
+                           Column('result', types.UnicodeText),
+                           )
+
+# compact pages of broken-links report rows (see ckanext.gsreport.storage)
+report_page_table = Table('gsreport_report_page', metadata,
+                          Column('run_id', types.Integer,
+                                 ForeignKey('gsreport_check_run.id', ondelete='CASCADE'),
+                                 primary_key=True),
+                          Column('page', types.Integer, primary_key=True, autoincrement=False),
+                          Column('data', types.LargeBinary),
+                          )
+
+# per-host timing aggregates of checks performed in run
+host_stats_table = Table('gsreport_host_stats', metadata,
+                         Column('id', types.Integer, primary_key=True),
+                         Column('run_id', types.Integer,
+                                ForeignKey('gsreport_check_run.id', ondelete='CASCADE'),
+                                index=True),
+                         Column('host', types.UnicodeText),
+                         Column('count', types.Integer),
+                         Column('errors', types.Integer),
+                         Column('duration_sum', types.Float),
+                         Column('ttfb_p50', types.Float),
+                         Column('p50', types.Float),
+                         Column('p95', types.Float),
+                         Column('p99', types.Float),
+                         Column('bytes', types.BigInteger),
+                         )
+
+# number of resources in each priority class (see
+# ckanext.gsreport.reports.PRIORITIES) and how many of them were checked
+# in prioritized run with time budget
+run_coverage_table = Table('gsreport_run_coverage', metadata,
+                           Column('run_id', types.Integer,
+                                  ForeignKey('gsreport_check_run.id', ondelete='CASCADE'),
+                                  primary_key=True),
+                           Column('priority', types.UnicodeText, primary_key=True),
+                           Column('total', types.Integer),
+                           Column('checked', types.Integer),
+                           )
+
+# work queue for sharded broken-links checking: resources to check
+# for each run, sharded by host, and shard leases held by workers
+check_queue_table = Table('gsreport_check_queue', metadata,
+                          Column('id', types.Integer, primary_key=True),
+                          Column('run_id', types.Integer,
+                                 ForeignKey('gsreport_check_run.id', ondelete='CASCADE'),
+                                 index=True),
+                          Column('resource_id', types.UnicodeText),
+                          Column('host', types.UnicodeText),
+                          Column('shard', types.Integer, index=True),
+                          Column('done', types.Boolean, default=False, nullable=False),
+                          Column('claimed_by', types.UnicodeText),
+                          Column('claimed_at', types.DateTime),
+                          )
+
+check_shard_table = Table('gsreport_check_shard', metadata,
+                          Column('shard', types.Integer, primary_key=True, autoincrement=False),
+                          Column('worker', types.UnicodeText),
+                          Column('leased_until', types.DateTime),
+                          )
+
+# OWS version which worked for endpoint in previous checks
+ows_version_table = Table('gsreport_ows_version', metadata,
+                          Column('endpoint', types.UnicodeText, primary_key=True),
+                          Column('version', types.UnicodeText),
+                          Column('updated_at', types.DateTime),
+                          )
+
+HOST_STATS_KEYS = ('host', 'count', 'errors', 'duration_sum', 'ttfb_p50',
+                   'p50', 'p95', 'p99', 'bytes',)
+
+
+# live counters: contribution of each package to counters, and
+# counters of resources per organization and format,
+# and of datasets per organization and license
+package_counts_table = Table('gsreport_package_counts', metadata,
+                             Column('package_id', types.UnicodeText, primary_key=True),
+                             Column('organization_id', types.UnicodeText),
+                             Column('license_id', types.UnicodeText),
+                             Column('formats', types.UnicodeText),
+                             )
+
+format_count_table = Table('gsreport_format_count', metadata,
+                           Column('organization_id', types.UnicodeText, primary_key=True),
+                           Column('format', types.UnicodeText, primary_key=True),
+                           Column('count', types.Integer, nullable=False, default=0),
+                           )
+
+license_count_table = Table('gsreport_license_count', metadata,
+                            Column('organization_id', types.UnicodeText, primary_key=True),
+                            Column('license_id', types.UnicodeText, primary_key=True),
+                            Column('count', types.Integer, nullable=False, default=0),
+                            )
+
+
+class ResourceCheckState(DomainObject):
+    """
+    Result of last check of resource url, with validators
+    (ETag, Last-Modified) returned by server.
+    """
+
+    @classmethod
+    def get_for_resources(cls, resource_ids):
+        """
+        Return dict of resource id -> state for given resources
+        """
+        if not resource_ids:
+            return {}
+        q = Session.query(cls).filter(cls.resource_id.in_(resource_ids))
+        return dict((s.resource_id, s) for s in q)
+
+    @classmethod
+    def update_from_results(cls, results):
+        """
+        Store state from list of check result dicts (see `ckanext.gsreport.checkers.check_url`)
+        """
+        states = cls.get_for_resources([r['resource_id'] for r in results])
+        for r in results:
+            state = states.get(r['resource_id'])
+            if state is None:
+                state = states[r['resource_id']] = cls(resource_id=r['resource_id'])
+                Session.add(state)
+            state.url = r['url']
+            state.error = r['error']
+            state.result = json.dumps(dict((k, r.get(k)) for k in RESULT_KEYS))
+            state.etag = r.get('etag')
+            state.last_modified = r.get('last_modified')
+            state.checked_at = datetime.strptime(r['checked_at'], DATE_FORMAT)
+        Session.flush()
+
+    def get_result(self):
+        """
+        Return stored verdict as a dict, which can update check result dict
+        """
+        if not self.result:
+            return {}
+        return json.loads(self.result)
+
+    def get_validators(self):
+        """
+        Return validators for conditional request, or None if there are none
+        """
+        if self.etag or self.last_modified:
+            return {'etag': self.etag,
+                    'last_modified': self.last_modified}
+
+
+class CheckRun(DomainObject):
+    """
+    One broken-links report run for organization (or dataset). Results
+    of checks are stored in `gsreport_check_result` table, one row per
+    checked resource.
+    """
+
+    @classmethod
+    def start(cls, organization=None, dataset=None):
+        run = cls(organization=organization,
+                  dataset=dataset,
+                  started_at=datetime.now())
+        Session.add(run)
+        Session.flush()
+        return run
+
+    def add_results(self, results):
+        """
+        Store list of check result dicts (see `ckanext.gsreport.checkers.check_url`)
+        """
+        if not results:
+            return
+        rows = [{'run_id': self.id,
+                 'resource_id': r['resource_id'],
+                 'dataset_id': r['dataset_id'],
+                 'organization_id': r['organization_id'],
+                 'url': r['url'],
+                 'error': r['error'],
+                 'checked_at': datetime.strptime(r['checked_at'], DATE_FORMAT),
+                 'result': json.dumps(r)} for r in results]
+        Session.execute(check_result_table.insert(), rows)
+
+    def add_report_page(self, page, data):
+        """
+        Store compressed page of report rows
+        """
+        Session.execute(report_page_table.insert(),
+                        {'run_id': self.id, 'page': page, 'data': data})
+
+    def clear_report_pages(self):
+        Session.execute(report_page_table.delete()
+                        .where(report_page_table.c.run_id == self.id))
+
+    @classmethod
+    def get_report_page(cls, run_id, page):
+        """
+        Return compressed page of report rows, or None
+        """
+        c = report_page_table.c
+        return Session.execute(select([c.data])
+                               .where(and_(c.run_id == run_id, c.page == page))).scalar()
+
+    @classmethod
+    def get_result(cls, run_id, resource_id):
+        """
+        Return stored check result dict for resource, with headers
+        and response data, or None
+        """
+        c = check_result_table.c
+        result = Session.execute(select([c.result])
+                                 .where(and_(c.run_id == run_id, c.resource_id == resource_id))
+                                 .limit(1)).scalar()
+        if result:
+            return json.loads(result)
+
+    def add_host_stats(self, stats):
+        """
+        Store per-host summary dicts (see `ckanext.gsreport.checkers.HostStats.summary`)
+        """
+        if not stats:
+            return
+        rows = [dict((k, row[k]) for k in HOST_STATS_KEYS) for row in stats]
+        for row in rows:
+            row['run_id'] = self.id
+        Session.execute(host_stats_table.insert(), rows)
+
+    def finish(self, total_datasets, keep_runs=1):
+        """
+        Mark run as finished and remove older runs for the same
+        organization/dataset, keeping `keep_runs` latest (including this one).
+        """
+        self.total_datasets = total_datasets
+        self.finished_at = datetime.now()
+        Session.flush()
+
+        c = check_run_table.c
+        q = Session.query(CheckRun.id)\
+                   .filter(and_(c.organization == self.organization,
+                                c.dataset == self.dataset,
+                                c.id <= self.id))\
+                   .order_by(c.id.desc())\
+                   .offset(max(keep_runs, 1))
+        old_ids = [r[0] for r in q]
+        if old_ids:
+            Session.execute(report_page_table.delete()
+                            .where(report_page_table.c.run_id.in_(old_ids)))
+            Session.execute(check_queue_table.delete()
+                            .where(check_queue_table.c.run_id.in_(old_ids)))
+            Session.execute(host_stats_table.delete()
+                            .where(host_stats_table.c.run_id.in_(old_ids)))
+            Session.execute(run_coverage_table.delete()
+                            .where(run_coverage_table.c.run_id.in_(old_ids)))
+            Session.execute(check_result_table.delete()
+                            .where(check_result_table.c.run_id.in_(old_ids)))
+            Session.execute(check_run_table.delete()
+                            .where(c.id.in_(old_ids)))
+
+    @classmethod
+    def get_latest_stats(cls):
+        """
+        Return list of summary dicts for latest finished run of each
+        active organization. Runs of deleted or renamed organizations
+        are not listed.
+
+        Summaries are computed with one grouped query over stored results.
+        """
+        run = check_run_table.c
+        res = check_result_table.c
+        org = model.group_table.c
+
+        latest = select([func.max(run.id)])\
+                    .where(and_(run.dataset == None,
+                                run.organization != None,
+                                run.finished_at != None))\
+                    .group_by(run.organization)
+
+        joined = check_run_table.join(model.group_table,
+                                      and_(org.name == run.organization,
+                                           org.state == 'active',
+                                           org.is_organization == True))\
+                                .outerjoin(check_result_table, res.run_id == run.id)
+
+        q = select([run.organization,
+                    func.max(run.total_datasets),
+                    func.count(res.id),
+                    func.count(res.error),
+                    func.count(distinct(case([(res.error != None, res.dataset_id)])))],
+                   from_obj=joined)\
+                .where(run.id.in_(latest))\
+                .group_by(run.organization)\
+                .order_by(run.organization)
+
+        return [{'organization': r[0],
+                 'total.datasets': r[1] or 0,
+                 'total.resources': r[2],
+                 'errors.resources': r[3],
+                 'errors.datasets': r[4]} for r in Session.execute(q)]
+
+
+    @classmethod
+    def get_latest(cls, organization):
+        """
+        Return latest finished run for organization, or None
+        """
+        return Session.query(cls)\
+                      .filter(and_(cls.organization == organization,
+                                   cls.dataset == None,
+                                   cls.finished_at != None))\
+                      .order_by(cls.id.desc())\
+                      .first()
+
+    def iter_results(self, batch_size=500):
+        """
+        Yield stored check result dicts of this run
+        """
+        c = check_result_table.c
+        q = select([c.result])\
+                .where(c.run_id == self.id)\
+                .order_by(c.url, c.id)
+        rows = Session.execute(q)
+        while True:
+            batch = rows.fetchmany(batch_size)
+            if not batch:
+                break
+            for r in batch:
+                yield json.loads(r[0])
+
+    def add_coverage(self, coverage):
+        """
+        Store list of (priority, total, checked) tuples
+        """
+        rows = [{'run_id': self.id, 'priority': priority, 'total': total, 'checked': checked}
+                for priority, total, checked in coverage]
+        if rows:
+            Session.execute(run_coverage_table.insert(), rows)
+
+    def get_coverage(self):
+        """
+        Return dict of priority -> (total, checked) stored for this run
+        """
+        c = run_coverage_table.c
+        q = select([c.priority, c.total, c.checked])\
+                .where(c.run_id == self.id)
+        return dict((r[0], (r[1], r[2],)) for r in Session.execute(q))
+
+    def get_host_stats(self):
+        """
+        Return list of stored per-host summary dicts for this run
+        """
+        hs = host_stats_table.c
+        q = select([hs[k] for k in HOST_STATS_KEYS])\
+                .where(hs.run_id == self.id)\
+                .order_by(hs.host)
+        out = []
+        for r in Session.execute(q):
+            row = dict(zip(HOST_STATS_KEYS, r))
+            row['error_rate'] = float(row['errors']) / row['count'] if row['count'] else 0.0
+            out.append(row)
+        return out
+
+    @classmethod
+    def get_latest_host_stats(cls):
+        """
+        Return list of per-host summary dicts from latest finished run
+        of each organization, with `organization` key added.
+        """
+        run = check_run_table.c
+        hs = host_stats_table.c
+
+        latest = select([func.max(run.id)])\
+                    .where(and_(run.dataset == None,
+                                run.organization != None,
+                                run.finished_at != None))\
+                    .group_by(run.organization)
+
+        q = select([run.organization] + [hs[k] for k in HOST_STATS_KEYS],
+                   from_obj=check_run_table.join(host_stats_table,
+                                                 hs.run_id == run.id))\
+                .where(run.id.in_(latest))\
+                .order_by(run.organization, hs.host)
+
+        out = []
+        for r in Session.execute(q):
+            row = dict(zip(HOST_STATS_KEYS, r[1:]))
+            row['organization'] = r[0]
+            out.append(row)
+        return out
+
+    @classmethod
+    def get_latest_ids(cls, organization=None):
+        """
+        Return list of ids of latest finished run for organization,
+        or for each organization, if not provided.
+        """
+        run = check_run_table.c
+        q = select([func.max(run.id)])\
+                .where(and_(run.dataset == None,
+                            run.organization != None,
+                            run.finished_at != None))
+        if organization:
+            q = q.where(run.organization == organization)
+        q = q.group_by(run.organization)\
+             .order_by(run.organization)
+        return [r[0] for r in Session.execute(q)]
+
+    @classmethod
+    def get_results_query(cls, run_ids, errors_only=False):
+        """
+        Return select of stored check results (json) of runs,
+        ordered by run and url, as in report.
+        """
+        c = check_result_table.c
+        q = select([c.result])\
+                .where(c.run_id.in_(run_ids))
+        if errors_only:
+            q = q.where(c.error != None)
+        return q.order_by(c.run_id, c.url, c.id)
+
+
+class OwsVersion(object):
+    """
+    Store of OWS versions which worked for endpoints, used by
+    `ckanext.gsreport.checkers.check_resources`.
+    """
+
+    @classmethod
+    def load_all(cls):
+        """
+        Return dict of endpoint key -> version
+        """
+        c = ows_version_table.c
+        return dict(Session.execute(select([c.endpoint, c.version])).fetchall())
+
+    @classmethod
+    def save(cls, changes):
+        """
+        Store dict of endpoint key -> version, None removes version
+        """
+        if not changes:
+            return
+        c = ows_version_table.c
+        Session.execute(ows_version_table.delete()
+                        .where(c.endpoint.in_(changes.keys())))
+        now = datetime.now()
+        rows = [{'endpoint': endpoint,
+                 'version': version,
+                 'updated_at': now} for endpoint, version in changes.items() if version]
+        if rows:
+            Session.execute(ows_version_table.insert(), rows)
+
+
+class CheckQueue(object):
+    """
+    Database-backed work queue for sharded checking.
+
+    Each queued resource belongs to a shard computed from its host.
+    Worker leases a shard (only one worker holds a shard at a time, so
+    per-host limits hold across workers), claims batches of resources
+    from it, and marks them done. Leases expire, so shards of crashed
+    workers are taken over by other workers.
+    """
+
+    @classmethod
+    def init_shards(cls, shards):
+        """
+        Create missing shard rows
+        """
+        c = check_shard_table.c
+        existing = set(r[0] for r in Session.execute(select([c.shard])))
+        missing = [{'shard': shard} for shard in range(shards) if shard not in existing]
+        if missing:
+            Session.execute(check_shard_table.insert(), missing)
+
+    @classmethod
+    def enqueue(cls, run_id, items):
+        """
+        Add list of (resource id, host, shard) items for run
+        """
+        if not items:
+            return
+        Session.execute(check_queue_table.insert(),
+                        [{'run_id': run_id,
+                          'resource_id': resource_id,
+                          'host': host,
+                          'shard': shard,
+                          'done': False} for resource_id, host, shard in items])
+
+    @classmethod
+    def pending_count(cls):
+        c = check_queue_table.c
+        return Session.execute(select([func.count(c.id)]).where(c.done == False)).scalar()
+
+    @classmethod
+    def lease_shard(cls, worker, lease_timeout):
+        """
+        Lease shard with pending items for worker. Returns shard number,
+        or None, if there's no shard available.
+        """
+        q = check_queue_table.c
+        c = check_shard_table.c
+        now = datetime.now()
+        pending = select([distinct(q.shard)]).where(q.done == False).order_by(q.shard)
+        for r in Session.execute(pending).fetchall():
+            result = Session.execute(check_shard_table.update()
+                                     .where(and_(c.shard == r[0],
+                                                 or_(c.worker == None,
+                                                     c.worker == worker,
+                                                     c.leased_until < now)))
+                                     .values(worker=worker,
+                                             leased_until=now + timedelta(seconds=lease_timeout)))
+            if result.rowcount == 1:
+                Session.commit()
+                return r[0]
+        Session.commit()
+
+    @classmethod
+    def renew_shard(cls, worker, shard, lease_timeout):
+        """
+        Extend lease of shard. Returns False if lease was lost.
+        """
+        c = check_shard_table.c
+        result = Session.execute(check_shard_table.update()
+                                 .where(and_(c.shard == shard, c.worker == worker))
+                                 .values(leased_until=datetime.now() + timedelta(seconds=lease_timeout)))
+        return result.rowcount == 1
+
+    @classmethod
+    def release_shard(cls, worker, shard):
+        c = check_shard_table.c
+        Session.execute(check_shard_table.update()
+                        .where(and_(c.shard == shard, c.worker == worker))
+                        .values(worker=None, leased_until=None))
+
+    @classmethod
+    def claim(cls, worker, shard, limit):
+        """
+        Claim up to `limit` pending items from leased shard. Items claimed
+        by other worker, which lost the lease, are claimed again.
+        Returns list of (item id, run id, resource id).
+        """
+        c = check_queue_table.c
+        rows = Session.execute(select([c.id, c.run_id, c.resource_id])
+                               .where(and_(c.shard == shard, c.done == False))
+                               .order_by(c.host, c.id)
+                               .limit(limit)).fetchall()
+        if rows:
+            Session.execute(check_queue_table.update()
+                            .where(c.id.in_([r[0] for r in rows]))
+                            .values(claimed_by=worker, claimed_at=datetime.now()))
+        return [tuple(r) for r in rows]
+
+    @classmethod
+    def complete(cls, item_ids):
+        if not item_ids:
+            return
+        c = check_queue_table.c
+        Session.execute(check_queue_table.update()
+                        .where(c.id.in_(item_ids))
+                        .values(done=True))
+
+    @classmethod
+    def get_drained_runs(cls):
+        """
+        Return unfinished runs, which have all queued items done
+        """
+        c = check_queue_table.c
+        queued = select([c.run_id]).group_by(c.run_id)
+        pending = select([c.run_id]).where(c.done == False)
+        return Session.query(CheckRun)\
+                      .filter(and_(CheckRun.finished_at == None,
+                                   CheckRun.id.in_(queued),
+                                   ~CheckRun.id.in_(pending)))\
+                      .order_by(CheckRun.id)\
+                      .all()
+
+    @classmethod
+    def claim_merge(cls, run):
+        """
+        Mark run as being merged. Returns False, if other worker did it first.
+        """
+        c = check_run_table.c
+        result = Session.execute(check_run_table.update()
+                                 .where(and_(c.id == run.id, c.finished_at == None))
+                                 .values(finished_at=datetime.now()))
+        return result.rowcount == 1
+
+    @classmethod
+    def remove_run(cls, run_id):
+        Session.execute(check_queue_table.delete()
+                        .where(check_queue_table.c.run_id == run_id))
+
+
+mapper(ResourceCheckState, check_state_table)
+mapper(CheckRun, check_run_table)
+
+tables = (check_state_table, check_run_table, check_result_table, host_stats_table, report_page_table,
+          run_coverage_table, check_queue_table, check_shard_table, ows_version_table,
+          package_counts_table, format_count_table, license_count_table,)
+
+
+def _get_contribution(state, owner_org, license_id, private, pkg_type, formats):
+    """
+    Return (organization id, license id or None, formats Counter) which
+    package adds to live counters, or None if package is not counted.
+
+    Resource formats are counted for active datasets, licenses for
+    active, public datasets only, as in `resources-format` and `licenses` reports.
+    """
+    if state != 'active':
+        return None
+    formats = Counter(EMPTY_STRING_PLACEHOLDER if f is None else f for f in formats)
+    if private or pkg_type != 'dataset':
+        license_id = None
+    else:
+        license_id = license_id or ''
+    return (owner_org or '', license_id, formats,)
+
+
+def _update_counts(table, key_name, organization_id, counts, sign):
+    c = table.c
+    key_col = c[key_name]
+    for key, count in counts.items():
+        update = table.update()\
+                      .where(and_(c.organization_id == organization_id,
+                                  key_col == key))\
+                      .values(count=c.count + sign * count)
+        res = Session.execute(update)
+        if res.rowcount == 0 and sign > 0:
+            # insert in savepoint, so concurrent insert of the same
+            # counter doesn't abort whole transaction
+            savepoint = Session.begin_nested()
+            try:
+                Session.execute(table.insert()
+                                     .values(**{'organization_id': organization_id,
+                                                key_name: key,
+                                                'count': count}))
+                savepoint.commit()
+            except IntegrityError:
+                savepoint.rollback()
+                Session.execute(update)
+    if sign < 0:
+        Session.execute(table.delete().where(c.count <= 0))
+
+
+def _apply_contribution(contribution, sign):
+    organization_id, license_id, formats = contribution
+    _update_counts(format_count_table, 'format', organization_id, formats, sign)
+    if license_id is not None:
+        _update_counts(license_count_table, 'license_id', organization_id, {license_id: 1}, sign)
+
+
+def update_package_counters(package_id):
+    """
+    Update live counters after package was created, updated or deleted.
+
+    Previous contribution of package is subtracted from counters, and
+    current one is added.
+
+    :param package_id: id or name of package (delete hooks get
+        whatever was passed to `package_delete`)
+    """
+    pkg = model.Package.get(package_id)
+    if pkg is not None:
+        package_id = pkg.id
+    c = package_counts_table.c
+    prev = Session.execute(select([c.organization_id, c.license_id, c.formats])
+                           .where(c.package_id == package_id)).first()
+    if prev is not None:
+        _apply_contribution((prev[0], prev[1], json.loads(prev[2]),), -1)
+        Session.execute(package_counts_table.delete().where(c.package_id == package_id))
+
+    contribution = None
+    if pkg is not None:
+        contribution = _get_contribution(pkg.state, pkg.owner_org, pkg.license_id,
+                                         pkg.private, pkg.type,
+                                         [r.format for r in pkg.resources if r.state == 'active'])
+    if contribution is not None:
+        _apply_contribution(contribution, 1)
+        Session.execute(package_counts_table.insert()
+                                            .values(package_id=package_id,
+                                                    organization_id=contribution[0],
+                                                    license_id=contribution[1],
+                                                    formats=json.dumps(contribution[2])))
+
+
+def reconcile_counters(batch_size=500):
+    """
+    Rebuild live counters from all datasets and resources
+    """
+    P = model.Package
+    R = model.Resource
+
+    for table in (package_counts_table, format_count_table, license_count_table,):
+        Session.execute(table.delete())
+
+    q = Session.query(P.id, P.state, P.owner_org, P.license_id, P.private, P.type, R.format, R.id)\
+               .outerjoin(R, and_(R.package_id == P.id, R.state == 'active'))\
+               .filter(P.state == 'active')\
+               .order_by(P.id)\
+               .yield_per(batch_size)
+
+    formats = Counter()
+    licenses = Counter()
+    packages = []
+    for package_id, rows in groupby(q, key=lambda r: r[0]):
+        rows = list(rows)
+        first = rows[0]
+        contribution = _get_contribution(first[1], first[2], first[3], first[4], first[5],
+                                         [r[6] for r in rows if r[7] is not None])
+        organization_id, license_id, pkg_formats = contribution
+        for f, count in pkg_formats.items():
+            formats[(organization_id, f,)] += count
+        if license_id is not None:
+            licenses[(organization_id, license_id,)] += 1
+        packages.append({'package_id': package_id,
+                         'organization_id': organization_id,
+                         'license_id': license_id,
+                         'formats': json.dumps(pkg_formats)})
+        if len(packages) >= batch_size:
+            Session.execute(package_counts_table.insert(), packages)
+            packages = []
+    if packages:
+        Session.execute(package_counts_table.insert(), packages)
+    if formats:
+        Session.execute(format_count_table.insert(),
+                        [{'organization_id': k[0], 'format': k[1], 'count': v}
+                         for k, v in formats.items()])
+    if licenses:
+        Session.execute(license_count_table.insert(),
+                        [{'organization_id': k[0], 'license_id': k[1], 'count': v}
+                         for k, v in licenses.items()])
+    log.info('reconciled counters for %s formats and %s licenses', len(formats), len(licenses))
+
+
+def get_live_format_counts():
+    """
+    Return list of (format, resources count) from live counters,
+    most used formats first
+    """
+    c = format_count_table.c
+    q = select([c.format, func.sum(c.count)])\
+            .group_by(c.format)\
+            .order_by(desc(func.sum(c.count)))
+    return [(r[0], int(r[1]),) for r in Session.execute(q) if r[1]]
+
+
+def get_live_license_counts(organization=None):
+    """
+    Return list of (license id, datasets count) from live counters,
+    for whole site or organization (name or id)
+    """
+    c = license_count_table.c
+    q = select([c.license_id, func.sum(c.count)])\
+            .group_by(c.license_id)
+    if organization:
+        org = model.Group.get(organization)
+        if org is None:
+            return []
+        q = q.where(c.organization_id == org.id)
+    return [(r[0], int(r[1]),) for r in Session.execute(q) if r[1]]
+
+
+def init_tables():
+    """
+    Create extension's tables if they don't exist
+    """
+    for table in tables:
+        if not table.exists(model.meta.engine):
+            log.info('creating table %s', table.name)
+            table.create(model.meta.engine)
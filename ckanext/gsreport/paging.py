@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Server-side pagination, sorting and filtering of report rows.
+
+Rows are returned in pages (offset/limit), optionally sorted on any
+column and filtered by column values or text. Long lists are read
+from their source: resources from database for `resources-format`
+with format selected, compact report pages for `broken-links` for
+organization. Short tables (summaries, licenses) are paginated
+from report data.
+"""
+
+from sqlalchemy import or_, asc, desc
+from ckan import model
+from ckan.lib.base import config
+import ckan.plugins.toolkit as t
+
+from ckanext.gsreport import reports
+
+# default and max number of rows in one page
+DEFAULT_ROWS_LIMIT = 100
+ROWS_LIMIT_CONFIG = 'ckanext.gsreport.rows.limit'
+ROWS_LIMIT = t.asint(config.get(ROWS_LIMIT_CONFIG, DEFAULT_ROWS_LIMIT))
+
+DEFAULT_MAX_ROWS_LIMIT = 1000
+MAX_ROWS_LIMIT_CONFIG = 'ckanext.gsreport.rows.max_limit'
+MAX_ROWS_LIMIT = t.asint(config.get(MAX_ROWS_LIMIT_CONFIG, DEFAULT_MAX_ROWS_LIMIT))
+
+# request params with filter on column value, like filter.error=http-error
+FILTER_PREFIX = 'filter.'
+
+
+class RowsQuery(object):
+    """
+    Requested page of report rows
+
+    :param offset: number of rows to skip
+    :param limit: max number of rows in page
+    :param sort: list of (column, descending) tuples
+    :param filters: list of (column, value) tuples
+    :param q: text which should be in one of row values
+    """
+
+    def __init__(self, offset=0, limit=None, sort=None, filters=None, q=None):
+        self.offset = offset
+        self.limit = limit or ROWS_LIMIT
+        self.sort = sort or []
+        self.filters = filters or []
+        self.q = q
+
+    @property
+    def columns(self):
+        return [c for c, d in self.sort] + [c for c, v in self.filters]
+
+    @property
+    def ordered(self):
+        """
+        Is query on rows in default order, without filters
+        """
+        return not (self.sort or self.filters or self.q)
+
+    def as_dict(self):
+        return {'offset': self.offset,
+                'limit': self.limit,
+                'sort': ','.join('{}{}'.format('-' if d else '', c) for c, d in self.sort),
+                'filters': dict(self.filters),
+                'q': self.q}
+
+
+def _get_int(params, name, default):
+    value = params.get(name)
+    if value in (None, ''):
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(u'Invalid {}: {}'.format(name, value))
+
+
+def parse_rows_query(params):
+    """
+    Return `RowsQuery` from request params:
+     * `offset`, `limit`
+     * `sort` - comma-separated list of columns, `-` prefix for
+       descending order, for example `-error,dataset_title`
+     * `filter.<column>` - value of column
+     * `q` - text to search for in row values
+
+    Raises ValueError for invalid params.
+    """
+    offset = _get_int(params, 'offset', 0)
+    limit = _get_int(params, 'limit', ROWS_LIMIT)
+    if offset < 0:
+        raise ValueError(u'Invalid offset: {}'.format(offset))
+    if not 0 < limit <= MAX_ROWS_LIMIT:
+        raise ValueError(u'Limit should be between 1 and {}'.format(MAX_ROWS_LIMIT))
+
+    sort = []
+    for column in (params.get('sort') or '').split(','):
+        column = column.strip()
+        if column:
+            sort.append((column.lstrip('-'), column.startswith('-'),))
+
+    filters = [(k[len(FILTER_PREFIX):], v,) for k, v in params.items()
+               if k.startswith(FILTER_PREFIX)]
+    return RowsQuery(offset, limit, sort, filters, params.get('q') or None)
+
+
+def get_report_options(report_name, params):
+    """
+    Return report options for report from request params,
+    with defaults for options not provided.
+
+    Raises KeyError for unknown report.
+    """
+    for report in reports.all_reports():
+        if report['name'] == report_name:
+            break
+    else:
+        raise KeyError(report_name)
+    options = dict(report['option_defaults'])
+    for k in options.keys():
+        if params.get(k):
+            options[k] = params[k]
+    return options
+
+
+def _page(rows, total, query):
+    out = query.as_dict()
+    out.update({'total': total,
+                'rows': rows})
+    return out
+
+
+def _as_text(value):
+    if value is None:
+        return u''
+    return unicode(value)
+
+
+def _sort_key(value):
+    # None is always before values in ascending order
+    return (value is not None, value)
+
+
+def _match(row, query):
+    for column, value in query.filters:
+        if _as_text(row.get(column)) != value:
+            return False
+    if query.q:
+        q = query.q.lower()
+        return any(q in _as_text(v).lower() for v in row.values())
+    return True
+
+
+def page_rows(rows, query):
+    """
+    Return page of rows from list of row dicts
+    """
+    if rows:
+        for column in query.columns:
+            if column not in rows[0]:
+                raise ValueError(u'Unknown column: {}'.format(column))
+    rows = [row for row in rows if _match(row, query)]
+    # sort is stable, so sorting by last key first gives multi-column sort
+    for column, descending in reversed(query.sort):
+        rows.sort(key=lambda row: _sort_key(row.get(column)), reverse=descending)
+    return _page(rows[query.offset:query.offset + query.limit], len(rows), query)
+
+
+def iter_broken_links_rows(run_id, start=0):
+    """
+    Yield rows stored for broken-links run, from page `start`
+    """
+    page = start
+    while True:
+        rows = reports.get_broken_links_page(run_id, page)
+        if rows is None:
+            break
+        for row in rows:
+            yield row
+        page += 1
+
+
+def _broken_links_rows(data, query):
+    run_id = data.get('run_id')
+    if run_id is None:
+        # summary (or report stored without pages)
+        return page_rows(data['table'], query)
+    if not query.ordered:
+        # all listed rows have to be sorted, but there's no more
+        # than `ckanext.gsreport.broken_links.table_limit` of them
+        return page_rows(list(iter_broken_links_rows(run_id)), query)
+
+    # only pages with requested rows are loaded
+    page_size = data.get('page_size') or reports.PAGE_SIZE
+    start = query.offset // page_size
+    rows = []
+    skip = query.offset - start * page_size
+    for row in iter_broken_links_rows(run_id, start):
+        if skip:
+            skip -= 1
+            continue
+        rows.append(row)
+        if len(rows) >= query.limit:
+            break
+    return _page(rows, data.get('table_rows', 0), query)
+
+
+def _resources_format_columns():
+    """
+    Return dict of `resources-format` row column -> db column
+    """
+    R = model.Resource
+    P = model.Package
+    O = model.Group
+    return {'organization.name': O.name,
+            'dataset.title': P.title,
+            'dataset.id': P.id,
+            'dataset.name': P.name,
+            'dataset.notes': P.notes,
+            'dataset.private': P.private,
+            'resource.format': R.format,
+            'resource.name': R.name,
+            'resource.url': R.url,
+            'resource.id': R.id,
+            'resource.size': R.size,
+            'resource.last_modified': R.last_modified,
+            'resource.description': R.description,
+            'resource.created': R.created,
+            'resource.state': R.state,
+            }
+
+
+def _like(text):
+    for c in ('\\', '%', '_',):
+        text = text.replace(c, '\\' + c)
+    return u'%{}%'.format(text)
+
+
+def _resources_format_rows(data, options, query):
+    res_format = options.get('res_format')
+    if not res_format:
+        # formats summary
+        return page_rows(data['table'], query)
+
+    R = model.Resource
+    P = model.Package
+    columns = _resources_format_columns()
+    for column in query.columns:
+        if column not in columns:
+            raise ValueError(u'Unknown column: {}'.format(column))
+
+    q = reports._resources_format_rows_query(model.Session)
+    q = reports._filter_resources_format(q, options.get('org'), res_format)
+    for column, value in query.filters:
+        if column == 'dataset.private':
+            value = t.asbool(value)
+        q = q.filter(columns[column] == value)
+    if query.q:
+        like = _like(query.q)
+        q = q.filter(or_(*[c.ilike(like, escape='\\')
+                           for c in (P.title, R.name, R.url, R.description,)]))
+
+    total = q.order_by(None).count()
+    if query.sort:
+        order = [desc(columns[c]) if d else asc(columns[c]) for c, d in query.sort]
+        q = q.order_by(None).order_by(*(order + [R.id]))
+    q = q.offset(query.offset).limit(query.limit)
+    return _page([reports._resources_format_row(r) for r in q], total, query)
+
+
+def get_report_rows(report_name, data, options, query):
+    """
+    Return page of rows of report, as dict with `rows`, `total` (number
+    of rows matching query) and query params.
+
+    :param report_name: name of report
+    :param data: report data (from cache)
+    :param options: report options
+    :param query: `RowsQuery`
+
+    Raises ValueError for columns not in report.
+    """
+    if report_name == 'broken-links':
+        return _broken_links_rows(data, query)
+    if report_name == 'resources-format':
+        return _resources_format_rows(data, options, query)
+    return page_rows(data['table'], query)
@@ -1,10 +1,13 @@
 import logging
 
+from ckan import model
 import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
 
 from ckanext.report.interfaces import IReport
+from ckanext.gsreport import reports
 from ckanext.gsreport.reports import all_reports, EMPTY_STRING_PLACEHOLDER
+from ckanext.gsreport.model import init_tables, update_package_counters
 
 log = logging.getLogger(__name__)
 
@@ -33,9 +36,12 @@ def check_if_super(context, data_dict=None):
 class StatusReportPlugin(plugins.SingletonPlugin, DefaultTranslation):
     plugins.implements(IReport)
     plugins.implements(plugins.IConfigurer)
+    plugins.implements(plugins.IConfigurable)
     plugins.implements(plugins.IAuthFunctions)
     plugins.implements(plugins.ITemplateHelpers)
     plugins.implements(plugins.IPackageController, inherit=True)
+    plugins.implements(plugins.IOrganizationController, inherit=True)
+    plugins.implements(plugins.IRoutes, inherit=True)
     # ITranslation
     if toolkit.check_ckan_version(min_version='2.5.0'):
         plugins.implements(plugins.ITranslation)
@@ -47,6 +53,25 @@ class StatusReportPlugin(plugins.SingletonPlugin, DefaultTranslation):
         toolkit.add_public_directory(config, 'public')
         toolkit.add_resource('fanstatic', 'ckanext-gsreport')
 
+    # ------------- IConfigurable ---------------#
+
+    def configure(self, config):
+        init_tables()
+
+    # ------------- IRoutes ---------------#
+
+    def before_map(self, map):
+        map.connect('gsreport_metrics', '/gsreport/metrics',
+                    controller='ckanext.gsreport.controllers:GsReportController',
+                    action='metrics')
+        map.connect('gsreport_report_rows', '/gsreport/report/{report_name}/rows',
+                    controller='ckanext.gsreport.controllers:GsReportController',
+                    action='report_rows')
+        map.connect('gsreport_export', '/gsreport/report/{report_name}/export',
+                    controller='ckanext.gsreport.controllers:GsReportController',
+                    action='export')
+        return map
+
     # ------------- IReport ---------------#
 
     def register_reports(self):
@@ -64,6 +89,43 @@ class StatusReportPlugin(plugins.SingletonPlugin, DefaultTranslation):
         dataset_dict['license_id'] = dataset_dict.get('license_id') or EMPTY_STRING_PLACEHOLDER
         return dataset_dict
 
+    def after_create(self, context, pkg_dict):
+        self._update_counters(pkg_dict)
+
+    def after_update(self, context, pkg_dict):
+        self._update_counters(pkg_dict)
+
+    def after_delete(self, context, pkg_dict):
+        self._update_counters(pkg_dict)
+
+    def _update_counters(self, pkg_dict):
+        # live format and license counters, failure shouldn't prevent
+        # dataset from being saved, counters can be reconciled later
+        if reports.LIVE_COUNTERS and pkg_dict.get('id'):
+            savepoint = model.Session.begin_nested()
+            try:
+                update_package_counters(pkg_dict['id'])
+                savepoint.commit()
+            except Exception:
+                savepoint.rollback()
+                log.exception('cannot update live counters for dataset %s', pkg_dict['id'])
+
+    # IPackageController and IOrganizationController share these hooks
+
+    def edit(self, entity):
+        self._invalidate_title(entity)
+
+    def delete(self, entity):
+        self._invalidate_title(entity)
+
+    def _invalidate_title(self, entity):
+        # cached localized titles
+        from ckanext.gsreport import helpers as gsh
+        if isinstance(entity, model.Package):
+            gsh.invalidate_pkg_title(entity.id)
+        elif isinstance(entity, model.Group):
+            gsh.invalidate_org_title(entity.name)
+
     # ------------- IAuthFunctions --------------- #
     def get_auth_functions(self):
         out = {}
@@ -87,6 +149,10 @@ class StatusReportPlugin(plugins.SingletonPlugin, DefaultTranslation):
                 'gsreport_get_organizations': gsh.get_organizations,
                 'gsreport_get_org_title': gsh.get_localized_org_title,
                 'gsreport_get_pkg_title': gsh.get_localized_pkg_title,
+                'gsreport_get_org_titles': gsh.get_localized_org_titles,
+                'gsreport_get_pkg_titles': gsh.get_localized_pkg_titles,
+                'gsreport_live_formats': gsh.get_live_formats,
+                'gsreport_live_licenses': gsh.get_live_licenses,
                }
 
 
@@ -1,10 +1,13 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from datetime import datetime
-from itertools import product
+from collections import Counter
+from datetime import datetime, timedelta
+from itertools import groupby
 import logging
-from sqlalchemy import func, and_, or_
+import time
+from sqlalchemy import func, and_, or_, case, literal_column
+from sqlalchemy.orm import contains_eager
 from sqlalchemy.sql.functions import coalesce
 from ckan import model
 import ckan.plugins.toolkit as t
@@ -23,7 +26,9 @@ except ImportError:
     from pylons.i18n import lazy_ugettext as _
 
 
-from ckanext.gsreport.checkers import check_url
+from ckanext.gsreport.checkers import check_resources, prepare_check, HostStats, CHECK_INCREMENTAL
+from ckanext.gsreport.storage import ReportPages, get_report_row, decode_rows
+from ckanext.gsreport.model import ResourceCheckState, CheckRun, OwsVersion, get_live_format_counts, get_live_license_counts
 log = logging.getLogger(__name__)
 
 
@@ -43,6 +48,57 @@ FORMAT_LIST_CONFIG = "ckanext.gsreport.resource_format.format_limit"
 FORMAT_LIST_LIMIT = t.asint(config.get(FORMAT_LIST_CONFIG, 
                                        DEFAULT_FORMAT_LIST_LIMIT))
 
+# number of stored broken-links runs kept for each organization
+DEFAULT_KEEP_RUNS = 2
+KEEP_RUNS_CONFIG = "ckanext.gsreport.broken_links.keep_runs"
+KEEP_RUNS = t.asint(config.get(KEEP_RUNS_CONFIG, DEFAULT_KEEP_RUNS))
+
+# read format and license summaries from counters maintained
+# when datasets are changed, instead of scanning resources and datasets
+LIVE_COUNTERS_CONFIG = "ckanext.gsreport.live_counters"
+LIVE_COUNTERS = t.asbool(config.get(LIVE_COUNTERS_CONFIG, False))
+
+# max number of failed resources listed in broken-links report for
+# organization, 0 means no limit
+DEFAULT_TABLE_LIMIT = 1000
+TABLE_LIMIT_CONFIG = "ckanext.gsreport.broken_links.table_limit"
+TABLE_LIMIT = t.asint(config.get(TABLE_LIMIT_CONFIG, DEFAULT_TABLE_LIMIT))
+
+# number of failed resources in one page of broken-links report, first
+# page is stored in report data, other pages in compact report storage
+DEFAULT_PAGE_SIZE = 100
+PAGE_SIZE_CONFIG = "ckanext.gsreport.broken_links.page_size"
+PAGE_SIZE = t.asint(config.get(PAGE_SIZE_CONFIG, DEFAULT_PAGE_SIZE))
+
+# how many resources are fetched from db and how many check results
+# are collected before they're written to db
+RESULTS_BATCH_SIZE = 500
+
+# resources are checked by workers (see ckanext.gsreport.workers),
+# organization report is built from results of latest finished run
+SHARDED_CONFIG = "ckanext.gsreport.broken_links.sharded"
+SHARDED = t.asbool(config.get(SHARDED_CONFIG, False))
+
+# check resources of organization or dataset in order of priority
+# (see PRIORITIES) instead of url order
+PRIORITIZED_CONFIG = "ckanext.gsreport.broken_links.prioritized"
+PRIORITIZED = t.asbool(config.get(PRIORITIZED_CONFIG, False))
+
+# max number of seconds spent on checking resources of organization
+# or dataset, results of resources checked so far are stored, 0 means no limit
+DEFAULT_TIME_BUDGET = 0
+TIME_BUDGET_CONFIG = "ckanext.gsreport.broken_links.time_budget"
+TIME_BUDGET = t.asint(config.get(TIME_BUDGET_CONFIG, DEFAULT_TIME_BUDGET))
+
+# priority classes of resources in prioritized checks, most important first:
+#  * modified - resource or its dataset was modified since last check
+#  * broken - resource failed in last check
+#  * new - resource was never checked
+#  * oldest - other resources, checked longest ago first
+PRIORITIES = ('modified', 'broken', 'new', 'oldest',)
+# coverage class of runs without priorities
+PRIORITY_ALL = 'all'
+
 def dformat(val):
     """
     Return timestamp as string
@@ -100,12 +156,47 @@ def get_formats():
          .group_by(coalesce(R.format, ''))
     return [item[0] for item in q] + [None, EMPTY_STRING_PLACEHOLDER]
 
-def resources_format_options_combinations():
-    formats = get_formats()
-    organizations = _get_organizations()
-    param_names = ('res_format', 'org',)
-    
-    return [ dict(zip(param_names, prod)) for prod in product(formats, organizations)]
+def get_format_counts():
+    """
+    Return ordered dict of (res_format, org name) -> number of resources,
+    for non-empty combinations listed in `resources-format` report,
+    ordered by format and organization. Empty format is returned
+    as EMPTY_STRING_PLACEHOLDER.
+    """
+    s = model.Session
+    R = model.Resource
+    P = model.Package
+    O = model.Group
+
+    q = s.query(R.format, O.name, func.count(1))\
+         .select_from(R)\
+         .join(P, P.id == R.package_id)\
+         .join(O, O.id == P.owner_org)\
+         .filter(and_(P.state == 'active',
+                      R.format != None))\
+         .group_by(R.format, O.name)\
+         .order_by(R.format, O.name)
+    return OrderedDict(((r[0] or EMPTY_STRING_PLACEHOLDER, r[1],), r[2],) for r in q)
+
+
+def resources_format_options_combinations(counts=None):
+    """
+    Return combinations of `resources-format` report options which have
+    any resources, ordered as `ResourcesFormatPass` produces them: for
+    each format, each organization and then all organizations.
+    Summary (without format) is returned for all organizations.
+
+    :param counts: resource counts from `get_format_counts`
+    """
+    if counts is None:
+        counts = get_format_counts()
+    organizations = sorted(set(org for res_format, org in counts.keys()))
+    out = [{'res_format': None, 'org': org} for org in [None] + organizations]
+    for res_format, keys in groupby(counts.keys(), key=lambda k: k[0]):
+        for res_format, org in keys:
+            out.append({'res_format': res_format, 'org': org})
+        out.append({'res_format': res_format, 'org': None})
+    return out
 
 def broken_links_options_combinations():
     organizations = _get_organizations()
@@ -116,52 +207,405 @@ resources_format_options = OrderedDict({'org': None, 'res_format': None})
 broken_links_options = OrderedDict({'org': None})
 
 
+def _get_license_title(lid):
+    l = license_reg.get(lid)
+    return l.title if l else lid
+
+
+def _licenses_data(rows, titles=None):
+    """
+    Return `licenses` report data from list of
+    (license id, datasets count, count of datasets with license set) rows
+    """
+    titles = titles or {}
+    rows = sorted(rows, key=lambda r: r[2], reverse=True)
+    table = [{'title': titles[r[0]] if r[0] in titles else _get_license_title(r[0]),
+              'license': r[0],
+              'count': r[1]} for r in rows]
+    return {'table': table,
+            'number_of_licenses': len(table)}
+
+
+def get_licenses_reports():
+    """
+    Return dict of organization name -> `licenses` report data, for
+    all organizations with datasets and for whole site (None key).
+
+    Data is computed with one query grouped by organization and license.
+    """
+    s = model.Session
+    P = model.Package
+    O = model.Group
+    q = s.query(O.name, coalesce(P.license_id, ''), func.count(1), func.count(P.license_id))\
+         .select_from(P)\
+         .outerjoin(O, O.id == P.owner_org)\
+         .filter(and_(P.state=='active',
+                      P.private == False,
+                      P.type=='dataset'))\
+         .group_by(O.name, coalesce(P.license_id, ''))
+
+    titles = {}
+    per_org = {}
+    site = {}
+    for org, lid, count, lcount in q:
+        if lid not in titles:
+            titles[lid] = _get_license_title(lid)
+        if org:
+            per_org.setdefault(org, []).append((lid, count, lcount,))
+        site_row = site.setdefault(lid, [0, 0])
+        site_row[0] += count
+        site_row[1] += lcount
+
+    out = dict((org, _licenses_data(rows, titles),) for org, rows in per_org.items())
+    out[None] = _licenses_data([(lid, c[0], c[1],) for lid, c in site.items()], titles)
+    return out
+
+
+class LicensesReport(object):
+    """
+    `licenses` report generation, with data for all organizations and
+    whole site prepared with one query (see `get_licenses_reports`).
+
+    Data is prepared when iteration over `option_combinations` starts,
+    and each report is used once. It's dropped when iteration ends,
+    `generate` called at other times uses regular queries.
+    """
+
+    def __init__(self):
+        self.licenses_reports = None
+
+    def option_combinations(self):
+        organizations = _get_organizations()
+        self.licenses_reports = get_licenses_reports()
+        try:
+            for org in organizations:
+                # organizations without public datasets have empty reports
+                self.licenses_reports.setdefault(org, _licenses_data([]))
+                yield {'organization': org}
+        finally:
+            self.licenses_reports = None
+
+    def generate(self, organization=None):
+        if self.licenses_reports is not None and organization in self.licenses_reports:
+            return self.licenses_reports.pop(organization)
+        return report_licenses(organization)
+
+
 def report_licenses(organization=None):
+    if LIVE_COUNTERS:
+        # datasets without license were not counted in license_id count
+        return _licenses_data([(lid, count, count if lid else 0,)
+                               for lid, count in get_live_license_counts(organization)])
+
     s = model.Session
     P = model.Package
     O = model.Group
-    q = s.query(coalesce(P.license_id, ''), func.count(1))\
+    q = s.query(coalesce(P.license_id, ''), func.count(1), func.count(P.license_id))\
          .filter(and_(P.state=='active',
                       P.private == False,
                       P.type=='dataset'))\
-         .group_by(coalesce(P.license_id, ''))\
-         .order_by(desc(func.count(P.license_id)))
+         .group_by(coalesce(P.license_id, ''))
 
     if organization:
         q = q.join(O, O.id == P.owner_org).filter(O.name==organization)
-    count = q.count()
 
-    def get_license(lid):
-        l = license_reg.get(r[0])
-        return l.title if l else lid
-    
-    table = [{'title': get_license(r[0]), 'license': r[0], 'count': r[1]} for r in q]
-    return {'table': table,
-            'number_of_licenses': count}
+    return _licenses_data(list(q))
 
-BROKEN_LINKS_MARKER = None
+def _get_stats_pct(data):
+    """
+    Update broken links stats with percent of failed resources and datasets
+    """
+    if data['total.resources'] > 0:
+        data['errors.resources_pct'] = data['errors.resources'] * 100.0/data['total.resources']
+    else:
+        data['errors.resources_pct'] = 0.0
+    if data['total.datasets'] > 0:
+        data['errors.datasets_pct'] = data['errors.datasets'] * 100.0/data['total.datasets']
+    else:
+        data['errors.datasets_pct'] = 0.0
+    return data
 
-def report_broken_links(org=None, dataset=None):
+
+def _store_results(run, results):
+    """
+    Store check results in run, in batches, and yield them
     """
+    batch = []
+    for out in results:
+        batch.append(out)
+        if len(batch) >= RESULTS_BATCH_SIZE:
+            run.add_results(batch)
+            batch = []
+        yield out
+    run.add_results(batch)
+
+
+def _collect_broken_links(results, run):
     """
-    # used in get_report_data to detect if report was
-    # created within the same session
-    global BROKEN_LINKS_MARKER
-    if BROKEN_LINKS_MARKER is None:
-        BROKEN_LINKS_MARKER = dformat(datetime.now())
+    Return (table, listed, count, errors count, set of dataset ids with errors)
+    for iterable of check results.
 
-    from ckanext.report.report_registry import ReportRegistry, extract_entity_name
-    from ckanext.report.model import DataCache
+    Failed results, up to `ckanext.gsreport.broken_links.table_limit`
+    (`listed`), are stored as compact report pages of run. Table
+    contains first page.
+    """
+    table = []
+    count = 0
+    ecount = 0
+    derr = set()
+    pages = ReportPages(run.add_report_page, PAGE_SIZE)
+    for out in results:
+        count += 1
+        if out['error']:
+            ecount += 1
+            derr.add(out['dataset_id'])
+            # all results are in check results storage,
+            # report keeps only first rows
+            if not TABLE_LIMIT or pages.rows < TABLE_LIMIT:
+                row = get_report_row(out)
+                pages.add(row)
+                if len(table) < PAGE_SIZE:
+                    table.append(row_dict_norm(row))
+    pages.flush()
+    return table, pages.rows, count, ecount, derr
+
+
+def _get_priority():
+    """
+    Return expression with index of resource's class in PRIORITIES,
+    for query with resources, datasets and outer-joined check state
+    """
+    R = model.Resource
+    D = model.Package
+    S = ResourceCheckState
 
-    def get_report_data(options_dict):
-        reg = ReportRegistry.instance()
-        rep = reg.get_report('broken-links')
+    def index(name):
+        return literal_column(str(PRIORITIES.index(name)))
+
+    # modification times are in UTC, check times are local and truncated
+    # to seconds, so modifications in the same second as check are ignored
+    utc_offset = int(round((datetime.now() - datetime.utcnow()).total_seconds()))
+    shift = timedelta(seconds=utc_offset - 1)
+    return case([(S.checked_at == None, index('new')),
+                 (or_(R.last_modified + shift > S.checked_at,
+                      D.metadata_modified + shift > S.checked_at), index('modified')),
+                 (S.error != None, index('broken'))],
+                else_=index('oldest'))
 
-        entity_name = extract_entity_name(options_dict)
-        key = rep.generate_key(options_dict)
-        data, date = DataCache.get(entity_name, key, convert_json=True)
-        if data['marker'] == BROKEN_LINKS_MARKER if data else False:
-            return data
+
+def _prioritize(q):
+    """
+    Return (query with (resource, priority index) rows in order
+    of priority, dict of priority index -> number of resources)
+    """
+    R = model.Resource
+    S = ResourceCheckState
+    priority = _get_priority()
+    q = q.outerjoin(S, S.resource_id == R.id)\
+         .order_by(None)
+    priorities = q.with_entities(priority.label('priority')).subquery()
+    totals = dict(model.Session.query(priorities.c.priority, func.count(1))
+                               .group_by(priorities.c.priority))
+    # oldest checks first in each class, never checked are in own class
+    q = q.add_columns(priority)\
+         .order_by(priority, S.checked_at, R.url, R.id)
+    return q, totals
+
+
+def _iter_committed(q, batch_size=RESULTS_BATCH_SIZE):
+    """
+    Yield rows of resources query (joined with datasets), loaded
+    with their datasets in batches by resource id.
+
+    Ids are read first, in query order, and db session is committed
+    before each next batch is loaded, so results stored by then are
+    committed, and check run isn't one long transaction. Resources
+    already passed to checks are expired by commit, but checks don't
+    read them after `ckanext.gsreport.checkers.prepare_check`.
+    """
+    R = model.Resource
+    ids = [r[0] for r in q.with_entities(R.id)]
+    q = q.options(contains_eager(R.package))
+    for start in range(0, len(ids), batch_size):
+        if start:
+            model.Session.commit()
+        batch_ids = ids[start:start + batch_size]
+        rows = dict((_row_resource(row).id, row) for row in q.filter(R.id.in_(batch_ids)))
+        for res_id in batch_ids:
+            # resource could be deleted in the meantime
+            if res_id in rows:
+                yield rows[res_id]
+
+
+def _row_resource(row):
+    # row of prioritized query is (resource, priority index)
+    return row if isinstance(row, model.Resource) else row[0]
+
+
+def _count_priorities(rows, counts):
+    """
+    Yield resources from (resource, priority index) rows,
+    counting them by priority
+    """
+    for res, priority in rows:
+        counts[priority] += 1
+        yield res
+
+
+def _store_states(results):
+    """
+    Store check state of results, which is needed to prioritize next run
+    when incremental checks are disabled
+    """
+    batch = []
+    for out in results:
+        if not out.get('inferred'):
+            batch.append(out)
+        if len(batch) >= RESULTS_BATCH_SIZE:
+            ResourceCheckState.update_from_results(batch)
+            batch = []
+        yield out
+    if batch:
+        ResourceCheckState.update_from_results(batch)
+
+
+def _carry_forward(results, rows, counts):
+    """
+    Yield check results, followed by results of resources from `rows`,
+    which were left unchecked when time budget was used. These get
+    verdict of their last check (see `ResourceCheckState`), and are
+    marked with `rechecked` set to False. Resources never checked
+    before (or with changed url) get no result.
+
+    Number of carried results is counted in `counts['carried']`.
+    """
+    for out in results:
+        yield out
+
+    def carried(batch):
+        states = ResourceCheckState.get_for_resources([res.id for res in batch])
+        for res in batch:
+            prev = states.get(res.id)
+            if prev is None:
+                continue
+            out = prepare_check(res)
+            if prev.url != out['url']:
+                continue
+            out.update(prev.get_result())
+            out['checked_at'] = prev.checked_at.strftime("%Y-%m-%d %H:%M:%S")
+            out['rechecked'] = False
+            counts['carried'] += 1
+            yield out
+
+    batch = []
+    for row in rows:
+        batch.append(_row_resource(row))
+        if len(batch) >= RESULTS_BATCH_SIZE:
+            for out in carried(batch):
+                yield out
+            batch = []
+    for out in carried(batch):
+        yield out
+
+
+def _coverage_data(coverage):
+    """
+    Return coverage of run from list of (priority, total, checked)
+    tuples, or None for runs without coverage
+    """
+    if not coverage:
+        return None
+    total = sum(c[1] for c in coverage)
+    checked = sum(c[2] for c in coverage)
+    return {'total': total,
+            'checked': checked,
+            'pct': checked * 100.0 / total if total else 100.0,
+            'complete': checked >= total,
+            'budget': TIME_BUDGET,
+            'priorities': [{'priority': p, 'total': t, 'checked': c}
+                           for p, t, c in coverage]}
+
+
+def _broken_links_data(run, org, dataset, table, listed, count, ecount, derr, host_stats,
+                       coverage=None):
+    # percentages on the same base as in summary
+    return _get_stats_pct({'table': table,
+                           'organization': org,
+                           'dataset': dataset,
+                           'total.datasets': (run.total_datasets or 0) if run is not None else 0,
+                           'total.resources': count,
+                           'errors.datasets': len(derr),
+                           'errors.resources': ecount,
+                           'table_limit': TABLE_LIMIT,
+                           'table_rows': listed,
+                           'page_size': PAGE_SIZE,
+                           'run_id': run.id if run is not None else None,
+                           'host_stats': host_stats,
+                           'coverage': _coverage_data(coverage),
+                           })
+
+
+def _broken_links_from_run(org):
+    """
+    Build organization report from stored results of latest finished run
+    """
+    run = CheckRun.get_latest(org)
+    if run is None:
+        return _broken_links_data(None, org, None, [], 0, 0, 0, set(), [])
+    run.clear_report_pages()
+    table, listed, count, ecount, derr = _collect_broken_links(run.iter_results(RESULTS_BATCH_SIZE), run)
+    coverage = sorted(((p, t, c,) for p, (t, c) in run.get_coverage().items()),
+                      key=lambda c: PRIORITIES.index(c[0]) if c[0] in PRIORITIES else len(PRIORITIES))
+    return _broken_links_data(run, org, None, table, listed, count, ecount, derr,
+                              run.get_host_stats(), coverage)
+
+
+def get_broken_links_page(run_id, page):
+    """
+    Return list of rows from page of stored broken-links report
+    (see `report_broken_links`), or None if there's no such page.
+    """
+    data = CheckRun.get_report_page(run_id, page)
+    if data is None:
+        return None
+    return [row_dict_norm(row) for row in decode_rows(data)]
+
+
+def get_broken_link_details(run_id, resource_id):
+    """
+    Return full check result for resource from stored broken-links
+    run, with response headers and data.
+    """
+    return CheckRun.get_result(run_id, resource_id)
+
+
+def report_broken_links(org=None, dataset=None):
+    """
+    Check resources from organization or dataset and list those
+    which are not working.
+
+    Without organization and dataset, summary for each organization
+    is returned, computed from stored results of latest organization runs.
+
+    Report for organization or dataset contains first page of failed
+    resources in `table`. All listed failed resources are stored in pages
+    of compact report storage for run (`run_id`), which can be loaded
+    with `get_broken_links_page`. Response headers and data are not
+    included in rows, see `get_broken_link_details`.
+
+    With `ckanext.gsreport.broken_links.prioritized` enabled, resources
+    are checked in order of priority (see PRIORITIES). With
+    `ckanext.gsreport.broken_links.time_budget` set, checking stops when
+    budget is used. Resources left unchecked keep verdict of their last
+    check (see `_carry_forward`), so totals of report (and of summary)
+    are counted from resources with known verdict. Report contains
+    `coverage` of such runs: number of resources and checked resources
+    in each priority class.
+
+    With `ckanext.gsreport.broken_links.sharded` enabled, organization's
+    resources are not checked, report is built from latest run
+    completed by workers.
+    """
 
     def get_report_summary(data):
 
@@ -169,8 +613,6 @@ def report_broken_links(org=None, dataset=None):
                'total.datasets': 0,
                'errors.resources': 0,
                'errors.datasets': 0,
-               'errors.resources_pct': 0,
-               'errors.datasets_pct': 0
                }
 
         for row in data:
@@ -179,52 +621,33 @@ def report_broken_links(org=None, dataset=None):
             out['errors.resources'] += row['errors.resources']
             out['errors.datasets'] += row['errors.datasets']
 
-        if out['total.resources'] > 0:
-            out['errors.resources_pct'] = out['errors.resources'] * 100.0/out['total.resources']
-        else:
-            out['errors.resources_pct'] = 0.0
-        if out['total.datasets'] > 0:
-            out['errors.datasets_pct'] = out['errors.datasets'] * 100.0/out['total.datasets']
-        else:
-            out['errors.datasets_pct'] = 0.0
-        return out
-
-    def get_report_stats(data, org_name):
-        out = {'organization': org_name}
-        out.update(dict(((k,v,) for k,v in data.items() if k.startswith('total.'))))
-        out.update(dict(((k,v,) for k,v in data.items() if k.startswith('errors.'))))
-
-        if data['total.resources'] > 0:
-            out['errors.resources_pct'] = data['errors.resources'] * 100.0/data['total.resources']
-        else:
-            out['errors.resources_pct'] = 0.0
-        if data['total.datasets'] > 0:
-            out['errors.datasets_pct'] = data['errors.datasets'] * 100.0/data['total.datasets']
-        else:
-            out['errors.datasets_pct'] = 0.0
-        return out
+        return _get_stats_pct(out)
 
     s = model.Session
     R = model.Resource
     D = model.Package
     O = model.Group
 
-    if org or dataset:
+    if org and not dataset and SHARDED:
+        return _broken_links_from_run(org)
+    elif org or dataset:
         q = s.query(R)\
              .join(D, D.id == R.package_id)\
              .filter(and_(R.state == 'active',
                           D.state == 'active'))\
-             .order_by(R.url)
+             .order_by(R.url, R.id)
         if org:
             q = q.join(O, O.id == D.owner_org).filter(O.name==org)
         if dataset:
             q = q.filter(or_(D.name == dataset,
                              D.id == dataset,
                              D.title == dataset))
-        table = []
         count = q.count()
         log. info("Checking broken links for %s items", count)
 
+        if PRIORITIZED:
+            q, totals = _prioritize(q)
+
         # we need dataset count later, in summary report
         dcount_q = s.query(D)\
                     .filter(D.state == 'active')
@@ -236,145 +659,317 @@ def report_broken_links(org=None, dataset=None):
                                            D.title == dataset))
         dcount = dcount_q.count()
 
+        run = CheckRun.start(organization=org, dataset=dataset)
+        state = ResourceCheckState if CHECK_INCREMENTAL else None
+        stats = HostStats()
+        deadline = time.time() + TIME_BUDGET if TIME_BUDGET > 0 else None
+        checked = Counter()
+        carried = Counter()
+        rows = _iter_committed(q)
+        if PRIORITIZED:
+            resources = _count_priorities(rows, checked)
+        else:
+            resources = rows
+        results = check_resources(resources, state=state, stats=stats,
+                                  versions=OwsVersion, deadline=deadline)
+        # states are needed to prioritize next run, and to carry
+        # verdicts of resources left unchecked
+        if (PRIORITIZED or deadline is not None) and state is None:
+            results = _store_states(results)
+        results = _carry_forward(results, rows, carried)
+        results = _store_results(run, results)
         # datasets with errors
-        derr = set()
-        for res in q:
-            out = check_url(res)
-            if out:
-                table.append(row_dict_norm(out))
-                derr.add(out['dataset_id'])
-
-        return {'table': table,
-                'organization': org,
-                'dataset': dataset,
-                'marker': BROKEN_LINKS_MARKER,
-                'total.datasets': dcount,
-                'total.resources': count,
-                'errors.datasets': len(derr),
-                'errors.resources': len(table),
-                }
+        table, listed, _count, ecount, derr = _collect_broken_links(results, run)
+        host_stats = stats.summary()
+        run.add_host_stats(host_stats)
+
+        coverage = None
+        if PRIORITIZED:
+            coverage = [(p, totals.get(idx, 0), checked[idx],)
+                        for idx, p in enumerate(PRIORITIES)]
+        elif deadline is not None:
+            coverage = [(PRIORITY_ALL, count, _count - carried['carried'],)]
+        if coverage:
+            run.add_coverage(coverage)
+            log.info('checked %s of %s resources, %s verdicts carried from previous checks',
+                     _count - carried['carried'], count, carried['carried'])
+        run.finish(dcount, keep_runs=KEEP_RUNS)
+
+        # totals are counted from stored results, as in summary
+        return _broken_links_data(run, org, dataset, table, listed, _count, ecount, derr,
+                                  host_stats, coverage)
     else:
-        table = []
-
-        for org_name in _get_organizations():
-            if not org_name:
-                continue
-            report_args = {'org': org_name, 'dataset': None}
-            data = get_report_data(report_args)
-            if not data:
-                raise ValueError("No report previously "
-                                 "cached for {}"
-                                 .format(BROKEN_LINKS_MARKER))
-            
-            row_stats = get_report_stats(data, org_name)
-            table.append(row_dict_norm(row_stats))
+        table = [row_dict_norm(_get_stats_pct(row))
+                 for row in CheckRun.get_latest_stats()]
         out = {'table': table,
-                'organization': None,
-                'marker': BROKEN_LINKS_MARKER,
-                }
+               'organization': None,
+               }
         out.update(get_report_summary(table))
         return out
 
-def resources_formats(org=None, res_format=None):
+def _resources_format_rows_query(s):
+    """
+    Return query for resource rows listed in `resources-format` report for format
+    """
+    R = model.Resource
+    P = model.Package
+    O = model.Group
+
+    return s.query(O.name,
+                   P.title,
+                   P.id,
+                   P.name,
+                   P.notes,
+                   coalesce(R.format, ''),
+                   R.name,
+                   R.url,
+                   R.id,
+                   R.size,
+                   R.last_modified,
+                   R.description,
+                   R.created,
+                   R.id,
+                   R.state,
+                   P.private
+                   ,
+                   )\
+            .select_from(R)\
+            .join(P, P.id == R.package_id)\
+            .join(O, O.id == P.owner_org)\
+            .order_by(O.name, P.title, R.name, R.id)
+
+
+def _filter_resources_format(q, org, res_format):
+    """
+    Filter `resources-format` query on resources with format (or without
+    format, for EMPTY_STRING_PLACEHOLDER) in active datasets of organization
+    """
+    R = model.Resource
+    P = model.Package
+    O = model.Group
+
+    if res_format != EMPTY_STRING_PLACEHOLDER:
+        q = q.filter(and_(P.state == 'active',
+                          R.format==res_format))
+    else:
+        q = q.filter(and_(P.state == 'active',
+                          R.format.in_(['', None,])))
+    if org:
+        q = q.filter(O.name==org)
+    return q
+
+
+def _resources_format_row(r):
+    return row_dict_norm(
+             {'organization': {'name': r[0]},
+              'dataset': {'title': r[1],
+                          'id': r[2],
+                          'name': r[3],
+                           'private': r[15],
+                          'notes': r[4]},
+              'resource': {'format': r[5],
+                           'name': r[6],
+                           'url': r[7],
+                           'id': r[8],
+                           'size': r[9],
+                           'last_modified': dformat(r[10]),
+                           'description': r[11],
+                           'created': dformat(r[12]),
+                           'id': r[13],
+                           'state': r[14],
+                          }
+                })
+
+
+def _resources_formats_summary():
+    if LIVE_COUNTERS:
+        table = [{'format': f, 'count': count} for f, count in get_live_format_counts()]
+        return table, len(table)
+
+    s = model.Session
+    R = model.Resource
+    P = model.Package
+
+    q = s.query(coalesce(R.format, EMPTY_STRING_PLACEHOLDER), func.count(1))\
+         .join(P, P.id == R.package_id)\
+         .filter(and_(R.state == 'active',
+                      P.state == 'active'))\
+         .group_by(coalesce(R.format, EMPTY_STRING_PLACEHOLDER))\
+         .order_by(desc(func.count(R.format)))
+    table = [{'format': r[0], 'count': r[1]} for r in q]
+    return table, len(table)
+
+
+class ResourcesFormatPass(object):
+    """
+    Single ordered pass over resources of all formats and organizations,
+    used to generate all `resources-format` report combinations with
+    a few queries, instead of several queries for each combination.
+
+    Rows are streamed from separate db connection, ordered by format and
+    organization, so data for each (format, organization) combination
+    is available once, in order returned by
+    `resources_format_options_combinations`. Data for all organizations
+    is available after organizations for that format. Tables contain
+    first `FORMAT_LIST_LIMIT` rows. For combinations requested out of order,
+    None is returned, and regular queries should be used.
+    """
+
+    def __init__(self, counts):
+        self.counts = counts
+        self._passed = set()
+        self._head_format = None
+        self._head = []
+        self._summary = None
+        self._conn = self._groups = None
+        self._closed = False
+
+    def _start(self):
+        R = model.Resource
+        P = model.Package
+        O = model.Group
+
+        q = _resources_format_rows_query(model.Session)\
+                .filter(and_(P.state == 'active',
+                             R.format != None))\
+                .order_by(None)\
+                .order_by(R.format, O.name, P.title, R.name, R.id)
+        self._conn = model.meta.engine.connect()
+        rows = self._conn.execution_options(stream_results=True).execute(q.statement)
+        self._groups = groupby(rows, key=lambda r: (r[5] or EMPTY_STRING_PLACEHOLDER, r[0],))
+
+    def close(self):
+        self._closed = True
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = self._groups = None
+
+    def get(self, org, res_format):
+        """
+        Return report data for combination, or None if it's not available
+        """
+        if not res_format:
+            if self._summary is None:
+                self._summary = _resources_formats_summary()
+            table, format_count = self._summary
+            return _resources_formats_data(list(table), org, res_format,
+                                           sum(row['count'] for row in table),
+                                           format_count)
+        if org:
+            table = self._advance((res_format, org,))
+            res_count = self.counts.get((res_format, org,), 0)
+        elif res_format == self._head_format:
+            table = list(self._head)
+            res_count = sum(count for (f, o), count in self.counts.items() if f == res_format)
+        else:
+            table = None
+        if table is not None:
+            return _resources_formats_data(table, org, res_format, res_count, res_count)
+
+    def _advance(self, key):
+        if key in self._passed or self._closed:
+            return
+        if self._groups is None:
+            self._start()
+        for group_key, rows in self._groups:
+            self._passed.add(group_key)
+            if group_key[0] != self._head_format:
+                self._head_format = group_key[0]
+                self._head = []
+            table = [] if group_key == key else None
+            for r in rows:
+                row = None
+                if table is not None and len(table) < FORMAT_LIST_LIMIT:
+                    row = _resources_format_row(r)
+                    table.append(row)
+                if len(self._head) < FORMAT_LIST_LIMIT:
+                    self._head.append(row or _resources_format_row(r))
+                elif table is None or len(table) >= FORMAT_LIST_LIMIT:
+                    break
+            if len(self._passed) >= len(self.counts):
+                self.close()
+            if table is not None:
+                return table
+        self.close()
+
+
+def _resources_formats_data(table, org, res_format, res_count, format_count):
+    return {'table': table,
+            'organization': org,
+            'options_hide': not res_format,
+            'res_format': res_format,
+            'number_of_resources': res_count,
+            'number_of_formats': format_count}
+
+
+def resources_formats(org=None, res_format=None, formats_pass=None):
+    if formats_pass is not None:
+        data = formats_pass.get(org, res_format)
+        if data is not None:
+            return data
+
     s = model.Session
     R = model.Resource
     P = model.Package
     O = model.Group
 
     if res_format:
-        q = s.query(O.name,
-                    P.title,
-                    P.id,
-                    P.name,
-                    P.notes,
-                    coalesce(R.format, ''),
-                    R.name,
-                    R.url,
-                    R.id,
-                    R.size,
-                    R.last_modified,
-                    R.description,
-                    R.created,
-                    R.id,
-                    R.state,
-                    P.private
-                    ,
-                    )\
-             .select_from(R)\
-             .join(P, P.id == R.package_id)\
-             .join(O, O.id == P.owner_org)\
-             .order_by(O.name, P.title, R.name)
+        q = _resources_format_rows_query(s)
         
         format_q = s.query(coalesce(R.format, ''))\
                     .select_from(R)\
                     .join(P, P.id == R.package_id)\
                     .join(O, O.id == P.owner_org)
 
-        if res_format != EMPTY_STRING_PLACEHOLDER:
-            q = q.filter(and_(P.state == 'active',
-                              R.format==res_format))
-
-            format_q = format_q.filter(and_(P.state == 'active',
-                                            R.format==res_format))
-
-        else:
-            q = q.filter(and_(P.state == 'active',
-                              R.format.in_(['', None,])))
-
-            format_q = format_q.filter(and_(P.state == 'active',
-                                            R.format.in_(['', None,])))
-
-        if org:
-             q = q.filter(O.name==org)
-             format_q = format_q.filter(O.name == org)
+        q = _filter_resources_format(q, org, res_format)
+        format_q = _filter_resources_format(format_q, org, res_format)
 
         res_count = q.count()
         format_count = format_q.count()
-        if not org:
-            q = q.limit(FORMAT_LIST_LIMIT)
-        table = [row_dict_norm(
-                 {'organization': {'name': r[0]},
-                  'dataset': {'title': r[1],
-                              'id': r[2],
-                              'name': r[3],
-                               'private': r[15],
-                              'notes': r[4]},
-                  'resource': {'format': r[5],
-                               'name': r[6],
-                               'url': r[7],
-                               'id': r[8],
-                               'size': r[9],
-                               'last_modified': dformat(r[10]),
-                               'description': r[11],
-                               'created': dformat(r[12]),
-                               'id': r[13],
-                               'state': r[14],
-                              }
-                    })
-                  for r in q]
-        options_hide = False
+        # all rows are available with paginated report rows
+        # (see ckanext.gsreport.paging)
+        q = q.limit(FORMAT_LIST_LIMIT)
+        table = [_resources_format_row(r) for r in q]
     else:
-        q = s.query(coalesce(R.format, EMPTY_STRING_PLACEHOLDER), func.count(1))\
-             .join(P, P.id == R.package_id)\
-             .filter(and_(R.state == 'active',
-                          P.state == 'active'))\
-             .group_by(coalesce(R.format, EMPTY_STRING_PLACEHOLDER))\
-             .order_by(desc(func.count(R.format)))
-        table = [{'format': r[0], 'count': r[1]} for r in q]
-        
-        format_count = q.count()
+        table, format_count = _resources_formats_summary()
         res_count = sum([t['count'] for t in table])
-        options_hide = True
 
-    return {'table': table,
-            'organization': org,
-            'options_hide': options_hide,
-            'res_format': res_format,
-            'number_of_resources': res_count,
-            'number_of_formats': format_count}
+    return _resources_formats_data(table, org, res_format, res_count, format_count)
+
+
+class ResourcesFormatReport(object):
+    """
+    `resources-format` report generation, with data for all option
+    combinations prepared with single pass over resources
+    (see `ResourcesFormatPass`).
+
+    Pass is opened when iteration over `option_combinations` starts,
+    and closed when it ends, so it's used only while report cache is
+    refreshed for all combinations. `generate` called at other times
+    uses regular queries.
+    """
+
+    def __init__(self):
+        self.formats_pass = None
+
+    def option_combinations(self):
+        counts = get_format_counts()
+        self.formats_pass = ResourcesFormatPass(counts)
+        try:
+            for options in resources_format_options_combinations(counts):
+                yield options
+        finally:
+            self.formats_pass.close()
+            self.formats_pass = None
+
+    def generate(self, org=None, res_format=None):
+        return resources_formats(org, res_format, formats_pass=self.formats_pass)
 
 
 def all_reports():
+    resources_format_report = ResourcesFormatReport()
+    licenses_report = LicensesReport()
+
     broken_link_info = {
         'name': 'broken-links',
         'description': _(u"List datasets with resources that are non-existent or return error response"),
@@ -388,8 +983,8 @@ def all_reports():
         'name': 'resources-format',
         'description': _(u"List formats used in resources"),
         'option_defaults': resources_format_options,
-        'generate': resources_formats,
-        'option_combinations': resources_format_options_combinations,
+        'generate': resources_format_report.generate,
+        'option_combinations': resources_format_report.option_combinations,
         'template': 'report/resources_format_report.html',
     }
 
@@ -397,8 +992,8 @@ def all_reports():
         'name': 'licenses',
         'description': _(u"List of licenses used"),
         'option_defaults': org_options.copy(),
-        'generate': report_licenses,
-        'option_combinations': get_organizations,
+        'generate': licenses_report.generate,
+        'option_combinations': licenses_report.option_combinations,
         'template': 'report/licenses_report.html',
     }
     return [
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compact storage of `broken-links` report rows.
+
+Rows of failed resources are stored in pages, each page is a compressed
+json document, in which repeated strings (error messages, hosts,
+dataset titles..) are stored once. Pages can be loaded separately,
+so showing one page of report doesn't require decoding whole table.
+
+Response headers and data are not stored in report rows, they can be
+loaded for one resource from stored check result
+(see `ckanext.gsreport.model.CheckRun.get_result`).
+"""
+
+import json
+import zlib
+from urlparse import urlparse
+
+FORMAT_VERSION = 1
+COMPRESS_LEVEL = 6
+
+# keys of report row, by the way they are stored
+STRING_KEYS = ('resource_id', 'resource_name', 'resource_format',
+               'dataset_id', 'dataset_title', 'dataset_url', 'organization_id',
+               'error', 'msg', 'msg_raw', 'checked_at',)
+# urls are stored as interned scheme://host prefix and path
+URL_KEYS = ('url', 'resource_url',)
+RAW_KEYS = ('code', 'inferred',)
+
+ROW_KEYS = STRING_KEYS + URL_KEYS + RAW_KEYS
+
+
+def get_report_row(out):
+    """
+    Return report row from check result dict (without headers,
+    response data and timing)
+    """
+    return dict((k, out.get(k)) for k in ROW_KEYS)
+
+
+def _split_url(url):
+    if not url:
+        return [url, None]
+    parsed = urlparse(url)
+    prefix = u'{}://{}'.format(parsed.scheme, parsed.netloc) if parsed.netloc else ''
+    return [prefix, url[len(prefix):]]
+
+
+class _Strings(object):
+
+    def __init__(self):
+        self.values = []
+        self._index = {}
+
+    def intern(self, value):
+        if value is None:
+            return None
+        try:
+            return self._index[value]
+        except KeyError:
+            idx = self._index[value] = len(self.values)
+            self.values.append(value)
+            return idx
+
+
+def encode_rows(rows):
+    """
+    Return compressed page with list of report rows
+    """
+    strings = _Strings()
+    out = []
+    for row in rows:
+        item = [strings.intern(row.get(k)) for k in STRING_KEYS]
+        for k in URL_KEYS:
+            prefix, rest = _split_url(row.get(k))
+            item.append([strings.intern(prefix), strings.intern(rest)])
+        item.extend(row.get(k) for k in RAW_KEYS)
+        out.append(item)
+    data = {'version': FORMAT_VERSION,
+            'keys': ROW_KEYS,
+            'strings': strings.values,
+            'rows': out}
+    return zlib.compress(json.dumps(data, separators=(',', ':')), COMPRESS_LEVEL)
+
+
+def decode_rows(data):
+    """
+    Return list of report rows from compressed page
+    """
+    data = json.loads(zlib.decompress(data))
+    strings = data['strings']
+
+    def get(idx):
+        return None if idx is None else strings[idx]
+
+    nstrings = len(STRING_KEYS)
+    nurls = len(URL_KEYS)
+    out = []
+    for item in data['rows']:
+        row = dict((k, get(v)) for k, v in zip(STRING_KEYS, item[:nstrings]))
+        for k, (prefix, rest) in zip(URL_KEYS, item[nstrings:nstrings + nurls]):
+            rest = get(rest)
+            row[k] = None if rest is None else (get(prefix) or u'') + rest
+        row.update(zip(RAW_KEYS, item[nstrings + nurls:]))
+        out.append(row)
+    return out
+
+
+class ReportPages(object):
+    """
+    Writes report rows in pages of `page_size` rows, with `write(page, data)`
+    callable, for example `CheckRun.add_report_page`.
+    """
+
+    def __init__(self, write, page_size):
+        self.write = write
+        self.page_size = max(page_size, 1)
+        self.pages = 0
+        self.rows = 0
+        self._rows = []
+
+    def add(self, row):
+        self._rows.append(row)
+        self.rows += 1
+        if len(self._rows) >= self.page_size:
+            self.flush()
+
+    def flush(self):
+        if self._rows:
+            self.write(self.pages, encode_rows(self._rows))
+            self.pages += 1
+            self._rows = []
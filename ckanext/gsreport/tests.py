@@ -1,18 +1,25 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import threading
+import time
 import unittest
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+import mock
+import requests
 from ckan import model
 from ckan.lib.base import config
 from ckan.model.meta import Session as session
 from ckan.tests.helpers import call_action, reset_db
 from ckanext.report import model as report_model
+from ckanext.gsreport import model as gsreport_model
 from ckanext.report.report_registry import ReportRegistry
 
 
-def make_pkg(idx, org, license_id, formats):
+def make_pkg(idx, org, license_id, formats, prefix='pkg'):
     return {'title': 'pkg {}'.format(idx),
-            'name': 'pkg-{}'.format(idx),
+            'name': '{}-{}'.format(prefix, idx),
             'license_id': license_id,
             'owner_org': org,
             'resources': [{'name': 'res {}'.format(ridx),
@@ -20,10 +27,114 @@ def make_pkg(idx, org, license_id, formats):
                            'format': f} for ridx, f in enumerate(formats)]}
 
 
+class FakeOwsClient(object):
+    version = '1.3.0'
+    contents = {}
+
+    def __init__(self, url):
+        pass
+
+
+class SlowOwsClient(FakeOwsClient):
+
+    def __init__(self, url):
+        time.sleep(10)
+
+
+class UnreachableOwsClient(FakeOwsClient):
+
+    def __init__(self, url):
+        raise requests.ConnectionError('Connection refused')
+
+
+class TimeoutOwsClient(FakeOwsClient):
+
+    def __init__(self, url):
+        raise requests.Timeout('Read timed out')
+
+
+class ProbeHandler(BaseHTTPRequestHandler):
+    # keep-alive connections
+    protocol_version = 'HTTP/1.1'
+    # responses, changed by subclasses
+    head_code = 200
+    get_code = 200
+    size = 100
+    delay = 0
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_HEAD(self):
+        self._respond(self.head_code, False)
+
+    def do_GET(self):
+        self._respond(self.get_code, True)
+
+    def _respond(self, code, body):
+        self.server.requests.append((self.command, self.path, self.headers.get('Range'),))
+        if self.delay:
+            time.sleep(self.delay)
+        data = 'x' * self.size
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if body:
+            self.wfile.write(data)
+
+
+class NoHeadHandler(ProbeHandler):
+    head_code = 405
+    get_code = 206
+
+
+class IgnoreRangeHandler(ProbeHandler):
+    head_code = 405
+    size = 1024 * 1024
+
+
+class SlowHandler(ProbeHandler):
+    delay = 2
+
+
+class NotFoundHandler(ProbeHandler):
+    head_code = 404
+    get_code = 404
+
+
+class ProbeServer(ThreadingMixIn, HTTPServer):
+    """
+    Local http server for checks, counting connections and requests
+    """
+    daemon_threads = True
+
+    def __init__(self, handler=ProbeHandler):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), handler)
+        self.connections = 0
+        self.requests = []
+        self.url = 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def __enter__(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+
 class ReporTestCase(unittest.TestCase):
 
     def setUp(self):
         report_model.init_tables()
+        gsreport_model.init_tables()
 
         self.orgs = [{'name': 'org1',
                      'licenses': ['cc-by', 'cc-by', 'cc-nd', 'other'],
@@ -53,7 +164,8 @@ class ReporTestCase(unittest.TestCase):
             org['packages'] = []
             data.append(org)
             for idx, license in enumerate(licenses):
-                pkg = make_pkg(idx, org_id, license, formats)
+                pkg = make_pkg(idx, org_id, license, formats,
+                               prefix='{}-pkg'.format(org_dict['name']))
                 pkg_dict = call_action('package_create', context=self.ctx, **pkg)
                 org['packages'].append(pkg_dict)
        
@@ -64,3 +176,773 @@ class ReporTestCase(unittest.TestCase):
         timings = {}
         registry = ReportRegistry.instance()
         registry.refresh_cache_for_all_reports()
+
+    def testConcurrentChecks(self):
+        from ckanext.gsreport.checkers import check_resources
+        R = model.Resource
+        q = session.query(R).filter(R.state == 'active').order_by(R.url, R.id)
+
+        def strip(out):
+            # time of check and its duration will differ between runs
+            out.pop('checked_at')
+            out.pop('timing', None)
+            return out
+
+        serial = [strip(out) for out in check_resources(q, workers=1)]
+        concurrent = [strip(out) for out in check_resources(q, workers=4, per_host=2)]
+        self.assertEqual(len(serial), q.count())
+        self.assertEqual(serial, concurrent)
+
+    def testInterleaveHosts(self):
+        from ckanext.gsreport.checkers import interleave_hosts
+        urls = ['http://a/1', 'http://a/2', 'http://a/3', 'http://b/1', 'http://c/1', 'http://b/2']
+        items = [(url, (None, {'url': url}, None,)) for url in urls]
+        keys = [key for key, item in interleave_hosts(items)]
+        self.assertEqual(keys, ['http://a/1', 'http://b/1', 'http://c/1',
+                                'http://a/2', 'http://b/2', 'http://a/3'])
+
+    def testConnectionReuse(self):
+        from ckanext.gsreport import checkers
+        checkers.close_session()
+        try:
+            with ProbeServer() as server:
+                checkers._probe('HEAD', server.url + '/res/1', {})
+                checkers._probe('GET', server.url + '/res/2', {'Range': 'bytes=0-1023'})
+                checkers._probe('HEAD', server.url + '/res/3', {})
+        finally:
+            checkers.close_session()
+        self.assertEqual(len(server.requests), 3)
+        self.assertEqual(server.connections, 1)
+
+    def testCheckersDontShareState(self):
+        from ckanext.gsreport import checkers
+        first = checkers.ResourceChecker(workers=1)
+        second = checkers.ResourceChecker(workers=1)
+        try:
+            self.assertFalse(first.session is second.session)
+            first.ows_cache.get_or_create('key', lambda: 'first')
+            self.assertEqual(second.ows_cache.get_or_create('key', lambda: 'second'), 'second')
+            # closing one checker doesn't touch state of the other
+            second.close()
+            self.assertEqual(len(first.ows_cache), 1)
+            self.assertTrue(checkers.get_checker() is None)
+            with ProbeServer() as server:
+                checkers._checker_context.checker = first
+                try:
+                    checkers._probe('HEAD', server.url + '/res/1', {})
+                    self.assertTrue(checkers.get_session() is first.session)
+                finally:
+                    checkers._checker_context.checker = None
+            self.assertEqual(len(server.requests), 1)
+        finally:
+            first.close()
+
+    def testHttpProbes(self):
+        from ckanext.gsreport import checkers
+        checkers.close_session()
+        try:
+            # HEAD is rejected, ranged GET is sent
+            with ProbeServer(NoHeadHandler) as server:
+                out = checkers.check_http(None, server.url + '/res/1')
+            self.assertIsNone(out)
+            self.assertEqual(server.requests, [('HEAD', '/res/1', None,),
+                                               ('GET', '/res/1', 'bytes=0-1023',)])
+
+            # server ignores Range, only beginning of body is read
+            with ProbeServer(IgnoreRangeHandler) as server:
+                with mock.patch.object(checkers, '_record_response') as record:
+                    out = checkers.check_http(None, server.url + '/res/1', return_headers=True)
+            self.assertIsNone(out.get('error'))
+            self.assertEqual(out['code'], 200)
+            self.assertEqual(len(out['data']), 1024)
+            self.assertEqual(record.call_args[0][2], 1024)
+
+            with ProbeServer(SlowHandler) as server, \
+                    mock.patch.object(checkers, 'READ_TIMEOUT', 0.5):
+                out = checkers.check_http(None, server.url + '/res/1')
+            self.assertEqual(out['error'], 'connection-error')
+
+            with ProbeServer(NotFoundHandler) as server:
+                out = checkers.check_http(None, server.url + '/res/1')
+            self.assertEqual(out['error'], 'bad-response-code')
+            self.assertEqual(out['code'], 404)
+        finally:
+            checkers.close_session()
+
+    def testDuplicateUrlsCheckedOnce(self):
+        from ckanext.gsreport import checkers
+        R = model.Resource
+        q = session.query(R).filter(R.state == 'active').order_by(R.url, R.id)
+        calls = []
+
+        def check_http(res, res_url, return_headers=False):
+            calls.append(res_url)
+            return {'error': 'connection-error', 'msg': 'test'}
+
+        with mock.patch.object(checkers, 'check_http', check_http):
+            outs = list(checkers.check_resources(q))
+
+        self.assertEqual(len(outs), q.count())
+        self.assertTrue(len(calls) < len(outs))
+        self.assertEqual(sorted(calls), sorted(set(calls)))
+        self.assertEqual(set(out['error'] for out in outs), set(['connection-error']))
+        pkg_ids = set(pkg['id'] for org in self.data for pkg in org['packages'])
+        self.assertEqual(set(out['dataset_id'] for out in outs), pkg_ids)
+
+    def testOwsClientCache(self):
+        from ckanext.gsreport.cache import LRUCache
+        from ckanext.gsreport.checkers import get_ows_cache_key
+        cache = LRUCache(2)
+        calls = []
+
+        def factory(val):
+            calls.append(val)
+            return val
+
+        for key in ('a', 'b', 'a', 'c', 'b', 'a'):
+            cache.get_or_create(key, lambda: factory(key))
+        # b was evicted by c, then a was evicted by b
+        self.assertEqual(calls, ['a', 'b', 'c', 'b', 'a'])
+        self.assertEqual(len(cache), 2)
+
+        endpoint = 'http://test.server/geoserver/ows'
+        k1 = get_ows_cache_key('wms', endpoint, {'VERSION': ['1.3.0'], 'layers': ['a']})
+        k2 = get_ows_cache_key('wms', endpoint, {'version': ['1.3.0'], 'LAYERS': ['b']})
+        k3 = get_ows_cache_key('wms', endpoint, {'version': ['1.1.1'], 'layers': ['a']})
+        self.assertEqual(k1, k2)
+        self.assertNotEqual(k1, k3)
+
+    def testOwsConnectionErrors(self):
+        from ckanext.gsreport.checkers import evaluate_ows
+        for client_cls in (UnreachableOwsClient, TimeoutOwsClient,):
+            verdict = evaluate_ows(client_cls, 'http://test.server/ows')
+            self.assertEqual(verdict['status'], 'connection-error')
+
+    def testOwsProcessPool(self):
+        from ckanext.gsreport import checkers
+        with mock.patch.object(checkers, 'OWS_TIMEOUT', 1):
+            pool = checkers.OwsProcessPool(2)
+            try:
+                ok = checkers._create_ows_verdict('wms', FakeOwsClient, 'http://test.server/ows', pool=pool)
+                slow = checkers._create_ows_verdict('wms', SlowOwsClient, 'http://test.server/ows', pool=pool)
+            finally:
+                pool.close()
+
+        self.assertEqual(ok, {'status': 'ok', 'msg': None, 'version': '1.3.0', 'layers': frozenset()})
+        self.assertEqual(slow['status'], 'timeout')
+
+        # timed out service is reported as such, not as invalid OWS endpoint
+        with mock.patch.object(checkers, '_get_ows_verdict', lambda *args: slow), \
+                mock.patch.object(checkers, 'check_http', lambda *args, **kwargs: {}):
+            out = checkers.check_ows(None, 'http://test.server/ows?service=WMS', 'wms')
+        self.assertEqual(out['error'], 'timeout')
+
+    def testStreamingCapabilities(self):
+        from ckanext.gsreport.capabilities import parse_capabilities
+        doc = ('<?xml version="1.0"?>'
+               '<WMS_Capabilities version="1.3.0" xmlns="http://www.opengis.net/wms">'
+               '<Service><Name>WMS</Name><Title>test</Title></Service>'
+               '<Capability><Layer><Title>root</Title>'
+               + ''.join('<Layer><Name>layer_{}</Name></Layer>'.format(i) for i in range(100)) +
+               '</Layer></Capability></WMS_Capabilities>')
+        chunks = [doc[i:i + 64] for i in range(0, len(doc), 64)]
+        read = []
+
+        def tracked():
+            for chunk in chunks:
+                read.append(chunk)
+                yield chunk
+
+        verdict = parse_capabilities(tracked(), 'wms')
+        self.assertEqual(verdict['status'], 'ok')
+        self.assertEqual(verdict['version'], '1.3.0')
+        # reading stops after service identification
+        self.assertTrue(len(read) < len(chunks))
+
+        verdict = parse_capabilities(chunks, 'wms', layers=['layer_5', 'missing'])
+        self.assertEqual(verdict['missing_layers'], ['missing'])
+        self.assertEqual(parse_capabilities(chunks, 'wfs')['status'], 'contents-error')
+        self.assertEqual(parse_capabilities(chunks, 'wms', max_bytes=100)['status'], 'too-large')
+        # names are matched without namespace prefix, reading stops when all are found
+        del read[:]
+        verdict = parse_capabilities(tracked(), 'wms', layers=['ns:layer_5'])
+        self.assertEqual(verdict['missing_layers'], [])
+        self.assertTrue(len(read) < len(chunks))
+        # limit reached while looking for layers isn't a pass
+        verdict = parse_capabilities(chunks, 'wms', layers=['layer_99'], max_bytes=len(doc) // 2)
+        self.assertEqual(verdict['status'], 'truncated')
+        self.assertNotIn('missing_layers', verdict)
+        self.assertEqual(parse_capabilities(['<ServiceExceptionReport><ServiceException>'
+                                             'failed</ServiceException></ServiceExceptionReport>'],
+                                            'wms'),
+                         {'status': 'service-error', 'msg': 'failed', 'version': None})
+
+    def testLayerIndex(self):
+        from ckanext.gsreport.checkers import get_layer_index, get_missing_layers
+        index = get_layer_index(['topp:states', 'roads'])
+        params = {'layers': ['topp:states,states,ws:roads,rivers'],
+                  'typename': ['topp:lakes'],
+                  'format': ['image/png']}
+        self.assertEqual(get_missing_layers(index, params), ['rivers', 'topp:lakes'])
+        self.assertEqual(get_missing_layers(None, params), [])
+        self.assertEqual(get_missing_layers(index, {'layers': ['roads']}), [])
+
+    def testOwsVersionMemory(self):
+        from ckanext.gsreport.checkers import OwsVersions, ows_clients
+        from ckanext.gsreport.model import OwsVersion
+        defaults = ows_clients['wfs'][1]
+        versions = OwsVersions()
+        key = 'wfs:http://test.server/ows'
+
+        self.assertEqual(versions.order(key, defaults), defaults)
+        versions.worked(key, '2.0')
+        self.assertEqual([d['version'] for d in versions.order(key, defaults)], ['2.0', '1.0', '1.1'])
+        OwsVersion.save(versions.pop_changes())
+        self.assertEqual(OwsVersion.load_all(), {key: '2.0'})
+
+        # other version failing doesn't drop stored one
+        versions.failed(key, '1.0')
+        self.assertEqual(versions.get(key), '2.0')
+        versions.failed(key, '2.0')
+        self.assertIsNone(versions.get(key))
+        OwsVersion.save(versions.pop_changes())
+        self.assertEqual(OwsVersion.load_all(), {})
+        # csw defaults can be used more than once
+        self.assertEqual(len(list(ows_clients['csw'][1])), len(list(ows_clients['csw'][1])))
+
+    def testTitlesCache(self):
+        from ckanext.gsreport import helpers
+        queries = []
+
+        def query(keys, langs):
+            queries.append((sorted(keys), langs,))
+            titles = {('pkg-1', 'it'): 'Titolo 1',
+                      ('pkg-1', helpers.DEFAULT_LANG): 'Title 1',
+                      ('pkg-2', helpers.DEFAULT_LANG): 'Title 2'}
+            return [(key, lang, titles[(key, lang)]) for key in keys for lang in langs
+                    if (key, lang) in titles]
+
+        helpers.titles_cache.clear()
+        rows = [{'id': 'pkg-1'}, {'id': 'pkg-2'}, {'id': 'pkg-3'}, {'id': 'pkg-1'}]
+        titles = helpers._get_titles('test', query, helpers._get_keys(rows, 'id'), 'it')
+        self.assertEqual(titles, {'pkg-1': 'Titolo 1', 'pkg-2': 'Title 2'})
+        self.assertEqual(len(queries), 1)
+
+        # cached, also missing titles
+        helpers._get_titles('test', query, ['pkg-1', 'pkg-3'], 'it')
+        self.assertEqual(len(queries), 1)
+
+        helpers.titles_cache.pop(('test', 'pkg-1',))
+        helpers._get_titles('test', query, ['pkg-1', 'pkg-2'], 'it')
+        self.assertEqual(queries[-1][0], ['pkg-1'])
+
+        # expired titles are loaded again
+        loaded_at = time.time()
+        with mock.patch.object(helpers.titles_cache, 'ttl', 60), \
+                mock.patch.object(time, 'time', lambda: loaded_at + 61):
+            helpers._get_titles('test', query, ['pkg-1', 'pkg-2'], 'it')
+        self.assertEqual(queries[-1][0], ['pkg-1', 'pkg-2'])
+
+    def testIncrementalChecks(self):
+        from ckanext.gsreport import checkers
+        from ckanext.gsreport.model import ResourceCheckState
+        R = model.Resource
+        q = session.query(R).filter(R.state == 'active').order_by(R.url, R.id)
+        calls = []
+
+        def check_http(res, res_url, return_headers=False, validators=None):
+            calls.append(validators)
+            if validators and validators.get('etag') == 'v1':
+                return {'code': 304, 'etag': 'v1', 'last_modified': None}
+            return {'code': 200, 'etag': 'v1', 'last_modified': None}
+
+        with mock.patch.object(checkers, 'check_http', check_http):
+            first = list(checkers.check_resources(q, state=ResourceCheckState))
+            self.assertEqual(calls[0], {})
+            states = ResourceCheckState.get_for_resources([out['resource_id'] for out in first])
+            self.assertEqual(len(states), len(first))
+            self.assertEqual(set(s.etag for s in states.values()), set(['v1']))
+
+            # conditional requests, 304 is not an error
+            calls[:] = []
+            second = list(checkers.check_resources(q, state=ResourceCheckState))
+            self.assertTrue(calls)
+            self.assertEqual(calls[0], {'etag': 'v1', 'last_modified': None})
+            self.assertEqual([out['error'] for out in second], [None] * len(second))
+
+            # recently checked resources are skipped
+            calls[:] = []
+            with mock.patch.object(checkers, 'CHECK_FRESH_FOR', 3600):
+                third = list(checkers.check_resources(q, state=ResourceCheckState))
+            self.assertEqual(calls, [])
+            self.assertEqual(len(third), len(first))
+
+    def testBrokenLinksSummary(self):
+        from ckanext.gsreport.reports import report_broken_links
+        per_org = dict((org['name'], report_broken_links(org=org['name'])) for org in self.data)
+        # runs of deleted organizations are not listed
+        call_action('organization_create', context=dict(self.ctx), name='org-deleted')
+        report_broken_links(org='org-deleted')
+        call_action('organization_delete', context=dict(self.ctx), id='org-deleted')
+        summary = report_broken_links()
+
+        self.assertEqual([row['organization'] for row in summary['table']],
+                         sorted(per_org.keys()))
+        for row in summary['table']:
+            org_data = per_org[row['organization']]
+            for k in ('total.resources', 'total.datasets',
+                      'errors.resources', 'errors.datasets',):
+                self.assertEqual(row[k], org_data[k])
+        self.assertEqual(summary['total.resources'],
+                         sum(d['total.resources'] for d in per_org.values()))
+
+    def testShardedWorkers(self):
+        from ckanext.gsreport import checkers, reports, workers
+        from ckanext.gsreport.model import CheckQueue
+
+        def check_http(res, res_url, return_headers=False):
+            if res_url.endswith('/0'):
+                return {'error': 'bad-response-code', 'msg': 'test'}
+
+        call_action('organization_create', context=self.ctx, name='org-empty')
+        with mock.patch.object(checkers, 'check_http', check_http):
+            runs = workers.enqueue_runs()
+            self.assertEqual(len(runs), len(self.data) + 1)
+            # run without resources is finished, it won't be merged
+            self.assertEqual([run.organization for run in runs if run.finished_at is not None],
+                             ['org-empty'])
+            # queue is not drained, nothing is added
+            self.assertEqual(workers.enqueue_runs(), [])
+            checked = workers.run_worker('worker-1')
+            self.assertEqual(workers.run_worker('worker-2'), 0)
+            merged = dict((org['name'], reports._broken_links_from_run(org['name'])) for org in self.data)
+            live = dict((org['name'], reports.report_broken_links(org=org['name'])) for org in self.data)
+
+        self.assertEqual(CheckQueue.pending_count(), 0)
+        self.assertEqual(checked, sum(d['total.resources'] for d in live.values()))
+        for org in self.data:
+            for k in ('total.resources', 'total.datasets',
+                      'errors.resources', 'errors.datasets',):
+                self.assertEqual(merged[org['name']][k], live[org['name']][k])
+
+    def testCompactReportStorage(self):
+        from ckanext.gsreport import checkers, reports
+
+        def check_http(res, res_url, return_headers=False):
+            return {'error': 'bad-response-code', 'msg': 'test', 'code': 404,
+                    'headers': 'Server: test', 'data': 'not found'}
+
+        with mock.patch.object(checkers, 'check_http', check_http), \
+                mock.patch.object(reports, 'PAGE_SIZE', 5):
+            data = reports.report_broken_links(org='org1')
+
+        self.assertEqual(len(data['table']), 5)
+        self.assertEqual(data['table_rows'], data['errors.resources'])
+        self.assertNotIn('headers', data['table'][0])
+
+        rows = []
+        page = 0
+        while True:
+            page_rows = reports.get_broken_links_page(data['run_id'], page)
+            if page_rows is None:
+                break
+            rows.extend(page_rows)
+            page += 1
+        self.assertEqual(rows[:5], data['table'])
+        self.assertEqual(len(rows), data['errors.resources'])
+        self.assertEqual(len(set(row['resource_id'] for row in rows)), len(rows))
+
+        details = reports.get_broken_link_details(data['run_id'], rows[0]['resource_id'])
+        self.assertEqual(details['headers'], 'Server: test')
+        self.assertEqual(details['data'], 'not found')
+
+    def testReportRows(self):
+        from ckanext.gsreport import checkers, paging, reports
+
+        self.assertRaises(ValueError, paging.parse_rows_query, {'limit': '0'})
+        self.assertRaises(ValueError, paging.parse_rows_query, {'offset': 'x'})
+
+        options = {'org': None, 'res_format': 'pdf'}
+        data = reports.resources_formats(**options)
+        query = paging.parse_rows_query({'limit': '3',
+                                         'sort': '-dataset.title,resource.name',
+                                         'filter.organization.name': 'org1'})
+        page = paging.get_report_rows('resources-format', data, options, query)
+        self.assertEqual(page['total'], 8)
+        self.assertEqual(len(page['rows']), 3)
+        titles = [row['dataset.title'] for row in page['rows']]
+        self.assertEqual(titles, sorted(titles, reverse=True))
+        self.assertRaises(ValueError, paging.get_report_rows, 'resources-format', data, options,
+                          paging.parse_rows_query({'sort': 'invalid'}))
+
+        def check_http(res, res_url, return_headers=False):
+            return {'error': 'bad-response-code', 'msg': 'test', 'code': 404}
+
+        with mock.patch.object(checkers, 'check_http', check_http), \
+                mock.patch.object(reports, 'PAGE_SIZE', 5):
+            data = reports.report_broken_links(org='org1')
+
+        rows = list(paging.iter_broken_links_rows(data['run_id']))
+        page = paging.get_report_rows('broken-links', data, {'org': 'org1'},
+                                      paging.RowsQuery(offset=3, limit=5))
+        self.assertEqual(page['total'], len(rows))
+        self.assertEqual(page['rows'], rows[3:8])
+
+        page = paging.get_report_rows('broken-links', data, {'org': 'org1'},
+                                      paging.parse_rows_query({'sort': '-resource_name', 'q': 'res 0'}))
+        self.assertEqual(page['total'], 4)
+        self.assertEqual(set(row['resource_name'] for row in page['rows']), set(['res 0']))
+
+    def testExport(self):
+        import csv
+        import json
+        from ckanext.gsreport import checkers, export, reports
+
+        columns, rows = export.get_export('resources-format', {'org': 'org1', 'res_format': 'pdf'})
+        lines = ''.join(export.write_export(columns, rows, 'csv')).splitlines()
+        exported = list(csv.DictReader(lines))
+        self.assertEqual(len(exported), 8)
+        self.assertEqual(set(row['resource.format'] for row in exported), set(['pdf']))
+        self.assertEqual(set(row['organization.name'] for row in exported), set(['org1']))
+
+        columns, rows = export.get_export('resources-format', {'org': None, 'res_format': 'pdf'})
+        chunks = export.write_export(columns, rows, 'jsonl')
+        exported = [json.loads(line) for line in ''.join(chunks).splitlines()]
+        self.assertEqual(len(exported), 12)
+        self.assertEqual(sorted(exported[0].keys()), sorted(export.RESOURCES_FORMAT_COLUMNS))
+
+        def check_http(res, res_url, return_headers=False):
+            return {'error': 'bad-response-code', 'msg': 'test', 'code': 404}
+
+        with mock.patch.object(checkers, 'check_http', check_http):
+            data = reports.report_broken_links(org='org1')
+        session.commit()
+
+        columns, rows = export.get_export('broken-links', {'org': 'org1'})
+        exported = [json.loads(line) for line in ''.join(export.write_export(columns, rows, 'jsonl')).splitlines()]
+        self.assertEqual(len(exported), data['errors.resources'])
+        self.assertEqual(set(row['error'] for row in exported), set(['bad-response-code']))
+        self.assertRaises(ValueError, export.get_export, 'licenses', {})
+        self.assertRaises(ValueError, export.write_export, columns, [], 'xml')
+
+    def testPrioritizedChecks(self):
+        from ckanext.gsreport import checkers, reports
+
+        calls = []
+
+        def check_http(res, res_url, return_headers=False):
+            calls.append(res_url)
+            if res_url.endswith('res/0'):
+                return {'error': 'bad-response-code', 'msg': 'test', 'code': 404}
+
+        with mock.patch.object(checkers, 'check_http', check_http), \
+                mock.patch.object(reports, 'PRIORITIZED', True):
+            data = reports.report_broken_links(org='org1')
+            self.assertEqual(data['coverage']['priorities'][2], {'priority': 'new', 'total': 12, 'checked': 12})
+            self.assertTrue(data['coverage']['complete'])
+
+            # previously broken resources are checked first
+            calls[:] = []
+            data = reports.report_broken_links(org='org1')
+            self.assertTrue(calls[0].endswith('res/0'))
+            coverage = dict((row['priority'], row['total']) for row in data['coverage']['priorities'])
+            self.assertEqual(coverage, {'modified': 0, 'broken': 4, 'new': 0, 'oldest': 8})
+
+    def testCommittedBatches(self):
+        from ckanext.gsreport import reports
+        R = model.Resource
+        D = model.Package
+        q = session.query(R)\
+                   .join(D, D.id == R.package_id)\
+                   .filter(R.state == 'active')\
+                   .order_by(R.url.desc(), R.id)
+        expected = [res.id for res in q]
+        with mock.patch.object(model.Session, 'commit') as commit:
+            rows = list(reports._iter_committed(q, batch_size=5))
+        # query order is kept, session is committed between batches
+        self.assertEqual([res.id for res in rows], expected)
+        self.assertEqual(commit.call_count, (len(expected) - 1) // 5)
+
+    def testTimeBudget(self):
+        from ckanext.gsreport import checkers, reports
+
+        def check_http(res, res_url, return_headers=False):
+            time.sleep(1.1)
+
+        with mock.patch.object(checkers, 'check_http', check_http), \
+                mock.patch.object(checkers, 'CHECK_BATCH_FACTOR', 1), \
+                mock.patch.object(reports, 'TIME_BUDGET', 1):
+            data = reports.report_broken_links(org='org1')
+
+        self.assertEqual(data['coverage']['total'], 12)
+        self.assertEqual(data['coverage']['checked'], 1)
+        self.assertFalse(data['coverage']['complete'])
+        # resources never checked before have no verdict
+        self.assertEqual(data['total.resources'], 1)
+        run = gsreport_model.CheckRun.get_latest('org1')
+        self.assertEqual(len(list(run.iter_results())), 1)
+        self.assertEqual(run.get_coverage(), {'all': (12, 1)})
+
+        def failing_check_http(res, res_url, return_headers=False):
+            if res_url.endswith('res/0'):
+                return {'error': 'bad-response-code', 'msg': 'test', 'code': 404}
+
+        with mock.patch.object(checkers, 'check_http', failing_check_http), \
+                mock.patch.object(reports, 'TIME_BUDGET', 1000):
+            data = reports.report_broken_links(org='org1')
+        self.assertTrue(data['coverage']['complete'])
+        self.assertEqual(data['errors.resources'], 4)
+
+        # unchecked resources keep verdicts of previous run
+        with mock.patch.object(checkers, 'check_http', check_http), \
+                mock.patch.object(checkers, 'CHECK_BATCH_FACTOR', 1), \
+                mock.patch.object(reports, 'TIME_BUDGET', 1):
+            data = reports.report_broken_links(org='org1')
+        self.assertEqual(data['coverage']['checked'], 1)
+        self.assertEqual(data['total.resources'], 12)
+        self.assertEqual(data['errors.resources'], 3)
+        run = gsreport_model.CheckRun.get_latest('org1')
+        results = list(run.iter_results())
+        self.assertEqual(len(results), 12)
+        self.assertEqual(len([out for out in results if out.get('rechecked') is False]), 11)
+
+        # summary uses the same totals
+        row = [row for row in reports.report_broken_links()['table'] if row['organization'] == 'org1'][0]
+        for k in ('total.resources', 'errors.resources', 'errors.resources_pct'):
+            self.assertEqual(row[k], data[k])
+
+    def testLocalFiles(self):
+        import os
+        import shutil
+        import tempfile
+        from ckanext.gsreport import checkers
+
+        calls = []
+
+        def check_http(res, res_url, return_headers=False):
+            calls.append(res_url)
+
+        R = model.Resource
+        resources = session.query(R).filter(R.state == 'active').order_by(R.url, R.id).all()
+        upload = [r for r in resources if r.url == 'res/2'][0]
+        upload.url_type = 'upload'
+        stored = [r for r in resources if r.url == 'res/1'][0]
+        stored.url_type = 'upload'
+        stored.size = 10
+        session.commit()
+
+        storage = tempfile.mkdtemp()
+        os.makedirs(os.path.join(storage, 'res'))
+        with open(os.path.join(storage, 'res', '0'), 'w') as f:
+            f.write('data')
+        try:
+            with mock.patch.object(checkers, 'check_http', check_http), \
+                    mock.patch.object(checkers, 'STORAGE_PATH', storage):
+                stored_path = checkers.get_upload_path(stored.id)
+                os.makedirs(os.path.dirname(stored_path))
+                with open(stored_path, 'w') as f:
+                    f.write('data')
+                results = dict((out['resource_id'], out) for out in checkers.check_resources(resources))
+        finally:
+            shutil.rmtree(storage)
+
+        for res in resources:
+            out = results[res.id]
+            if res.id == stored.id:
+                # uploaded file has different size than resource
+                self.assertEqual(out['error'], 'size-mismatch')
+                self.assertEqual(out['msg_raw'], '4')
+                self.assertEqual(out['local_path'], stored_path)
+            elif res.id == upload.id:
+                # uploaded file is missing in storage, it's checked with http
+                self.assertIsNone(out['local_path'])
+                self.assertIsNone(out['error'])
+                self.assertEqual(out['timing']['handler'], 'check_http')
+            elif res.url == 'res/0':
+                self.assertIsNone(out['error'])
+                self.assertEqual(out['timing']['handler'], 'check_file')
+            else:
+                # the same url as upload, but checked with http
+                self.assertIsNone(out['local_path'])
+                self.assertIsNone(out['error'])
+                self.assertEqual(out['timing']['handler'], 'check_http')
+        # only resources not in storage were checked with http
+        self.assertEqual(set(url.rsplit('/', 1)[-1] for url in calls), set(['1', '2']))
+
+    def testBenchmark(self):
+        from ckanext.gsreport import benchmark
+        R = gsreport_model.check_run_table.c
+
+        results = benchmark.run_benchmark(sizes=(20,))
+        self.assertEqual(len(results), 1)
+        result = results[0]
+        self.assertEqual(set(result.keys()),
+                         set(['size', 'organizations', 'datasets', 'latency', 'failure_rate',
+                              'seed', 'host', 'started_at', 'reports']))
+        self.assertEqual(set(result['reports'].keys()), set(benchmark.REPORT_NAMES))
+        for measured in result['reports'].values():
+            self.assertEqual(set(measured.keys()),
+                             set(['wall_time', 'combinations', 'queries', 'requests',
+                                  'peak_rss_kb', 'peak_rss_growth_kb']))
+            self.assertTrue(measured['combinations'] > 0)
+        self.assertTrue(result['reports']['broken-links']['requests'] > 0)
+
+        # synthetic catalog, its runs and cached reports are removed
+        prefix = u'{}%'.format(benchmark.NAME_PREFIX)
+        self.assertEqual(session.query(model.Group).filter(model.Group.name.like(prefix)).count(), 0)
+        self.assertEqual(session.query(model.Package).filter(model.Package.name.like(prefix)).count(), 0)
+        runs = session.execute(gsreport_model.check_run_table.select()
+                               .where(R.organization.like(prefix))).fetchall()
+        self.assertEqual(runs, [])
+        self.assertEqual(session.execute(gsreport_model.check_result_table.count()).scalar(), 0)
+        self.assertEqual(session.execute(gsreport_model.check_state_table.count()).scalar(), 0)
+        DataCache = report_model.DataCache
+        self.assertEqual(session.query(DataCache)
+                                .filter(DataCache.key.like(u'%{}'.format(prefix))).count(), 0)
+        # only synthetic organizations were refreshed
+        self.assertEqual(session.query(DataCache).filter(DataCache.key.like(u'%org1%')).count(), 0)
+
+    def testHostBreaker(self):
+        from ckanext.gsreport.checkers import HostBreaker
+        breaker = HostBreaker(2, 60)
+        err = {'error': 'connection-error', 'msg': 'host is down'}
+        host = 'test.server'
+
+        self.assertIsNone(breaker.before_check(host))
+        breaker.after_check(host, err)
+        self.assertIsNone(breaker.before_check(host))
+        breaker.after_check(host, err)
+
+        inferred = breaker.before_check(host)
+        self.assertTrue(inferred['inferred'])
+        self.assertEqual(inferred['error'], 'connection-error')
+        self.assertEqual(inferred['msg_raw'], 'host is down')
+        self.assertIsNone(breaker.before_check('other.server'))
+
+        # after cooldown, one probe is allowed
+        breaker.cooldown = 0
+        self.assertIsNone(breaker.before_check(host))
+        self.assertTrue(breaker.before_check(host)['inferred'])
+        breaker.after_check(host, None)
+        self.assertIsNone(breaker.before_check(host))
+
+    def testInferredVerdictsNotStored(self):
+        from collections import OrderedDict
+        from ckanext.gsreport import checkers
+        inferred = {'error': 'connection-error', 'msg': 'test', 'inferred': True}
+        batch = [(None, {'resource_id': str(idx),
+                         'url': 'http://test.server/res/{}'.format(idx % 2),
+                         'resource_format': 'csv'}) for idx in range(4)]
+        verdicts = OrderedDict()
+
+        def check_many(items):
+            return [inferred if item[1]['url'].endswith('/0') else None for item in items]
+
+        outs = list(checkers._check_batch(check_many, batch, verdicts))
+        # inferred result is applied within batch, but not kept for next batches
+        self.assertEqual([out.get('inferred') for out in outs], [True, None, True, None])
+        self.assertEqual(verdicts.values(), [None])
+
+    def testHostStats(self):
+        from ckanext.gsreport.checkers import HostBreaker, HostStats
+        from ckanext.gsreport.metrics import format_metrics
+
+        stats = HostStats()
+        for idx in range(1, 101):
+            resp = {'error': 'bad-response-code' if idx % 10 == 0 else None,
+                    'timing': {'ttfb': 0.01, 'duration': idx / 100.0, 'bytes': 10,
+                               'handler': 'check_http', 'version': None}}
+            stats.add('http://test.server/res/{}'.format(idx), resp)
+        # inferred results are not counted
+        breaker = HostBreaker(1, 60)
+        breaker.after_check('test.server', {'error': 'connection-error', 'msg': 'test',
+                                            'timing': {'ttfb': None, 'duration': 10.0, 'bytes': 0,
+                                                       'handler': 'check_http', 'version': None}})
+        inferred = breaker.before_check('test.server')
+        self.assertTrue(inferred['inferred'])
+        self.assertNotIn('timing', inferred)
+        stats.add('http://test.server/res/0', inferred)
+        stats.add('http://test.server/res/0', dict(inferred, timing={'ttfb': None, 'duration': 10.0, 'bytes': 0,
+                                                                     'handler': 'check_http', 'version': None}))
+
+        summary = stats.summary()
+        self.assertEqual(len(summary), 1)
+        row = summary[0]
+        self.assertEqual(row['host'], 'test.server')
+        self.assertEqual(row['count'], 100)
+        self.assertEqual(row['errors'], 10)
+        self.assertEqual(row['p50'], 0.5)
+        self.assertEqual(row['p95'], 0.95)
+        self.assertEqual(row['p99'], 0.99)
+        self.assertEqual(row['bytes'], 1000)
+
+        row['organization'] = 'org1'
+        metrics = format_metrics([row])
+        self.assertIn('gsreport_link_check_duration_seconds{host="test.server",'
+                      'organization="org1",quantile="0.95"} 0.95', metrics)
+        self.assertIn('gsreport_link_check_error_ratio{host="test.server",organization="org1"} 0.1', metrics)
+
+    def testResourcesFormatPass(self):
+        from ckanext.gsreport import reports
+        report = reports.ResourcesFormatReport()
+        combos = []
+        precomputed = []
+        for c in report.option_combinations():
+            self.assertIsNotNone(report.formats_pass)
+            combos.append(c)
+            precomputed.append(report.generate(**c))
+        # pass is closed when all combinations were generated
+        self.assertIsNone(report.formats_pass)
+        self.assertIn({'res_format': 'pdf', 'org': 'org1'}, combos)
+        self.assertIn({'res_format': 'pdf', 'org': None}, combos)
+        self.assertIn({'res_format': None, 'org': None}, combos)
+
+        regular = [reports.resources_formats(**c) for c in combos]
+        self.assertEqual(precomputed, regular)
+
+    def testLicensesBulk(self):
+        from ckanext.gsreport import reports
+
+        def norm(data):
+            return (sorted((row['license'], row['count'], row['title']) for row in data['table']),
+                    data['number_of_licenses'])
+
+        call_action('organization_create', context=self.ctx, name='org3')
+        report = reports.LicensesReport()
+        combos = []
+        bulk = []
+        for c in report.option_combinations():
+            combos.append(c)
+            bulk.append(norm(report.generate(**c)))
+        self.assertIsNone(report.licenses_reports)
+        # all organizations are listed, also without datasets
+        orgs = [c['organization'] for c in combos]
+        self.assertEqual(sorted(orgs[:-1]), ['org1', 'org2', 'org3'])
+        self.assertIsNone(orgs[-1])
+        regular = [norm(reports.report_licenses(**c)) for c in combos]
+        self.assertEqual(bulk, regular)
+        bulk = dict(zip(orgs, bulk))
+        self.assertEqual(bulk['org3'], ([], 0))
+        self.assertEqual(dict((row[0], row[1]) for row in bulk['org1'][0]),
+                         {'cc-by': 2, 'cc-nd': 1, 'other': 1})
+
+    def testLiveCounters(self):
+        from ckanext.gsreport import model as gm
+        gm.reconcile_counters()
+        formats = dict(gm.get_live_format_counts())
+        self.assertEqual(formats, {'pdf': 12, 'doc': 12})
+        licenses = dict(gm.get_live_license_counts('org1'))
+        self.assertEqual(licenses, {'cc-by': 2, 'cc-nd': 1, 'other': 1})
+
+        from ckanext.gsreport import reports
+        pkg = self.data[0]['packages'][0]
+        # hooks get dataset name when actions are called with it
+        with mock.patch.object(reports, 'LIVE_COUNTERS', True):
+            pkg_dict = dict(pkg, id=pkg['name'], license_id='other')
+            call_action('package_update', context=dict(self.ctx), **pkg_dict)
+            self.assertEqual(dict(gm.get_live_format_counts()), {'pdf': 12, 'doc': 12})
+            self.assertEqual(dict(gm.get_live_license_counts('org1')), {'cc-by': 1, 'cc-nd': 1, 'other': 2})
+
+            call_action('package_delete', context=dict(self.ctx), id=pkg['name'])
+        self.assertEqual(dict(gm.get_live_format_counts()), {'pdf': 10, 'doc': 11})
+        self.assertEqual(dict(gm.get_live_license_counts('org1')), {'cc-by': 1, 'cc-nd': 1, 'other': 1})
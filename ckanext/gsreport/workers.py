@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Sharded `broken-links` checking with many worker processes.
+
+Resources of all organizations are put into work queue in database
+(`enqueue_runs`), one run per organization. Each queued resource belongs
+to a shard computed from its host. Workers (`run_worker`), on the same
+or different machines, lease shards, check claimed batches of resources
+and store results in run's results. When queue is drained, finished runs
+are merged: run is marked as finished and `broken-links` report cache is
+refreshed for organization from stored results.
+"""
+
+import logging
+import os
+import socket
+import zlib
+from collections import OrderedDict
+
+from sqlalchemy import and_
+from sqlalchemy.orm import contains_eager
+from ckan import model
+from ckan.lib.base import config
+import ckan.plugins.toolkit as t
+
+from ckanext.gsreport.checkers import (ResourceChecker, get_check_url, get_host,
+                                       HostStats, CHECK_INCREMENTAL,)
+from ckanext.gsreport.model import CheckRun, CheckQueue, OwsVersion, ResourceCheckState
+from ckanext.gsreport.reports import KEEP_RUNS, RESULTS_BATCH_SIZE, SHARDED
+
+log = logging.getLogger(__name__)
+
+# number of shards in work queue, hosts are spread across them
+DEFAULT_QUEUE_SHARDS = 64
+QUEUE_SHARDS_CONFIG = 'ckanext.gsreport.queue.shards'
+QUEUE_SHARDS = t.asint(config.get(QUEUE_SHARDS_CONFIG, DEFAULT_QUEUE_SHARDS))
+
+# number of resources claimed by worker at once
+DEFAULT_QUEUE_BATCH_SIZE = 200
+QUEUE_BATCH_SIZE_CONFIG = 'ckanext.gsreport.queue.batch_size'
+QUEUE_BATCH_SIZE = t.asint(config.get(QUEUE_BATCH_SIZE_CONFIG,
+                                      DEFAULT_QUEUE_BATCH_SIZE))
+
+# seconds after which shard lease of worker expires, should be
+# longer than checking of one batch
+DEFAULT_QUEUE_LEASE_TIMEOUT = 900
+QUEUE_LEASE_TIMEOUT_CONFIG = 'ckanext.gsreport.queue.lease_timeout'
+QUEUE_LEASE_TIMEOUT = t.asint(config.get(QUEUE_LEASE_TIMEOUT_CONFIG,
+                                         DEFAULT_QUEUE_LEASE_TIMEOUT))
+
+ENQUEUE_BATCH_SIZE = 1000
+
+
+def get_shard(host, shards=None):
+    """
+    Return shard number for host
+    """
+    if isinstance(host, unicode):
+        host = host.encode('utf-8')
+    return (zlib.crc32(host) & 0xffffffff) % (shards or QUEUE_SHARDS)
+
+
+def get_worker_name():
+    return u'{}-{}'.format(socket.gethostname(), os.getpid())
+
+
+def _count_datasets(org):
+    D = model.Package
+    O = model.Group
+    return model.Session.query(D)\
+                        .join(O, O.id == D.owner_org)\
+                        .filter(and_(D.state == 'active', O.name == org))\
+                        .count()
+
+
+def enqueue_runs(organizations=None, force=False):
+    """
+    Start run for each organization (all by default), and put its
+    active resources into work queue. Returns list of started runs.
+    Runs of organizations without resources are finished immediately,
+    as there's nothing to merge.
+
+    If queue is not drained yet, nothing is queued, unless `force` is set.
+    """
+    s = model.Session
+    R = model.Resource
+    D = model.Package
+    O = model.Group
+
+    pending = CheckQueue.pending_count()
+    if pending and not force:
+        log.warning('%s resources are still queued, not adding new runs', pending)
+        return []
+
+    if organizations is None:
+        organizations = [r[0] for r in s.query(O.name)
+                                         .filter(and_(O.is_organization == True,
+                                                      O.state == 'active'))
+                                         .order_by(O.name)]
+    CheckQueue.init_shards(QUEUE_SHARDS)
+    runs = []
+    for org in organizations:
+        run = CheckRun.start(organization=org)
+        q = s.query(R.id, R.url)\
+             .join(D, D.id == R.package_id)\
+             .join(O, O.id == D.owner_org)\
+             .filter(and_(R.state == 'active',
+                          D.state == 'active',
+                          O.name == org))\
+             .yield_per(ENQUEUE_BATCH_SIZE)
+        items = []
+        count = 0
+        for res_id, res_url in q:
+            host = get_host(get_check_url(res_url or ''))
+            items.append((res_id, host, get_shard(host),))
+            if len(items) >= ENQUEUE_BATCH_SIZE:
+                CheckQueue.enqueue(run.id, items)
+                count += len(items)
+                items = []
+        CheckQueue.enqueue(run.id, items)
+        count += len(items)
+        if not count:
+            run.finish(_count_datasets(org), keep_runs=KEEP_RUNS)
+        log.info('queued %s resources for %s', count, org)
+        runs.append(run)
+    s.commit()
+    return runs
+
+
+def _check_items(checker, items):
+    """
+    Check claimed queue items with `ResourceChecker` and store
+    results in their runs.
+    """
+    s = model.Session
+    R = model.Resource
+    D = model.Package
+
+    run_ids = dict((resource_id, run_id) for item_id, run_id, resource_id in items)
+    resources = s.query(R)\
+                 .join(D, D.id == R.package_id)\
+                 .options(contains_eager(R.package))\
+                 .filter(R.id.in_(run_ids.keys()))\
+                 .order_by(R.url, R.id)\
+                 .all()
+
+    results = OrderedDict()
+    for out in checker.check(resources):
+        results.setdefault(run_ids[out['resource_id']], []).append(out)
+    for run_id, run_results in results.items():
+        s.query(CheckRun).get(run_id).add_results(run_results)
+
+
+def run_worker(worker=None):
+    """
+    Check queued resources until queue is drained, then merge
+    finished runs. Returns number of checked resources.
+
+    One `ResourceChecker` (with its pools, http session and caches)
+    is used for all claimed batches.
+    """
+    s = model.Session
+    worker = worker or get_worker_name()
+    state = ResourceCheckState if CHECK_INCREMENTAL else None
+    count = 0
+    with ResourceChecker(state=state, versions=OwsVersion) as checker:
+        while True:
+            shard = CheckQueue.lease_shard(worker, QUEUE_LEASE_TIMEOUT)
+            if shard is None:
+                break
+            log.info('worker %s checking shard %s', worker, shard)
+            while True:
+                items = CheckQueue.claim(worker, shard, QUEUE_BATCH_SIZE)
+                s.commit()
+                if not items:
+                    break
+                _check_items(checker, items)
+                if not CheckQueue.renew_shard(worker, shard, QUEUE_LEASE_TIMEOUT):
+                    # other worker took over the shard, it will check items again
+                    log.warning('worker %s lost lease of shard %s', worker, shard)
+                    s.rollback()
+                    break
+                CheckQueue.complete([item[0] for item in items])
+                s.commit()
+                count += len(items)
+            CheckQueue.release_shard(worker, shard)
+            s.commit()
+    merge_runs()
+    return count
+
+
+def merge_runs():
+    """
+    Finish runs which have all queued resources checked, and refresh
+    `broken-links` report summary (and organization reports, when
+    `ckanext.gsreport.broken_links.sharded` is enabled). Returns list of
+    organization names.
+    """
+    from ckanext.report.report_registry import ReportRegistry
+
+    s = model.Session
+
+    merged = []
+    for run in CheckQueue.get_drained_runs():
+        if not CheckQueue.claim_merge(run):
+            s.rollback()
+            continue
+        stats = HostStats()
+        urls = set()
+        for out in run.iter_results(RESULTS_BATCH_SIZE):
+            # count each url once, as with single process run
+            if out.get('timing') and not out.get('inferred') and out['url'] not in urls:
+                urls.add(out['url'])
+                stats.add(out['url'], out)
+        run.add_host_stats(stats.summary())
+        run.finish(_count_datasets(run.organization), keep_runs=KEEP_RUNS)
+        CheckQueue.remove_run(run.id)
+        s.commit()
+        merged.append(run.organization)
+
+    if merged:
+        report = ReportRegistry.instance().get_report('broken-links')
+        # without sharded mode, organization report would check resources again
+        if SHARDED:
+            for org in merged:
+                report.refresh_cache({'org': org})
+        report.refresh_cache({'org': None})
+        log.info('merged broken-links runs for %s', ', '.join(merged))
+    return merged
@@ -26,6 +26,9 @@ setup(
         [ckan.plugins]
         status_reports=ckanext.gsreport.plugin:StatusReportPlugin
 
+        [paste.paster_command]
+        gsreport=ckanext.gsreport.commands:GsReportCommand
+
         [babel.extractors]
         ckan = ckan.lib.extract:extract_ckan
 